@@ -10,8 +10,18 @@ Path:
 Author: William
 '''
 
+__version__ = '1.1.1'
+
 from .parsers import *
 from .actions import *
 from .expressions import *
 from .utils import *
 from .oplists import *
+from .optimize import *
+from .serialize import *
+from .cache import *
+from .compiler import *
+from .simplify import Simplifier, simplify
+from .batch import evalBatch
+from .frames import Frame, FramePool, framePool
+from .vm import Code, compileProgram, runProgram
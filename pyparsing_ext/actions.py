@@ -2,18 +2,817 @@
 # -*- coding: utf-8 -*-
 
 
+import decimal
+import fractions
 import functools
+import gc
+import sys
+import threading
+import types
 # import dataclasses
 
 import pyparsing as pp
 
+from pyparsing_ext.frames import capture
+
+
+# lazy mode: parse actions record their arguments, action objects are created on first access
+_mode = threading.local()
+
+class lazyActions:
+    '''Context in which the action classes return LazyAction objects
+
+    Example:
+        with lazyActions():
+            ret = pe.parseString(s)
+    '''
+    def __init__(self, flag=True):
+        self.flag = flag
+
+    def __enter__(self):
+        self.outer = getattr(_mode, 'lazy', False)
+        _mode.lazy = self.flag
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        _mode.lazy = self.outer
+
+
+class compactActions(lazyActions):
+    '''Context in which the action objects are compact:
+    after construction they keep their fields and `loc` only, see `compact`
+    (the token list and the reference to the source string are dropped)'''
+
+    def __enter__(self):
+        self.outer = getattr(_mode, 'compact', False)
+        _mode.compact = self.flag
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        _mode.compact = self.outer
+
+
+class internActions(lazyActions):
+    '''Context in which structurally identical action objects are shared
+
+    flag is True for a new Interner, or an Interner to share the objects with
+    former parsings. A shared object keeps the location of its first occurrence.
+
+    Example:
+        with internActions() as ctx:
+            ret = pe.parseString(s)
+        print(len(ctx.interner), ctx.interner.hits)
+    '''
+
+    def __enter__(self):
+        self.outer = getattr(_mode, 'interner', None)
+        self.interner = Interner() if self.flag is True else self.flag or None
+        _mode.interner = self.interner
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        _mode.interner = self.outer
+
+
+class _ActionMeta(type):
+    def __call__(cls, *args, **kwargs):
+        interner = getattr(_mode, 'interner', None)
+        if interner is not None:
+            key = interner.key(cls, args, kwargs)
+            if key in interner.nodes:
+                interner.hits += 1
+                return interner.nodes[key]
+        if getattr(_mode, 'lazy', False):
+            action = LazyAction(cls, args, kwargs)
+        else:
+            action = super(_ActionMeta, cls).__call__(*args, **kwargs)
+            if getattr(_mode, 'compact', False):
+                compact(action)
+        if interner is not None and key is not None:
+            interner.nodes[key] = action
+        writer = getattr(_mode, 'writer', None)
+        if writer is not None:
+            writer.add(action)
+        return action
+
+
+def _slots(cls):
+    # names of the slots of cls and of its bases
+    return [name for c in cls.__mro__ for name in c.__dict__.get('__slots__', ())]
+
+def iterfields(action):
+    # (name, value) of the fields of an action object
+    if type(action) is LazyAction:
+        action = action.force()
+    for name in _slots(type(action)):
+        if hasattr(action, name):
+            yield name, getattr(action, name)
+    yield from getattr(action, '__dict__', {}).items()
+
+
+class CompactTokens:
+    '''Compact replacement of ParseResults: items and names
+
+    It supports what the actions use of ParseResults:
+    indexing, slicing, iteration, `name in tokens` and `tokens.name`'''
+    __slots__ = ('items', 'names')
+
+    def __init__(self, items=(), names=None):
+        self.items = tuple(items)
+        self.names = names or None
+
+    @classmethod
+    def of(cls, tokens, memo=None):
+        # convert ParseResults (and the ParseResults in it) to CompactTokens
+        if memo is None:
+            memo = {}
+        if not isinstance(tokens, pp.ParseResults):
+            return tokens
+        if id(tokens) not in memo:
+            memo[id(tokens)] = ret = cls()
+            ret.items = tuple(cls.of(t, memo) for t in tokens)
+            ret.names = {k: cls.of(v, memo) for k, v in tokens.items()} or None
+        return memo[id(tokens)]
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.names[key]
+        return self.items[key]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self.names.get(name, '') if self.names else ''
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __contains__(self, name):
+        return self.names is not None and name in self.names
+
+    def __bool__(self):
+        return bool(self.items)
+
+    def get(self, name, default=None):
+        return self.names.get(name, default) if self.names else default
+
+    def keys(self):
+        return self.names.keys() if self.names else ()
+
+    def haskeys(self):
+        return bool(self.names)
+
+    def asList(self):
+        return [t.asList() if isinstance(t, CompactTokens) else t for t in self.items]
+
+    def __repr__(self):
+        return '(%s, %s)' % (list(self.items), self.names or {})
+
+    def __str__(self):
+        return '[' + ', '.join(str(i) if isinstance(i, CompactTokens) else repr(i) for i in self.items) + ']'
+
+
+def _structure(x, leaf):
+    # hashable structure of tokens, where the action objects are replaced by leaf(action)
+    if isinstance(x, BaseAction):
+        return leaf(x)
+    elif isinstance(x, (pp.ParseResults, CompactTokens)):
+        return (tuple(_structure(t, leaf) for t in x),
+            tuple(sorted((name, _structure(x[name], leaf)) for name in x.keys())))
+    elif isinstance(x, (list, tuple)):
+        return (tuple(_structure(t, leaf) for t in x), ())
+    hash(x)   # TypeError for unhashable tokens
+    return type(x), x
+
+def _same(x, y):
+    # structural equality of tokens, without recursion
+    stack = [(x, y)]
+    while stack:
+        x, y = stack.pop()
+        if x is y:
+            continue
+        elif isinstance(x, BaseAction):
+            if not isinstance(y, BaseAction):
+                return False
+            if type(x) is LazyAction:
+                x = x.force()
+            if type(y) is LazyAction:
+                y = y.force()
+            if type(x).__eq__ not in _structuralEq:
+                if not x == y:
+                    return False
+                continue
+            if type(x) is not type(y):
+                return False
+            h, k = _hashOf(x), _hashOf(y)
+            if h is not None and k is not None and h != k:
+                return False
+            stack.append((x.tokens, y.tokens))
+        elif isinstance(x, (pp.ParseResults, CompactTokens, list, tuple)):
+            if not isinstance(y, (pp.ParseResults, CompactTokens, list, tuple)) or len(x) != len(y):
+                return False
+            xkeys = set(x.keys()) if hasattr(x, 'keys') else set()
+            ykeys = set(y.keys()) if hasattr(y, 'keys') else set()
+            if xkeys != ykeys:
+                return False
+            stack.extend(zip(x, y))
+            stack.extend((x[name], y[name]) for name in xkeys)
+        elif type(x) is not type(y) or x != y:
+            return False
+    return True
+
+def _hashTree(action):
+    # compute the structural hashes of action and of its subtrees, children first
+    stack = [action]
+    while stack:
+        node = stack[-1]
+        if hasattr(node, '_hash'):
+            stack.pop()
+            continue
+        pending = [child for child in node.children() if not hasattr(child, '_hash')]
+        if pending:
+            stack.extend(pending)
+        else:
+            stack.pop()
+            node._hash = hash(_structure(node.tokens, _hashLeaf))
+
+def _hashOf(action):
+    # the structural hash of an action object, None if its tokens are unhashable
+    if type(action) is LazyAction:
+        action = action.force()
+    try:
+        return BaseAction.__hash__(action)
+    except TypeError:
+        return None
+
+def _hashLeaf(action):
+    # the hash of an action object in the tokens, computed before by _hashTree
+    h = _hashOf(action)
+    if h is None:
+        raise TypeError('unhashable action object')
+    return h
+
+
+class Interner:
+    '''Table of the action objects built in `internActions` context
+
+    An action class applied to tokens of the same structure returns the
+    object built first. The structure contains the names of the tokens;
+    action objects in the tokens are compared by identity, since they are
+    interned before.
+
+    Attributes:
+        nodes {dict} -- structure => action object
+        hits {int} -- number of the objects that were shared instead of built
+    '''
+
+    def __init__(self):
+        self.nodes = {}
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def key(self, cls, args, kwargs):
+        # None if the tokens are unhashable, then the object is not interned
+        tokens = args[2] if len(args) > 2 else kwargs.get('tokens', [])
+        try:
+            return cls, _structure(tokens, id)
+        except TypeError:
+            return None
+
+    def clear(self):
+        self.nodes.clear()
+        self.hits = 0
+
+
+class TokenLayout:
+    '''Where the tokens of compact action objects are, among their fields
+
+    items and names are paths (field, index) to the token values, index None for the field itself;
+    items is the name of a field if the tokens are the items of the field (as a statement list).
+    A string in no field (as a keyword) is kept in the layout, with the path (None, string).
+    A layout is shared by all the objects of the same shape (see `of`), so a compact object
+    keeps no token list: its `tokens` are rebuilt from the fields on access.
+    At most maxsize layouts are made, then the objects of new shapes keep their tokens.'''
+    __slots__ = ('items', 'names')
+    _shared = {}
+    maxsize = 4096
+
+    def __init__(self, items=(), names=()):
+        self.items = items
+        self.names = names
+
+    @classmethod
+    def of(cls, action, tokens):
+        # the shared layout of tokens (CompactTokens) in the fields of action, None if a token is in no field
+        fields = [(name, value) for name, value in iterfields(action) if name not in BaseAction.__slots__]
+        def path(t):
+            # a string may be a copy of the token, as the interned names of VariableAction
+            for name, value in fields:
+                if value is t or type(t) is str and type(value) is str and value == t:
+                    return name, None
+            for name, value in fields:
+                if isinstance(value, (list, tuple, CompactTokens)):
+                    for k, v in enumerate(value):
+                        if v is t:
+                            return name, k
+            if type(t) is str:
+                return None, t
+            raise LookupError(t)
+        whole = [name for name, value in fields if isinstance(value, (list, tuple, CompactTokens))
+            and len(value) == len(tokens) and all(v is t for v, t in zip(value, tokens))]
+        try:
+            key = whole[0] if whole else tuple(map(path, tokens)), tuple((name, path(tokens[name])) for name in tokens.keys())
+        except LookupError:
+            return None
+        if key not in cls._shared and len(cls._shared) >= cls.maxsize:
+            return None
+        return cls._shared.setdefault(key, cls(*key))
+
+    @staticmethod
+    def _value(action, path):
+        name, k = path
+        if name is None:
+            return k
+        value = getattr(action, name)
+        return value if k is None else value[k]
+
+    def tokens(self, action):
+        # the tokens of action, rebuilt from its fields
+        items = getattr(action, self.items) if isinstance(self.items, str) else [self._value(action, p) for p in self.items]
+        return CompactTokens(items,
+            {name: self._value(action, p) for name, p in self.names} or None)
+
+
+def compact(action):
+    # make an action object compact in place: its ParseResults become CompactTokens, and
+    # the token list is replaced by its shared TokenLayout when the tokens are all in the fields
+    memo = {}
+    for name, value in list(iterfields(action)):
+        if isinstance(value, pp.ParseResults):
+            setattr(action, name, CompactTokens.of(value, memo))
+        elif type(value) is list and any(isinstance(v, pp.ParseResults) for v in value):
+            setattr(action, name, [CompactTokens.of(v, memo) for v in value])
+    tokens = action._tokens
+    if isinstance(tokens, CompactTokens):
+        action._tokens = TokenLayout.of(action, tokens) or tokens
+    action.instring = None
+    return action
+
+
+class LazyAction:
+    '''Placeholder of an action object, created on first access
+
+    It records the action class (the rule) and the arguments of the parse action
+    (the string, the location and the tokens).
+    isinstance works as for the action object.'''
+    __slots__ = ('_rule', '_args', '_action', '_compact')
+
+    def __init__(self, rule, args=(), kwargs={}):
+        object.__setattr__(self, '_rule', rule)
+        object.__setattr__(self, '_args', (args, kwargs))
+        object.__setattr__(self, '_action', None)
+        object.__setattr__(self, '_compact', getattr(_mode, 'compact', False))
+
+    @property
+    def __class__(self):
+        return self._rule
+
+    @property
+    def loc(self):
+        if self._action is not None:
+            return self._action.loc
+        args, kwargs = self._args
+        return args[1] if len(args) > 1 else kwargs.get('loc', 0)
+
+    def force(self):
+        # create the action object
+        if self._action is None:
+            args, kwargs = self._args
+            action = type.__call__(self._rule, *args, **kwargs)
+            object.__setattr__(self, '_action', compact(action) if self._compact else action)
+        return self._action
+
+    def __getattr__(self, name):
+        return getattr(self.force(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.force(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self.force(), name)
+
+    def __repr__(self):
+        return repr(self.force())
+
+    def __str__(self):
+        return str(self.force())
+
+    def __len__(self):
+        return len(self.force())
+
+    def __bool__(self):
+        return bool(self.force())
+
+    def __contains__(self, name):
+        return name in self.force()
+
+    def __iter__(self):
+        return iter(self.force())
+
+    def __getitem__(self, key):
+        return self.force()[key]
+
+    def __eq__(self, other):
+        return self.force() == other
+
+    def __ne__(self, other):
+        return self.force() != other
+
+    def __hash__(self):
+        return hash(self.force())
+
+    def __call__(self, *args, **kwargs):
+        return self.force()(*args, **kwargs)
+
+
+# traversal of trees of action objects with an explicit stack, without recursion
+def _children(action):
+    # the action objects in the tokens of action
+    stack = [action.tokens]
+    ret = []
+    while stack:
+        x = stack.pop()
+        if isinstance(x, BaseAction):
+            ret.append(x.force() if type(x) is LazyAction else x)
+        elif isinstance(x, (pp.ParseResults, CompactTokens, list, tuple)):
+            stack.extend(reversed(x))
+    return ret
+
+def _each(items, kind=None, *args):
+    # values of items, in a generator run by trampoline: values = yield from _each(items)
+    # with kind, the items computed without steps (such as atoms) are not yielded
+    values = []
+    if kind is None:
+        for item in items:
+            values.append((yield item))
+        return values
+    plans = _plans[kind]
+    for item in items:
+        try:
+            steps, method = plans[type(item)]
+        except KeyError:
+            steps, method = _plan(type(item), kind)
+        if steps or type(item) is LazyAction:
+            values.append((yield item))
+        else:
+            values.append(method(item, *args))
+    return values
+
+def _const(value):
+    # a generator returning value
+    return value
+    yield
+
+class _Text(list):
+    # parts of a long string (str or _Text), joined by str() in linear time
+    def __str__(self):
+        parts = []
+        stack = [self]
+        while stack:
+            x = stack.pop()
+            if isinstance(x, _Text):
+                stack.extend(reversed(x))
+            else:
+                parts.append(x)
+        return ''.join(parts)
+
+def _concat(parts):
+    # short strings are joined at once, long ones are kept in _Text
+    for part in parts:
+        if isinstance(part, _Text):
+            return _Text(parts)
+    s = ''.join(parts)
+    return s if len(s) < 4096 else _Text([s])
+
+def _text(fmt, *args):
+    # fmt % args, where fmt contains only %s
+    for arg in args:
+        if type(arg) is _Text:
+            break
+    else:
+        s = fmt % args
+        return s if len(s) < 4096 else _Text([s])
+    pieces = fmt.split('%s')
+    parts = pieces[:1]
+    for arg, piece in zip(args, pieces[1:]):
+        parts.append(arg if isinstance(arg, (str, _Text)) else str(arg))
+        parts.append(piece)
+    return _concat(parts)
+
+def _joined(sep, parts):
+    # sep.join(parts)
+    for part in parts:
+        if type(part) is _Text:
+            break
+    else:
+        s = sep.join(parts)
+        return s if len(s) < 4096 else _Text([s])
+    ret = []
+    for k, part in enumerate(parts):
+        if k:
+            ret.append(sep)
+        ret.append(part)
+    return _concat(ret)
+
+def _remember(memo, key, task):
+    value = yield from task
+    memo[key] = value
+    return value
+
+
+def trampoline(task, expand):
+    '''Run the generator task with an explicit stack
+
+    A task yields the objects whose values it needs, and receives them;
+    expand(x) returns the value of x, or a task computing it.
+    The depth of the computation is not limited by the recursion limit.
+
+    Arguments:
+        task {generator} -- the computation to run
+        expand {function} -- object => value or task
+
+    Returns:
+        the return value of task
+    '''
+    stack = [task]
+    value = None
+    paused = False
+    try:
+        while stack:
+            try:
+                x = stack[-1].send(value)
+            except StopIteration as e:
+                stack.pop()
+                value = e.value
+                continue
+            task = expand(x)
+            if isinstance(task, types.GeneratorType):
+                stack.append(task)
+                value = None
+                if len(stack) > 1000 and not paused and gc.isenabled():
+                    # the collector would scan the suspended tasks again and again
+                    gc.disable()
+                    paused = True
+            else:
+                value = task
+    finally:
+        if paused:
+            gc.enable()
+    return value
+
+
+def walk(action, order='pre', unique=False):
+    '''Iterate the action objects in the tree of action, without recursion
+
+    Keyword Arguments:
+        order {str} -- 'pre' (parents first) or 'post' (children first) (default: {'pre'})
+        unique {bool} -- visit a shared subtree once (default: {False})
+    '''
+    if type(action) is LazyAction:
+        action = action.force()
+    seen = set()
+    stack = [(action, False)]
+    while stack:
+        node, visited = stack.pop()
+        if visited:
+            yield node
+            continue
+        if unique:
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+        if order == 'pre':
+            yield node
+        else:
+            stack.append((node, True))
+        stack.extend((child, False) for child in reversed(node.children()))
+
+
+class Visitor:
+    '''Visitor of trees of action objects, without recursion
+
+    `visit(node)` calls the method `visit_<Class>` for the class of node (or
+    its nearest base class having one), else `generic_visit`.
+    A method returns the value of node; if it is a generator, it yields the
+    subtrees (or tokens) whose values it needs and receives them:
+
+        class Depth(Visitor):
+            def generic_visit(self, node):
+                depth = 0
+                for child in node.children():
+                    depth = max(depth, (yield child))
+                return depth + 1
+
+    Attributes:
+        cache {bool} -- visit a shared subtree once in each `visit` call
+    '''
+    cache = False
+
+    def visit(self, node):
+        if not self.cache:
+            expand = self.dispatch
+        else:
+            memo = {}
+            def expand(x):
+                if id(x) in memo:
+                    return memo[id(x)]
+                task = self.dispatch(x)
+                if isinstance(task, types.GeneratorType):
+                    return _remember(memo, id(x), task)
+                memo[id(x)] = task
+                return task
+        task = expand(node)
+        if isinstance(task, types.GeneratorType):
+            return trampoline(task, expand)
+        return task
+
+    def dispatch(self, node):
+        if type(node) is LazyAction:
+            node = node.force()
+        for cls in type(node).__mro__:
+            method = getattr(self, 'visit_' + cls.__name__, None)
+            if method is not None:
+                return method(node)
+        return self.generic_visit(node)
+
+    def generic_visit(self, node):
+        # visit the subtrees, in pre-order
+        if isinstance(node, BaseAction):
+            yield from _each(node.children())
+
+
+class Transformer(Visitor):
+    '''Visitor building a new tree, the value of a node is the node replacing it
+
+    `generic_visit` transforms the subtrees in post-order and rebuilds node
+    if one of them is replaced; unchanged subtrees are kept.
+    A method can transform the subtrees first with
+        node = yield from self.generic_visit(node)
+    '''
+    cache = True
+
+    def generic_visit(self, node):
+        if not isinstance(node, BaseAction):
+            return node
+        children = node.children()
+        values = yield from _each(children)
+        if all(a is b for a, b in zip(children, values)):
+            return node
+        return node.rebuild({id(a): b for a, b in zip(children, values)})
+
+
+# evaluation, s-expression and representation of the action objects:
+# the methods evalSteps, sexprSteps and reprSteps are generators run by trampoline,
+# subclasses overriding eval, sexpr or __str__/__repr__ are called directly
+_plainMethods = {'eval': ('eval',), 'sexpr': ('sexpr',), 'str': ('__str__', '__repr__')}
+_stepsMethods = {'eval': 'evalSteps', 'sexpr': 'sexprSteps', 'str': 'reprSteps'}
+_plans = {'eval': {}, 'sexpr': {}, 'str': {}}
+
+def _plan(cls, kind):
+    # (True, generator method) or (False, plain method) of cls for kind
+    plans = _plans[kind]
+    if cls not in plans:
+        plain, steps = _plainMethods[kind], _stepsMethods[kind]
+        if not issubclass(cls, BaseAction):
+            if kind == 'eval':
+                plans[cls] = False, lambda x, *args: x.eval(*args)
+            elif kind == 'sexpr' and issubclass(cls, str):
+                plans[cls] = False, lambda x: x
+            else:
+                plans[cls] = False, str
+            return plans[cls]
+        for c in cls.__mro__:
+            if steps in c.__dict__:
+                plans[cls] = True, getattr(cls, steps)
+                break
+            elif any(name in c.__dict__ for name in plain):
+                plans[cls] = False, str if kind == 'str' else getattr(cls, plain[0])
+                break
+    return plans[cls]
+
+def _run(action, kind, *args):
+    # value of action for kind ('eval', 'sexpr', 'str') with trampoline
+    memo = getattr(args[0], 'memo', None) if kind == 'eval' else None
+    plans = _plans[kind]
+    def expand(x):
+        if type(x) is LazyAction:
+            x = x.force()
+        try:
+            steps, method = plans[type(x)]
+        except KeyError:
+            steps, method = _plan(type(x), kind)
+        if memo is not None and id(x) in memo.nodes:
+            if id(x) not in memo:
+                task = method(x, *args)
+                if isinstance(task, types.GeneratorType):
+                    return _remember(memo, id(x), task if steps else _const(task))
+                memo[id(x)] = task
+            return memo[id(x)]
+        task = method(x, *args)
+        if not steps and isinstance(task, types.GeneratorType):
+            return _const(task)
+        return task
+    value = trampoline(getattr(action, _stepsMethods[kind])(*args), expand)
+    return str(value) if isinstance(value, _Text) else value
+
+
+class EvalMemo(dict):
+    '''Values of the shared subtrees during one evaluation (see `evalShared`)
+
+    A subtree is shared if it occurs more than once in the tree.
+    It is computed once if it is pure: its action class is pure, the functions it
+    calls are pure for the calculator, and so are its subtrees.
+    Subtrees with variables are computed once only if the whole tree is pure,
+    otherwise a function could change the variables between two occurrences.
+
+    Attributes:
+        nodes {set} -- ids of the subtrees computed once
+    '''
+
+    def __init__(self, action, calculator):
+        super().__init__()
+        self.calculator = calculator
+        if type(action) is LazyAction:
+            action = action.force()
+        # count the occurrences of the subtrees, the nodes are listed parents first
+        counts = {id(action): 0}
+        nodes = [action]
+        children = {}
+        for node in nodes:
+            children[id(node)] = cs = [c.force() if type(c) is LazyAction else c for c in _children(node)]
+            for child in cs:
+                if id(child) in counts:
+                    counts[id(child)] += 1
+                else:
+                    counts[id(child)] = 1
+                    nodes.append(child)
+        # check the children before their parents
+        kinds = {}
+        callees = {}
+        order = []
+        stack = [(action, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited:
+                order.append(node)
+            elif id(node) not in kinds:
+                kinds[id(node)] = None
+                stack.append((node, True))
+                stack.extend((c, False) for c in children[id(node)] if id(c) not in kinds)
+        for node in order:
+            if not node.pure:
+                kind = 0
+            else:
+                kind = 1 if isinstance(node, VariableAction) else 2
+                for f in node.callees():
+                    if f not in callees:
+                        callees[f] = calculator.isPure(f)
+                    if not callees[f]:
+                        kind = 0
+                        break
+            kinds[id(node)] = min([kind] + [kinds[id(c)] for c in children[id(node)]])
+        # 0: impure, 1: pure with variables, 2: pure without variables
+        level = 1 if kinds[id(action)] else 2
+        self.nodes = {k for k, n in counts.items() if n > 1 and kinds[k] >= level}
+
+
+def evalShared(action, calculator):
+    '''Evaluate action, computing each shared pure subtree once
+
+    The subtrees are shared by parsing in `internActions` context.
+    The calculator should have the method `isPure(name)`.
+    '''
+    outer, calculator.memo = getattr(calculator, 'memo', None), EvalMemo(action, calculator)
+    try:
+        return action.eval(calculator)
+    finally:
+        calculator.memo = outer
+
+
 # classes for actions
-class BaseAction:
+class BaseAction(metaclass=_ActionMeta):
     '''Base class for parsing action classes
 
     Register the names of tokens in names list.
     '''
+    __slots__ = ('instring', 'loc', '_tokens', '_hash')
     names = ()
+    pure = False   # eval has no side effect except calling the functions in `callees`
     def __init__(self, instring='', loc=0, tokens=[]):
         self.tokens = tokens
         self.instring = instring
@@ -22,6 +821,18 @@ class BaseAction:
             if name in tokens:
                 setattr(self, name, getattr(tokens, name))
 
+    @property
+    def tokens(self):
+        # the tokens, rebuilt from the fields for a compact object (see compact)
+        tokens = self._tokens
+        if type(tokens) is TokenLayout:
+            return tokens.tokens(self)
+        return tokens
+
+    @tokens.setter
+    def tokens(self, value):
+        self._tokens = value
+
     def __contains__(self, name):
         return name in self.tokens
 
@@ -30,27 +841,90 @@ class BaseAction:
 
     def __eq__(self, other):
         if isinstance(other, BaseAction):
-            return self.tokens == other.tokens
+            return _same(self, other)
         else:
             return self.tokens == other
 
+    def __hash__(self):
+        # structural hash of the tokens, cached
+        try:
+            return self._hash
+        except AttributeError:
+            _hashTree(self)
+            return self._hash
+
     def __repr__(self):
-        return ' '.join(map(str, self.tokens))
+        return _run(self, 'str')
+
+    def reprSteps(self):
+        # generator yielding the subtrees to represent, see evalSteps
+        return _joined(' ', (yield from _each(self.tokens, 'str')))
 
+    def sexpr(self):
+        return _run(self, 'sexpr')
+
+    def sexprSteps(self):
+        return _joined(' ', (yield from _each(self.tokens, 'sexpr')))
 
     def __call__(self, *args, **kwargs):
         # if eval defined in action
         return self.eval(*args, **kwargs)
 
-    def eval(self, *args, **kwargs):
-        # evaluate it
-        pass
+    def eval(self, calculator):
+        # evaluate it, see evalSteps
+        return _run(self, 'eval', calculator)
+
+    def evalSteps(self, calculator):
+        # generator yielding the subtrees to evaluate and receiving their values
+        return None
+        yield
+
+    def children(self):
+        # the action objects in the tokens
+        return _children(self)
+
+    def rebuild(self, mapping):
+        """Apply the action class to the tokens where the subtrees are replaced
+
+        Arguments:
+            mapping {dict} -- id of a subtree => new subtree
+        """
+        memo = {}
+        def sub(x):
+            if isinstance(x, BaseAction):
+                return mapping.get(id(x), x)
+            elif id(x) in memo:
+                return memo[id(x)]
+            elif isinstance(x, pp.ParseResults):
+                memo[id(x)] = ret = pp.ParseResults([sub(t) for t in x])
+                for name, occurrences in x._ParseResults__tokdict.items():
+                    for value, offset in occurrences:
+                        ret[name] = pp._ParseResultsWithOffset(sub(value), offset)
+                return ret
+            elif isinstance(x, CompactTokens):
+                memo[id(x)] = ret = CompactTokens(map(sub, x.items))
+                ret.names = {k: sub(v) for k, v in x.names.items()} if x.names else None
+                return ret
+            elif isinstance(x, (list, tuple)):
+                return type(x)(map(sub, x))
+            return x
+        return type(self)(self.instring, self.loc, self.wrapTokens(sub(self.tokens)))
+
+    @classmethod
+    def wrapTokens(cls, tokens):
+        # the tokens to apply the class to, to get an object whose attribute `tokens` is tokens
+        return tokens
 
     def execute(self, *args, **kwargs):
         pass
 
+    def callees(self):
+        # the names of the functions called by eval via the calculator
+        return ()
+
 
 class VarOpAction(BaseAction):
+    __slots__ = ()
     # for operators with variables
     pass
 
@@ -59,6 +933,7 @@ class CallOpAction(VarOpAction):
     '''x(args, kwargs=values) where (args, kwargs=values) is an operator and x is the corresponding operand
     distinguished with f(x)
     '''
+    __slots__ = ('args', 'kwargs')
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
         self.args = tokens.args if 'args' in self else ()
@@ -66,16 +941,18 @@ class CallOpAction(VarOpAction):
 
 
 class DotOpAction(VarOpAction):
+    __slots__ = ('attr',)
     # x.attr
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
         self.attr = tokens.attr
 
-    def eval(self, calculator):
-        return self.attr.eval(calculator)
+    def evalSteps(self, calculator):
+        return (yield self.attr)
 
 
 class IndexOpAction(VarOpAction):
+    __slots__ = ('index', 'slice', 'start', 'step', 'stop')
     # x[start:stop]
     names = ('slice', 'index')
     def __init__(self, instring='', loc=0, tokens=[]):
@@ -88,11 +965,11 @@ class IndexOpAction(VarOpAction):
         else:
             self.index = tokens.index
 
-    def eval(self, calculator):
+    def evalSteps(self, calculator):
         if 'slice' in self:
-            return slice(self.start.eval(calculator), self.stop.eval(calculator), self.step.eval(calculator))
+            return slice((yield self.start), (yield self.stop), (yield self.step))
         else:
-            return self.index.eval(calculator)
+            return (yield self.index)
 
 
 # operators, arithmetic, mathematics, logic:
@@ -108,24 +985,42 @@ class FunctionAction(BaseAction):
            function: a function
            args: the parameters of the function
     """
+    __slots__ = ('args', 'function')
     names = ('function', 'args')
+    pure = True
+
+    def __init__(self, instring='', loc=0, tokens=[]):
+        super().__init__(instring, loc, tokens)
+        # names are looked up in dicts, interned strings are compared by identity
+        function = getattr(self, 'function', None)
+        if type(function) is str:
+            try:
+                self.function = sys.intern(function)
+            except AttributeError:
+                # a class attribute, as in TupleAction
+                pass
 
     def __eq__(self, other):
-        if isinstance(other, FunctionAction):
-            return self.args == other.args and self.function == other.function
+        if isinstance(other, BaseAction):
+            return super().__eq__(other)
         else:
             return self.args == other[1:] and self.function == other[0]
 
-    def __repr__(self):
-        return "%s(%s)"%(self.function, ', '.join(map(str, self.args)))
+    __hash__ = BaseAction.__hash__
 
-    def sexpr(self):
-        return "(%s %s)"%(_tosx(self.function) , ' '.join(_tosx(arg) for arg in self.args))
+    def callees(self):
+        return (self.function,)
+
+    def reprSteps(self):
+        return _text("%s(%s)", self.function, _joined(', ', (yield from _each(self.args, 'str'))))
+
+    def sexprSteps(self):
+        return _text("(%s %s)", (yield self.function), _joined(' ', (yield from _each(self.args, 'sexpr'))))
 
     def arity(self):
         return len(self.args)
 
-    def eval(self, calculator):
+    def evalSteps(self, calculator):
         # calculator(self.function, *self.args)
         args = []
         kwargs = {}
@@ -138,18 +1033,24 @@ class FunctionAction(BaseAction):
                 kwargs[arg.key]=arg.value
             else:
                 args.append(arg)
-        return calculator(self.function, *(arg.eval(calculator) for arg in args))
+        return calculator(self.function, *(yield from _each(args, 'eval', calculator)))
+
+
+_structuralEq = {BaseAction.__eq__, FunctionAction.__eq__}
 
 
 class UnpackAction(BaseAction):
+    __slots__ = ('content',)
     names = ('content',)
 
 
 class KWUnpackAction(BaseAction):
+    __slots__ = ('content',)
     names = ('content',)
 
 
 class KWAction(BaseAction):
+    __slots__ = ('key', 'value')
     names = ('value','key')
  
 
@@ -159,6 +1060,7 @@ class BifixAction(FunctionAction):
     bifix operator has effect of parentheses;
     parentheses in the expression (<x, y>) is tedious
     '''
+    __slots__ = ()
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
         if 'args' in self:
@@ -169,6 +1071,7 @@ class BifixAction(FunctionAction):
 
 
 class OperatorAction(FunctionAction):
+    __slots__ = ()
     def __format__(self, spec=None):
         if spec is None:
             return repr(self)
@@ -184,6 +1087,7 @@ class InfixOperatorAction(OperatorAction):
     It is recommanded to inherite the class to create an action for
     operators in infixNotation.
     """
+    __slots__ = ()
     
     def __init__(self, instring='', loc=0, tokens=[]):
         """
@@ -193,8 +1097,14 @@ class InfixOperatorAction(OperatorAction):
         self.tokens = tokens[0]
         super().__init__(instring, loc, self.tokens)
 
+    @classmethod
+    def wrapTokens(cls, tokens):
+        # the action is applied to [[...]]
+        return CompactTokens([tokens]) if isinstance(tokens, CompactTokens) else pp.ParseResults([tokens])
+
 
 class UnaryOperatorAction(InfixOperatorAction):
+    __slots__ = ('operand', 'parameters')
     # action class for unary operators used in infixNotation
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
@@ -202,18 +1112,20 @@ class UnaryOperatorAction(InfixOperatorAction):
         self.operand = self.tokens[-1]
         self.parameters =  self.tokens[1:-1]
 
-    def eval(self, calculator):
+    def evalSteps(self, calculator):
         # calculator(self.function, *self.args)
-        return calculator(self.function, self.operand.eval(calculator))
+        return calculator(self.function, (yield self.operand))
 
 
 class RightUnaryOperatorAction(UnaryOperatorAction):
+    __slots__ = ()
     pass
 
 
 class LeftUnaryOperatorAction(UnaryOperatorAction):
     '''action class for unary operators used in infixNotation
     such as x*, x' '''
+    __slots__ = ()
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
         self.function, self.args = self.tokens[1], (self.tokens[0],)
@@ -223,26 +1135,31 @@ class LeftUnaryOperatorAction(UnaryOperatorAction):
 class ICDAction(LeftUnaryOperatorAction):
     '''action for index, call and dot:
     a[...], a(...), a.xxx where a is treated as an operand'''
+    __slots__ = ('ops',)
+    pure = False
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
         self.ops = self.tokens[1:]
         self.operand = self.tokens[0]
 
-    def eval(self, calculator):
-        retval = self.operand.eval(calculator)
+    def evalSteps(self, calculator):
+        retval = yield self.operand
         for op in self.ops:
             if isinstance(op, IndexOpAction):
-                retval = retval[op.eval(calculator)]
+                retval = retval[(yield op)]
             elif isinstance(op, CallOpAction):
-                args = (arg.eval(calculator) for args in op.args)
-                kwargs = {k:v.eval(calculator) for k, v in op.kwargs.items()}
+                args = yield from _each(op.args, 'eval', calculator)
+                kwargs = {}
+                for k, v in op.kwargs.items():
+                    kwargs[k] = yield v
                 retval = retval(*args, **kwargs)
             elif isinstance(op, DotOpAction):
-                retval = getattr(retval, op.eval(calculator))
+                retval = getattr(retval, (yield op))
         return retval
 
 
 class BinaryOperatorAction(InfixOperatorAction):
+    __slots__ = ('associative', 'ishybrid')
     # action class for binary operators used in infixNotation
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
@@ -261,27 +1178,31 @@ class BinaryOperatorAction(InfixOperatorAction):
         else:
             return "(%s)(%s)" %(', '.join(self.function), ', '.join(map(str, self.args)))
 
-    def __repr__(self):
+    def reprSteps(self):
+        args = yield from _each(self.args, 'str')
         if not self.ishybrid:
-            return (' %s '%self.function).join(map(str, self.args))
+            return _joined(' %s '%self.function, args)
         else:
-            s = str(self.args[0])
+            parts = args[:1]
             for k, f in enumerate(self.function):
-                s += ' %s %s'%(f, self.args[k])
-            return s
+                parts += [' %s '%f, args[k+1]]
+            return _concat(parts)
 
-    def sexpr(self):
+    def sexprSteps(self):
         if not self.ishybrid:
-            return "(%s %s)" %(_tosx(self.function), ' '.join(_tosx(arg) for arg in self.args))
+            return _text("(%s %s)", (yield self.function), _joined(' ', (yield from _each(self.args, 'sexpr'))))
         else:
-            return "((%s) %s)" %(', '.join(self.function), ' '.join(map(_tosx, self.args)))
+            return _text("((%s) %s)", ', '.join(self.function), _joined(' ', (yield from _each(self.args, 'sexpr'))))
 
-    def eval(self, calculator):
+    def callees(self):
+        return tuple(self.function) if self.ishybrid else (self.function,)
+
+    def evalSteps(self, calculator):
         # calculator(self.function, *self.args)
-        args = tuple(arg.eval(calculator) for arg in self.args)
+        args = tuple((yield from _each(self.args, 'eval', calculator)))
         if self.ishybrid:
             ret = calculator(self.function[0])(args[0], args[1])
-            for f, arg in zip(self.function[1:], self.args[2:]):
+            for f, arg in zip(self.function[1:], args[2:]):
                 ret = calculator(f)(ret, arg)
             return ret
         else:
@@ -289,13 +1210,15 @@ class BinaryOperatorAction(InfixOperatorAction):
 
 
 class LeftBinaryOperatorAction(BinaryOperatorAction):
+    __slots__ = ()
     pass
 
 
 class RightBinaryOperatorAction(BinaryOperatorAction):
+    __slots__ = ()
 
-    def eval(self, calculator):
-        args = tuple(arg.eval(calculator) for arg in self.args)
+    def evalSteps(self, calculator):
+        args = tuple((yield from _each(self.args, 'eval', calculator)))
         if self.ishybrid:
             ret = calculator(self.function[-1])(args[-2], args[-1])
             for f, arg in zip(self.function[-2::-1], args[-3::-1]):
@@ -310,24 +1233,45 @@ class RightBinaryOperatorAction(BinaryOperatorAction):
 
 
 class CompareAction(BinaryOperatorAction):
+    __slots__ = ()
     # action for comparison
-    def eval(self, calculator):
-        args = tuple(arg.eval(calculator) for arg in self.args)
-        if self.ishybrid:
-            for k, f in enumerate(self.function):
-                f = calculator(self.function)
-                if not f(args[k], args[k+1]):
-                    return False
-            return True
-        else:
-            f = calculator(self.function)
-            for k in range(len(args)-1):
-                if not f(args[k], args[k+1]):
-                    return False
-            return True
+    # a chain a < b < c evaluates its operands on demand, it stops at the first false comparison
+    def evalSteps(self, calculator):
+        functions = self.function if self.ishybrid else [self.function] * (len(self.args)-1)
+        left = yield self.args[0]
+        for f, arg in zip(functions, self.args[1:]):
+            right = yield arg
+            if not calculator(f)(left, right):
+                return False
+            left = right
+        return True
+
+
+class LogicalOperatorAction(BinaryOperatorAction):
+    """Action class for the logical operators, such as and, or
+
+    The operands are evaluated one by one: an operand deciding the operator that follows it
+    (false for and, true for or, see `stops`) is its value, without evaluating the next operand.
+    Otherwise the function of the operator is applied, as in BinaryOperatorAction.
+
+    Attributes:
+        stops {dict} -- operator => truth value deciding it
+    """
+    __slots__ = ()
+    stops = {'and': False, 'or': True, '&&': False, '||': True, '&': False, '|': True}
+
+    def evalSteps(self, calculator):
+        functions = self.function if self.ishybrid else [self.function] * (len(self.args)-1)
+        ret = yield self.args[0]
+        for f, arg in zip(functions, self.args[1:]):
+            if f in self.stops and bool(ret) == self.stops[f]:
+                continue
+            ret = calculator(f)(ret, (yield arg))
+        return ret
 
 
 class TernaryOperatorAction(InfixOperatorAction):
+    __slots__ = ()
     # action class for ternary operators used in infixNotation
     def __init__(self, instring='', loc=0, tokens=[]):
         super(TernaryOperatorAction, self).__init__(instring, loc, tokens)
@@ -335,52 +1279,85 @@ class TernaryOperatorAction(InfixOperatorAction):
         self.function = self.tokens[1], self.tokens[3]
         self.args = self.tokens[0], self.tokens[2], self.tokens[4]
 
-    def __repr__(self):
-        return "(%s, %s)(%s)" %(self.function[0], self.function[1], ', '.join(map(str, self.args)))
+    def reprSteps(self):
+        return _text("(%s, %s)(%s)", self.function[0], self.function[1], _joined(', ', (yield from _each(self.args, 'str'))))
 
     def sexpr(self):
         return "((%s, %s) %s)" %(self.function[0], self.function[1], ', '.join(map(str, self.args)))
 
+    # conditional operators => (condition, value if true, value if false) as positions of the operands
+    conditionals = {('if', 'else'): (1, 0, 2), ('?', ':'): (0, 1, 2)}
+
+    def conditional(self):
+        # the positions of the operands of a conditional, None for other operators
+        try:
+            return self.conditionals.get(self.function)
+        except TypeError:
+            return None
+
+    def callees(self):
+        return () if self.conditional() else (self.function,)
+
+    def evalSteps(self, calculator):
+        # only the taken branch of a conditional is evaluated,
+        # the other operators apply their function to the three operands
+        positions = self.conditional()
+        if positions is None:
+            return calculator(self.function, *(yield from _each(self.args, 'eval', calculator)))
+        c, a, b = positions
+        if (yield self.args[c]):
+            return (yield self.args[a])
+        return (yield self.args[b])
+
 
 class LambdaAction(BaseAction):
+    __slots__ = ('args', 'expr', 'lambdaKeyword')
     # action class for lambda expression used in infixNotation
     def __init__(self, instring='', loc=0, tokens=[]):
         super(LambdaAction, self).__init__(instring, loc, tokens)
         self.args, self.expr = tokens.args, tokens.expression
         self.lambdaKeyword='lambda'
 
-    def __repr__(self):
-        return "%s %s: %s"%(self.lambdaKeyword, ', '.join(map(str, self.args)), self.expr)
+    def reprSteps(self):
+        return _text("%s %s: %s", self.lambdaKeyword, ', '.join(map(str, self.args)), (yield self.expr))
 
-    def sexpr(self):
-        return "(%s (%s) %s)"%(self.lambdaKeyword, ' '.join(map(str, self.args)), self.expr.sexpr())
+    def sexprSteps(self):
+        return _text("(%s (%s) %s)", self.lambdaKeyword, ' '.join(map(str, self.args)), (yield self.expr))
 
     def eval(self, calculator):
-        localcalculator = calculator.copy()
+        # each call binds the arguments in a frame over the context of the lambda
+        capture(calculator.context)
         def f(*args):
-            localcalculator.update({arg:v for arg, v in zip(self.args, args)})
-            return self.expr.eval(localcalculator)
+            loc = calculator.enter()
+            try:
+                loc.update({arg:v for arg, v in zip(self.args, args)})
+                return self.expr.eval(loc)
+            finally:
+                calculator.leave(loc)
         return f
 
 
 class IndexAction(BaseAction):
+    __slots__ = ('index', 'variable')
     # action class for index expression
     names = ('index', 'variable')
+    pure = True
 
-    def __repr__(self):
-        return "%s[%s]" %(self.variable, ']['.join(map(str, self.index)))
+    def reprSteps(self):
+        return _text("%s[%s]", (yield self.variable), _joined('][', (yield from _each(self.index, 'str'))))
 
     def sexpr(self):
         return "(%s, %s, %s)" %('get', self.variable, ', '.join(map(str, self.index)))
 
-    def eval(self, calculator):
-        ret = self.variable.eval(calculator)
+    def evalSteps(self, calculator):
+        ret = yield self.variable
         for ind in self.index:
-            ret = ret[int(ind.eval(calculator))]
+            ret = ret[int((yield ind))]
         return ret
 
 
 class SliceExprAction(BaseAction):
+    __slots__ = ()
     # action class for slice expression
     name = ('slice', 'varaible')
 
@@ -401,13 +1378,14 @@ class QuantifierAction(OperatorAction):
     '''action class for quantifiers
     forall x A(x) where quantifier = forall, varaibles = (x,), operand (of the quantifier) = A(x)
     '''
+    __slots__ = ('operand', 'quantifier', 'variables')
     def __init__(self, instring='', loc=0, tokens=[]):
         super(QuantifierAction, self).__init__(instring, loc, tokens)
         self.quantifier, self.variables = self.tokens.quantifier, self.tokens.variables
         self.operand = self.tokens[-1]
 
-    def __repr__(self):
-        return "%s %s (%s)" %(self.quantifier, ', '.join(map(str, self.variables)), self.operand)
+    def reprSteps(self):
+        return _text("%s %s (%s)", self.quantifier, ', '.join(map(str, self.variables)), (yield self.operand))
 
     def sexpr(self):
         return "(%s (%s) %s)" %(self.quantifier, ', '.join(map(tosx, self.variables)), self.operand.sexpr())
@@ -415,16 +1393,23 @@ class QuantifierAction(OperatorAction):
 
 # tuple, set
 class IterableAction(FunctionAction):
+    __slots__ = ()
+    pure = False   # mutable containers are not shared
     def __iter__(self):
         return iter(self.args[:])
 
+    def callees(self):
+        return ()
+
 
 class TupleAction(IterableAction):
+    __slots__ = ()
     # action class for atomic term
     function = 'tuple'
+    pure = True
 
-    def eval(self, calculator):
-        return tuple(arg.eval(calculator) for arg in self.args)
+    def evalSteps(self, calculator):
+        return tuple((yield from _each(self.args, 'eval', calculator)))
 
     def __str__(self):
         if len(self.args)==1:
@@ -439,11 +1424,12 @@ class TupleAction(IterableAction):
             return 'Tuple(%s)' % (', '.join(str(arg.eval(calculator)) for arg in self.args))
 
 class ListAction(IterableAction):
+    __slots__ = ()
     # action class for atomic term
     function = 'list'
 
-    def eval(self, calculator):
-        return list(arg.eval(calculator) for arg in self.args)
+    def evalSteps(self, calculator):
+        return list((yield from _each(self.args, 'eval', calculator)))
 
     def __str__(self):
         return '[%s]' % (', '.join(str(arg.eval(calculator)) for arg in self.args))
@@ -453,11 +1439,12 @@ class ListAction(IterableAction):
 
 
 class SetAction(IterableAction):
+    __slots__ = ()
     # action class for set
     function = 'set'
 
-    def eval(self, calculator):
-        return set(arg.eval(calculator) for arg in self.args)
+    def evalSteps(self, calculator):
+        return set((yield from _each(self.args, 'eval', calculator)))
 
     def __str__(self):
         if len(self.args)==0:
@@ -467,14 +1454,19 @@ class SetAction(IterableAction):
 
 
 class DictAction(IterableAction):
+    __slots__ = ('keys', 'values')
     # action class for set
     def __init__(self, instring='', loc=0, tokens=[]):
         super(SetAction, self).__init__(instring, loc, tokens)
         self.keys = [t.key for t in tokens]
         self.values = [t.value for t in tokens]
 
-    def eval(self, calculator):
-        return {arg.key.eval(calculator):arg.value.eval(calculator) for arg in self.args}
+    def evalSteps(self, calculator):
+        ret = {}
+        for arg in self.args:
+            key = yield arg.key
+            ret[key] = yield arg.value
+        return ret
 
     def __str__(self):
         return '{%s}' % ('%s:%s'% (str(arg.key.eval(calculator)), str(arg.value.eval(calculator))) for arg in self.args)
@@ -483,7 +1475,9 @@ class DictAction(IterableAction):
 # More advanced actions
 # atomic expression
 class AtomAction(BaseAction):
+    __slots__ = ('content',)
     # action class for atomic term
+    pure = True
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
         self.content = tokens[0]
@@ -494,6 +1488,8 @@ class AtomAction(BaseAction):
         else:
             return self.content == other
 
+    __hash__ = BaseAction.__hash__
+
     def __repr__(self):
         return str(self.content)
 
@@ -508,53 +1504,163 @@ class AtomAction(BaseAction):
 
 
 class VariableAction(AtomAction):
+    __slots__ = ()
     # action class for variable
+    def __init__(self, instring='', loc=0, tokens=[]):
+        super().__init__(instring, loc, tokens)
+        if type(self.content) is str:
+            self.content = sys.intern(self.content)
 
     def __hash__(self):
         return hash(self.content)
 
     def eval(self, calculator):
-        if self.content in calculator.context:
+        # calculator[content] if content is in the context, with one lookup in most cases
+        try:
+            value = calculator.context[self.content]
+        except KeyError:
+            raise Exception('%s could not be evaluated!'%self.content) from None
+        if self.content in calculator.dictionary:
             return calculator[self.content]
-        else:
-            raise Exception('%s could not be evaluated!'%self.content)
+        return value
 
 
 class TypeAction(VariableAction):
+    __slots__ = ()
     pass
 
 
 class ConstantAction(AtomAction):
+    __slots__ = ()
     # action class for constant
 
     def eval(self, calculator):
         return calculator.dict_[self.content]
 
+class ValueAction(AtomAction):
+    __slots__ = ()
+    # action class for a value computed in advance, see simplify
+    pass
+
 class NoneAction(AtomAction):
+    __slots__ = ()
     # action class for none (null)
     pass
 
+# numeric tower of a language
+def _intOrFloat(x):
+    # int if x is integral, else float
+    if isinstance(x, str):
+        try:
+            return int(x)
+        except ValueError:
+            x = float(x)
+    elif isinstance(x, int):
+        return x
+    else:
+        x = float(x)
+    return int(x) if x.is_integer() else x
+
+def _fraction(x):
+    # the float tokens are converted by their shortest representation: 0.1 => 1/10
+    return fractions.Fraction(repr(x) if isinstance(x, float) else x)
+
+
+class NumericMode:
+    """Numbers of a language, see StandardCalculator.setNumeric
+
+    Attributes:
+        name {str} -- 'decimal', 'float', 'int-or-float' or 'fraction'
+        number -- literal of a number (str or float token) => value
+        integer -- literal of an integer => value
+    """
+    __slots__ = ('name', 'number', 'integer')
+
+    def __init__(self, name, number, integer=int):
+        self.name = name
+        self.number = number
+        self.integer = integer
+
+    def __repr__(self):
+        return 'NumericMode(%s)' % self.name
+
+    def match(self, dictionary):
+        """The dictionary whose number constants are in the tower of the mode
+
+        It is the dictionary itself if none is changed; functions (and the dicts of functions by arity)
+        are kept, the functions of the operator module work in every tower.
+        """
+        changed = {}
+        for k, v in dictionary.items():
+            if isinstance(v, (int, float, decimal.Decimal, fractions.Fraction)) and not isinstance(v, bool):
+                w = self.number(v)
+                if type(w) is not type(v) or w != v:
+                    changed[k] = w
+        return {**dictionary, **changed} if changed else dictionary
+
+
+numericModes = {
+    'decimal': NumericMode('decimal', decimal.Decimal),
+    'float': NumericMode('float', float, float),
+    'int-or-float': NumericMode('int-or-float', _intOrFloat),
+    'fraction': NumericMode('fraction', _fraction, lambda x: fractions.Fraction(int(x)))
+}
+
+def numericMode(mode):
+    # NumericMode of a name
+    if isinstance(mode, NumericMode):
+        return mode
+    try:
+        return numericModes[mode]
+    except KeyError:
+        raise ValueError('numeric mode should be one of %s, not %r' % (', '.join(numericModes), mode)) from None
+
+_decimalMode = numericModes['decimal']
+
+
 class NumberAction(AtomAction):
+    __slots__ = ('converted',)
     # action class for number
+    # the value of the literal is converted once for the numeric mode of the calculator
 
     def eval(self, calculator):
-        import decimal
-        return decimal.Decimal(self.content)
+        mode = getattr(calculator, 'numeric', _decimalMode)
+        try:
+            m, value = self.converted
+            if m is mode:
+                return value
+        except AttributeError:
+            pass
+        value = mode.number(self.content)
+        self.converted = mode, value
+        return value
 
 
 class IntegerAction(AtomAction):
+    __slots__ = ('converted',)
     # action class for integer
 
     def eval(self, calculator):
-        return int(self.content)
+        mode = getattr(calculator, 'numeric', _decimalMode)
+        try:
+            m, value = self.converted
+            if m is mode:
+                return value
+        except AttributeError:
+            pass
+        value = mode.integer(self.content)
+        self.converted = mode, value
+        return value
 
 
 class BooleAction(IntegerAction):
+    __slots__ = ()
     # action class for boolean value
     pass
 
 
 class StringAction(AtomAction):
+    __slots__ = ()
     # action class for string
 
     def __repr__(self):
@@ -565,6 +1671,7 @@ class StringAction(AtomAction):
 
 
 class LetAction(BaseAction):
+    __slots__ = ('args', 'expr', 'values')
     # action class for let-expression
     letKeyword = 'let'
 
@@ -579,15 +1686,19 @@ class LetAction(BaseAction):
         return "(%s (%s) (%s) %s)" %(self.letKeyword, ' '.join(map(str, self.args)), ' '.join(map(str, self.args)), self.expr.sexpr())
 
     def eval(self, calculator):
-        with calculator as loc:
+        loc = calculator.enter()
+        try:
             loc.update({arg:val for arg, val in zip(self.args, self.values)})
             return self.expr.eval(loc)
+        finally:
+            calculator.leave(loc)
 
 
 # actions for programming
 class CommandAction(BaseAction):
     '''action for command such as assignment
     '''
+    __slots__ = ('args',)
 
     names = ('args',)
 
@@ -611,16 +1722,19 @@ class CommandAction(BaseAction):
 
 
 class ControlAction(CommandAction):
+    __slots__ = ()
     # action for contral flow
     pass
 
 
 class BreakAction(ControlAction):
+    __slots__ = ()
     def execute(self, calculator):
         calculator.control = 'break'
 
 
 class ContinueAction(ControlAction):
+    __slots__ = ()
     def execute(self, calculator):
         calculator.control = 'continue'
 
@@ -635,6 +1749,7 @@ class ReturnAction(ControlAction):
     Extends:
         ControlAction
     '''
+    __slots__ = ('arg',)
     names = ('arg',)
     def execute(self, calculator):
         calculator.control = 'return'
@@ -657,10 +1772,12 @@ class ReturnAction(ControlAction):
         
 
 class PassAction(CommandAction):
+    __slots__ = ()
     pass
 
 
 class PrintAction(CommandAction):
+    __slots__ = ()
 
     def execute(self, calculator):
         for arg in self.args:
@@ -668,6 +1785,7 @@ class PrintAction(CommandAction):
         print()
 
 class DeleteAction(CommandAction):
+    __slots__ = ()
 
     def execute(self, calculator):
         for arg in self.args:
@@ -675,6 +1793,7 @@ class DeleteAction(CommandAction):
 
 
 class EmbedAction(CommandAction):
+    __slots__ = ('code',)
     
     names = ('code',)
 
@@ -706,6 +1825,7 @@ class EmbedAction(CommandAction):
 
 class AssignmentAction(CommandAction):
     '''action for assignment like x = expr:type'''
+    __slots__ = ('arg', 'type', 'variable')
     names = ('args', 'variable', 'type', 'arg')
 
     def execute(self, calculator):
@@ -736,6 +1856,7 @@ class AssignmentAction(CommandAction):
 
 class IfAction(CommandAction):
     '''action for if statement'''
+    __slots__ = ('condition', 'program')
     def __init__(self, instring='', loc=0, tokens=[]):
         super(IfAction, self).__init__(instring, loc, tokens)
         self.condition = tokens.condition
@@ -751,6 +1872,7 @@ class IfAction(CommandAction):
 
 class WhileAction(IfAction):
     '''action for while statement'''
+    __slots__ = ()
 
     def execute(self, calculator):
         ML = calculator.maxloop
@@ -776,6 +1898,7 @@ class WhileAction(IfAction):
 class IfelseAction(CommandAction):
     '''action for if-elif-else statement
     '''
+    __slots__ = ('conditions', 'elseprogram', 'programs')
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
         self.conditions = tokens.conditions[:]
@@ -799,6 +1922,7 @@ class IfelseAction(CommandAction):
 
 
 class ForAction(WhileAction):
+    __slots__ = ()
     def execute(self, calculator):
         ML = calculator.maxloop
         for _ in self.range_.eval(calculator):
@@ -821,13 +1945,40 @@ class ForAction(WhileAction):
         return 'for %s in %s\n{%s}'%(self.loopingVar, self.range_, self.program)
 
 
+def _memoized(f, maxsize=1024):
+    """f with a LRU cache of its values, keyed by the arguments (of the same types)
+
+    Calls with unhashable arguments are not cached.
+    The cache has the methods cache_info (hits, misses, ...) and cache_clear of functools.lru_cache.
+    """
+    cached = functools.lru_cache(maxsize, typed=True)(f)
+    @functools.wraps(f)
+    def g(*args, **kwargs):
+        try:
+            hash((args, tuple(kwargs.values())))
+        except TypeError:
+            return f(*args, **kwargs)
+        return cached(*args, **kwargs)
+    g.cache_info, g.cache_clear = cached.cache_info, cached.cache_clear
+    return g
+
+
 class DefAction(CommandAction):
     '''
     Action for definition of functions
+
+    A function defined with the pragma @memo (or @memo(maxsize)),
+    or registered by StandardCalculator.memoize, caches its values (LRU cache, see _memoized).
     '''
+    __slots__ = ('function', 'parameters', 'program', 'memo')
     names = ('program',)
+    memoSize = 1024   # maxsize of the cache of @memo
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
+        if 'memo' in self:
+            self.memo = tokens.maxsize if 'maxsize' in self else self.memoSize
+        else:
+            self.memo = None
 
         if 'function' in self:
             self.function = tokens.function.content
@@ -842,8 +1993,15 @@ class DefAction(CommandAction):
 
 
     def execute(self, calculator):
-        with calculator as loc:
-            def f(*args, **kwargs):
+        calculator.update({self.function: self.makeFunction(calculator, self.program.execute)})
+
+    def makeFunction(self, calculator, body):
+        # the function defined in calculator, body(loc) runs the program in the local calculator,
+        # a frame over the context of the definition for each call
+        capture(calculator.context)
+        def f(*args, **kwargs):
+            loc = calculator.enter()
+            try:
                 loc.update({param.name:param.default.eval(calculator) for param in self.parameters if 'default' in param})
                 for k, p_v in enumerate(zip(self.parameters, args)):
                     p, v = p_v
@@ -860,9 +2018,18 @@ class DefAction(CommandAction):
                 if self.parameters[-1].kind == '**':
                     loc[self.parameters[-1].name] = c
                 loc.update(kwargs)
-                self.program.execute(loc)
+                body(loc)
                 return loc.retval
-        calculator.update({self.function:f})
+            finally:
+                calculator.leave(loc)
+        maxsize = self.memo
+        if maxsize is None and getattr(calculator, 'memoized', None):
+            maxsize = calculator.memoized.get(self.function)
+        if maxsize is not None:
+            f = _memoized(f, maxsize)
+        # to make the function again for another calculator, see StandardCalculator.threadCopy
+        f.definition = self, calculator, body
+        return f
 
 
     def __repr__(self):
@@ -884,6 +2051,7 @@ class DefAction(CommandAction):
 
 
 class ParameterAction(BaseAction):
+    __slots__ = ('default', 'kind', 'name')
 
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
@@ -913,6 +2081,7 @@ class ProgramSequenceAction(CommandAction):
     '''action for a sequence of programs:
     program; program; program...
     '''
+    __slots__ = ('program',)
     def __init__(self, instring='', loc=0, tokens=[]):
         super().__init__(instring, loc, tokens)
         self.program = tokens[:]
@@ -929,3 +2098,25 @@ class ProgramSequenceAction(CommandAction):
     def __str__(self):
         return ';\n'.join(map(str, self.program))
 
+
+class ModuleAction(CommandAction):
+    '''action for a program with load statements:
+    load path
+    program
+    '''
+    __slots__ = ('loading', 'program')
+    def __init__(self, instring='', loc=0, tokens=[]):
+        super().__init__(instring, loc, tokens)
+        self.loading = [path.strip() for path in tokens.get('loading', ())]
+        self.program = tokens[-1]
+
+    def execute(self, calculator):
+        # the modules in `loading` are run by the language
+        return self.program.execute(calculator)
+
+    def __repr__(self):
+        return 'MODULE{%s%r}' % (''.join('load %s\n' % path for path in self.loading), self.program)
+
+    def __str__(self):
+        return ''.join('load %s\n' % path for path in self.loading) + str(self.program)
+
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Evaluation of a tree over columns of NumPy arrays
+
+evalBatch(action, calculator, columns) gives the array of the values of action
+for the rows of the columns, the same as evaluating it for each row with
+the variables bound to the items of the columns:
+
+    numpy.array([action.eval(<calculator with x = columns['x'][i], ...>) for i in range(n)])
+
+The operators, comparisons and functions apply to whole columns when their functions
+are elementwise (the functions of the operator module, abs, and the functions of math
+mapped to ufuncs); other functions, and the actions without a vectorized evaluation,
+are applied row by row. A vectorized call failing (a domain error of a ufunc,
+an error of a function applied to arrays) is done again row by row, so the error is
+the one of the scalar evaluation. The operands evaluated lazily (and, or, comparison chains,
+conditionals) are evaluated only for the rows where they are needed.
+
+NumPy is required only by this module. The literals should have the numeric mode
+'float' or 'int-or-float' (see StandardCalculator.setNumeric): Decimal does not mix with
+float columns, in the scalar evaluation as well.
+'''
+
+import math
+import operator
+
+from pyparsing_ext.actions import *
+from pyparsing_ext.compiler import _lookup
+
+
+_ufuncs = {}
+
+def ufuncs():
+    # elementwise function => (ufunc, whether floating point errors are errors)
+    if not _ufuncs:
+        import numpy as np
+        _ufuncs.update({
+            operator.add: (np.add, False), operator.sub: (np.subtract, False),
+            operator.mul: (np.multiply, False), operator.truediv: (np.true_divide, False),
+            operator.floordiv: (np.floor_divide, False), operator.mod: (np.remainder, False),
+            operator.pow: (np.power, False), operator.neg: (np.negative, False), operator.pos: (np.positive, False),
+            operator.abs: (np.absolute, False), abs: (np.absolute, False),
+            operator.eq: (np.equal, False), operator.ne: (np.not_equal, False),
+            operator.lt: (np.less, False), operator.le: (np.less_equal, False),
+            operator.gt: (np.greater, False), operator.ge: (np.greater_equal, False),
+            operator.and_: (np.bitwise_and, False), operator.or_: (np.bitwise_or, False),
+            operator.xor: (np.bitwise_xor, False), operator.invert: (np.invert, False),
+            # math raises ValueError or OverflowError where the ufuncs give nan or inf
+            math.sqrt: (np.sqrt, True), math.exp: (np.exp, True), math.log10: (np.log10, True),
+            math.log2: (np.log2, True), math.sin: (np.sin, True), math.cos: (np.cos, True),
+            math.tan: (np.tan, True), math.asin: (np.arcsin, True), math.acos: (np.arccos, True),
+            math.atan: (np.arctan, True), math.atan2: (np.arctan2, True), math.sinh: (np.sinh, True),
+            math.cosh: (np.cosh, True), math.tanh: (np.tanh, True), math.fabs: (np.fabs, True),
+            math.hypot: (np.hypot, True)
+        })
+        # math.log has an optional base
+        _ufuncs[math.log] = lambda x: np.log(x), True
+    return _ufuncs
+
+
+def stack(values, n):
+    # array of the values of n rows, one-dimensional even if the values are sequences
+    import numpy as np
+    ret = np.array(values)
+    if ret.shape != (n,):
+        ret = np.empty(n, dtype=object)
+        ret[:] = values if values else []
+    return ret
+
+
+class BatchEvaluator(Visitor):
+    '''Values of the nodes of a tree over the rows of columns
+
+    The value of a node is (True, array of the values of the rows), or (False, value of every row).
+
+    Attributes:
+        calculator -- gives the dictionary and the context
+        columns {dict} -- name => 1-dimensional array of n items
+        n {int} -- number of rows
+    '''
+
+    def __init__(self, calculator, columns, n):
+        self.calculator = calculator
+        self.columns = columns
+        self.n = n
+
+    def rows(self, f):
+        # the values of f(loc) for each row, loc: calculator with the variables of the row
+        calculator = self.calculator
+        loc = calculator.enter()
+        try:
+            values = []
+            for i in range(self.n):
+                loc.context.update({name: column[i] for name, column in self.columns.items()})
+                values.append(f(loc))
+        finally:
+            calculator.leave(loc)
+        return True, stack(values, self.n)
+
+    def sub(self, rows):
+        # evaluator of the rows (array of indices)
+        return BatchEvaluator(self.calculator, {name: column[rows] for name, column in self.columns.items()}, len(rows))
+
+    def restricted(self, node, rows):
+        # the value of node over the rows (array of indices)
+        if len(rows) == self.n:
+            return self.visit(node)
+        return self.sub(rows).visit(node)
+
+    def apply(self, f, *args):
+        # f applied to the values args
+        import numpy as np
+        if not any(isColumn for isColumn, _ in args):
+            return False, f(*(value for _, value in args))
+        values = [value for _, value in args]
+        try:
+            g, strict = ufuncs()[f]
+        except (KeyError, TypeError):
+            g = None
+        if g is not None:
+            try:
+                if strict:
+                    with np.errstate(all='raise'):
+                        ret = g(*values)
+                else:
+                    ret = g(*values)
+                if isinstance(ret, np.ndarray) and ret.shape == (self.n,):
+                    return True, ret
+            except Exception:
+                pass
+        # row by row
+        items = [(isColumn, value) for isColumn, value in args]
+        return True, stack([f(*(value[i] if isColumn else value for isColumn, value in items)) for i in range(self.n)], self.n)
+
+    def truth(self, value):
+        # boolean array of the truth of the rows
+        import numpy as np
+        isColumn, v = value
+        if not isColumn:
+            return np.full(self.n, bool(v))
+        if v.dtype == object:
+            return np.fromiter(map(bool, v), dtype=bool, count=self.n)
+        return v.astype(bool)
+
+    def merge(self, ret, rows, value):
+        # ret with the rows (array of indices) replaced by value (over those rows)
+        import numpy as np
+        others = np.setdiff1d(np.arange(self.n), rows, assume_unique=True)
+        return self.assemble([(others, (True, ret[1][others]) if ret[0] else ret), (rows, value)])
+
+    def assemble(self, parts):
+        # column of the values over the rows of the parts (rows, value), the rows of all parts are all the rows
+        import numpy as np
+        parts = [(rows, value) for rows, value in parts if len(rows)]
+        arrays = [v if isColumn else np.asarray(v) for _, (isColumn, v) in parts]
+        if all(a.dtype.kind in 'biufc' and a.ndim == (1 if isColumn else 0) for a, (_, (isColumn, _)) in zip(arrays, parts)):
+            # the dtype np.array gives to the values of the rows
+            out = np.empty(self.n, dtype=np.result_type(*arrays) if arrays else float)
+            for a, (rows, _) in zip(arrays, parts):
+                out[rows] = a
+            return True, out
+        values = [None] * self.n
+        for rows, (isColumn, v) in parts:
+            for k, i in enumerate(rows):
+                values[i] = v[k] if isColumn else v
+        return True, stack(values, self.n)
+
+    def function(self, t, arity):
+        return _lookup(self.calculator, self.calculator.context, t, arity)
+
+    def generic_visit(self, node):
+        # row by row
+        return self.rows(node.eval)
+
+    def visit_AtomAction(self, node):
+        return False, node.eval(self.calculator)
+
+    def visit_VariableAction(self, node):
+        name = node.content
+        if name in self.columns and name not in self.calculator.dictionary:
+            return True, self.columns[name]
+        if name in self.columns:
+            # the dictionary first, as VariableAction.eval
+            return False, self.calculator[name]
+        return False, node.eval(self.calculator)
+
+    def visit_FunctionAction(self, node):
+        if type(node).evalSteps is not FunctionAction.evalSteps or node.function in self.columns or \
+            any(isinstance(arg, (UnpackAction, KWUnpackAction, KWAction)) for arg in node.args):
+            return self.rows(node.eval)
+        args = []
+        for arg in node.args:
+            args.append((yield arg))
+        if not args:
+            return False, self.calculator(node.function)
+        return self.apply(self.function(node.function, len(args)), *args)
+
+    def visit_UnaryOperatorAction(self, node):
+        if type(node).evalSteps is not UnaryOperatorAction.evalSteps or node.function in self.columns:
+            return self.rows(node.eval)
+        return self.apply(self.function(node.function, 1), (yield node.operand))
+
+    def visit_BinaryOperatorAction(self, node):
+        cls = type(node)
+        if cls.evalSteps not in (BinaryOperatorAction.evalSteps, RightBinaryOperatorAction.evalSteps) or \
+            any(f in self.columns for f in node.callees()):
+            return self.rows(node.eval)
+        args = []
+        for arg in node.args:
+            args.append((yield arg))
+        functions = node.function if node.ishybrid else [node.function] * (len(args)-1)
+        fs = [self.function(f, 0) for f in functions]
+        if cls.evalSteps is RightBinaryOperatorAction.evalSteps:
+            ret = self.apply(fs[-1], args[-2], args[-1])
+            for f, arg in zip(fs[-2::-1], args[-3::-1]):
+                ret = self.apply(f, arg, ret)
+        else:
+            ret = self.apply(fs[0], args[0], args[1])
+            for f, arg in zip(fs[1:], args[2:]):
+                ret = self.apply(f, ret, arg)
+        return ret
+
+    def visit_CompareAction(self, node):
+        import numpy as np
+        if type(node).evalSteps is not CompareAction.evalSteps or any(f in self.columns for f in node.callees()):
+            return self.rows(node.eval)
+        functions = node.function if node.ishybrid else [node.function] * (len(node.args)-1)
+        left = yield node.args[0]
+        right = yield node.args[1]
+        ret = self.truth(self.apply(self.function(functions[0], 0), left, right))
+        rows = np.arange(self.n)
+        for f, arg in zip(functions[1:], node.args[2:]):
+            # the next operand is evaluated for the rows still true,
+            # right is the value of the former operand over `rows`
+            keep = ret[rows]
+            if not keep.any():
+                break
+            rows = rows[keep]
+            sub = self.sub(rows)
+            left = (True, right[1][keep]) if right[0] else right
+            right = self.restricted(arg, rows)
+            ret[rows] = sub.truth(sub.apply(self.function(f, 0), left, right))
+        return True, ret
+
+    def visit_LogicalOperatorAction(self, node):
+        import numpy as np
+        if type(node).evalSteps is not LogicalOperatorAction.evalSteps or any(f in self.columns for f in node.callees()):
+            return self.rows(node.eval)
+        functions = node.function if node.ishybrid else [node.function] * (len(node.args)-1)
+        ret = yield node.args[0]
+        for f, arg in zip(functions, node.args[1:]):
+            # the operand is evaluated for the rows not decided by the former value
+            stop = node.stops.get(f)
+            rows = np.arange(self.n) if stop is None else np.flatnonzero(self.truth(ret) != stop)
+            if not len(rows):
+                continue
+            sub = self.sub(rows)
+            left = (True, ret[1][rows]) if ret[0] else ret
+            ret = self.merge(ret, rows, sub.apply(self.function(f, 0), left, self.restricted(arg, rows)))
+        return ret
+
+    def visit_TernaryOperatorAction(self, node):
+        import numpy as np
+        positions = node.conditional()
+        if type(node).evalSteps is not TernaryOperatorAction.evalSteps or positions is None:
+            return self.rows(node.eval)
+        c, a, b = (node.args[k] for k in positions)
+        mask = self.truth((yield c))
+        if mask.all():
+            return (yield a)
+        elif not mask.any():
+            return (yield b)
+        rows, others = np.flatnonzero(mask), np.flatnonzero(~mask)
+        return self.assemble([(rows, self.restricted(a, rows)), (others, self.restricted(b, others))])
+
+
+def evalBatch(action, calculator, columns):
+    '''Evaluate action for each row of the columns
+
+    Example:
+        language.setNumeric('float')
+        evalBatch(language.parse('x^2 + 2*x*y'), language.calculator, {'x': xs, 'y': ys})
+
+    Arguments:
+        action {BaseAction} -- tree of expression actions
+        calculator {StandardCalculator} -- gives the dictionary and the other variables
+        columns {dict} -- name of a variable => sequence of its values, all of the same length
+
+    Returns:
+        numpy.ndarray -- the values of the rows
+
+    Raises:
+        ValueError -- the columns have different lengths
+    '''
+    import numpy as np
+    columns = {name: np.asarray(column) for name, column in columns.items()}
+    lengths = {len(column) for column in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError('the columns should have the same length, not %s' % sorted(lengths))
+    n = lengths.pop() if lengths else 1
+    isColumn, value = BatchEvaluator(calculator, columns, n).visit(action)
+    return value if isColumn else stack([value] * n, n)
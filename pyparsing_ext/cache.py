@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''On-disk cache of parsed source files, like __pycache__
+
+An entry is the tree parsed from a file, in the binary format of serialize.
+It is keyed by the hash of the source, the fingerprint of the grammar and
+the versions of pyparsing_ext, pyparsing and the format,
+so a change of any of them is a miss, never a stale tree.
+
+grammarFingerprint: hash of the structure of a grammar
+ParseCache: load the trees in place of parsing, store, invalidate and clean up
+MemoryCache: LRU cache in memory of the results of parsing strings
+'''
+
+import collections
+import hashlib
+import inspect
+import os
+import pathlib
+import tempfile
+import threading
+import types
+
+import pyparsing as pp
+
+from pyparsing_ext.actions import BaseAction, compactActions
+from pyparsing_ext.serialize import FORMAT_VERSION, ASTWriter, loadAST
+from pyparsing_ext.utils import _children
+
+
+CACHE_DIRECTORY = '__ppxcache__'
+SUFFIX = '.ppxa'
+
+# attributes changed by streamline, str or parsing, not part of the grammar
+_VOLATILE = {'strRepr', 'streamlined', 'mayReturnEmpty', 'mayIndexError', 'errmsg', 'name', 're', 're_match', '_ppx_facts'}
+
+def _name(f):
+    return '%s.%s' % (getattr(f, '__module__', ''), getattr(f, '__qualname__', None) or getattr(f, '__name__', type(f).__name__))
+
+
+class _Unstable(Exception):
+    # a callable of the grammar has no stable text
+    pass
+
+def _unwrapped(f):
+    # the function given to setParseAction, behind the wrapper made by pyparsing (_trim_arity)
+    code = getattr(f, '__code__', None)
+    if getattr(f, '__module__', None) == pp.__name__ and code is not None and code.co_name == 'wrapper' and 'func' in code.co_freevars:
+        return f.__closure__[code.co_freevars.index('func')].cell_contents
+    return f
+
+def _code(code):
+    # stable text of a code object: its bytecode, constants and names
+    consts = [_code(c) if isinstance(c, types.CodeType) else repr(c) for c in code.co_consts]
+    return '%s:%s:%s' % (code.co_code.hex(), consts, list(code.co_names))
+
+def _callable(f, seen=frozenset()):
+    '''stable text of a callable: the qualified name of a class or of a module-level function,
+    with the code and the closure of a lambda or a local function;
+    raise _Unstable for the other callables (bound methods, partials, callable objects)
+    or for closures over values without a stable text'''
+    f = _unwrapped(f)
+    if isinstance(f, (type, types.BuiltinFunctionType)):
+        return _name(f)
+    if not isinstance(f, types.FunctionType) or id(f) in seen:
+        raise _Unstable(f)
+    if '<' not in f.__qualname__ and not f.__closure__:
+        return _name(f)
+    cells = []
+    for cell in f.__closure__ or ():
+        try:
+            v = cell.cell_contents
+        except ValueError:
+            v = None
+        text = _callable(v, seen | {id(f)}) if callable(v) and not isinstance(v, pp.ParserElement) else _attr(v)
+        if text is None:
+            raise _Unstable(v)
+        cells.append(text)
+    return '%s(%s)%s' % (_name(f), _code(f.__code__), cells)
+
+def _attr(v):
+    # stable text of an attribute of a ParserElement, None to leave it out
+    if v is None or isinstance(v, (str, bytes, int, float)):
+        return repr(v)
+    elif isinstance(v, (set, frozenset)):
+        return repr(sorted(map(repr, v)))
+    elif isinstance(v, tuple) and all(isinstance(x, (str, int)) for x in v):
+        return repr(v)
+    elif callable(v) and not isinstance(v, pp.ParserElement):
+        return _callable(v)
+
+
+def grammarFingerprint(pe):
+    '''Hash of the structure of the grammar pe
+
+    It covers the types and the attributes of the elements, their order,
+    the parse actions and the ignored expressions,
+    so a grammar built by the same code has the same fingerprint in every process.
+    A parse action is covered by its qualified name, and by its code and its closure
+    if it is a lambda or a local function.
+
+    Returns:
+        str -- hex digest, None if a callable has no stable text (see _callable): do not cache
+    '''
+    pe.streamline()
+    # number the elements in depth-first order
+    elements, numbers = [], {}
+    stack = [pe]
+    while stack:
+        x = stack.pop()
+        if id(x) in numbers:
+            continue
+        numbers[id(x)] = len(elements)
+        elements.append(x)
+        stack.extend(reversed(list(_children(x)) + list(x.ignoreExprs)))
+    h = hashlib.sha256()
+    try:
+        for x in elements:
+            h.update(type(x).__qualname__.encode())
+            for k, v in sorted(vars(x).items()):
+                if k not in _VOLATILE:
+                    text = _attr(v)
+                    if text is not None:
+                        h.update(('|%s=%s' % (k, text)).encode('utf-8', 'backslashreplace'))
+            for f in x.parseAction:
+                h.update(('|action=%s' % _callable(f)).encode('utf-8', 'backslashreplace'))
+            h.update(('|children=%s|ignore=%s;' % ([numbers[id(e)] for e in _children(x)],
+                [numbers[id(e)] for e in x.ignoreExprs])).encode())
+    except _Unstable:
+        return None
+    return h.hexdigest()
+
+
+class ParseCache:
+    '''On-disk cache of the trees parsed from source files
+
+    The entries of a file `dir/name.ext` are `dir/__ppxcache__/name.ext.<grammar>.<key>.ppxa`
+    (or in `directory` if it is given); storing a new entry removes the older ones
+    of the same file, grammar and mode (compact or not). A hit refreshes the mtime of the entry,
+    so `cleanup` removes the least recently used entries first.
+
+    Example:
+        parser.cache = ParseCache(maxsize=2**26)
+        parser.parseFile('script.spy')   # parsed and stored
+        parser.parseFile('script.spy')   # loaded
+    '''
+
+    def __init__(self, directory=None, maxsize=None, lazy=False):
+        """
+        Keyword Arguments:
+            directory {str} -- directory of all the entries, None for __ppxcache__ beside each source (default: {None})
+            maxsize {int} -- bound of the total size in bytes of a directory, checked after a store (default: {None})
+            lazy {bool} -- load the trees with LazyAction nodes (default: {False})
+        """
+        self.directory = directory
+        self.maxsize = maxsize
+        self.lazy = lazy
+        self.hits = self.misses = 0
+        self.directories = set()   # directories used so far
+
+    def key(self, source, fingerprint, compact=False):
+        # hex digest of everything the tree depends on
+        import pyparsing_ext
+        h = hashlib.sha256()
+        h.update(('%s|%s|%d|%s|%d|' % (pyparsing_ext.__version__, pp.__version__, FORMAT_VERSION, fingerprint, compact)).encode())
+        h.update(source.encode('utf-8', 'surrogatepass'))
+        return h.hexdigest()
+
+    def folder(self, filename):
+        if self.directory is None:
+            return pathlib.Path(filename).resolve().parent / CACHE_DIRECTORY
+        return pathlib.Path(self.directory)
+
+    def stem(self, filename):
+        # prefix of the names of the entries of filename
+        path = pathlib.Path(filename).resolve()
+        if self.directory is None:
+            return path.name
+        # files of different directories share the cache directory
+        return '%s-%s' % (path.name, hashlib.sha256(str(path.parent).encode('utf-8', 'surrogatepass')).hexdigest()[:8])
+
+    @staticmethod
+    def tag(fingerprint, compact=False):
+        # part of the names of the entries for the grammar and the mode
+        return fingerprint[:16] + ('-compact' if compact else '')
+
+    def path(self, filename, fingerprint, key, compact=False):
+        return self.folder(filename) / ('%s.%s.%s%s' % (self.stem(filename), self.tag(fingerprint, compact), key[:32], SUFFIX))
+
+    def load(self, filename, source, fingerprint, compact=False, lazy=None):
+        """The tree stored for the source of filename, or None
+
+        Unreadable entries (truncated, written by another version, missing classes) are removed.
+        """
+        path = self.path(filename, fingerprint, self.key(source, fingerprint, compact), compact)
+        try:
+            with open(path, 'rb') as fo, compactActions(compact):
+                tree = loadAST(fo, self.lazy if lazy is None else lazy, instring='' if compact else source)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError, EOFError, IndexError, ImportError, AttributeError):
+            self.misses += 1
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return tree
+
+    def store(self, filename, source, fingerprint, tree, compact=False):
+        """Store the tree parsed from the source of filename
+
+        Returns:
+            pathlib.Path -- the entry, None if the tree could not be written
+        """
+        folder = self.folder(filename)
+        path = self.path(filename, fingerprint, self.key(source, fingerprint, compact), compact)
+        try:
+            folder.mkdir(parents=True, exist_ok=True)
+            # write to a temporary file, then rename: readers never see a partial entry
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=str(folder))
+            try:
+                with os.fdopen(fd, 'wb') as fo:
+                    writer = ASTWriter(fo)
+                    writer.write(tree)
+                    writer.flush()
+                os.replace(tmp, path)
+            except BaseException:
+                self._remove(tmp)
+                raise
+        except (OSError, TypeError):
+            return None
+        for old in self.entriesOf(filename, self.tag(fingerprint, compact)):
+            if old != path:
+                self._remove(old)
+        self.directories.add(folder)
+        if self.maxsize is not None:
+            self.cleanup(folder)
+        return path
+
+    def parseFile(self, parser, filename, *args, **kwargs):
+        """Parse a file with parser (see BaseParser.parse for the arguments), through the cache
+
+        Only the results that are action objects are stored,
+        and nothing is cached for a grammar without a fingerprint (see grammarFingerprint).
+        """
+        with open(filename, 'r') as fo:
+            source = fo.read()
+        options = inspect.signature(parser.parse).bind(source, *args, **kwargs).arguments
+        compact, lazy = bool(options.get('compact', False)), options.get('lazy', False)
+        fingerprint = parser.fingerprint
+        if fingerprint is None:
+            return parser.parse(source, *args, **kwargs)
+        tree = self.load(filename, source, fingerprint, compact, lazy or self.lazy)
+        if tree is None:
+            tree = parser.parse(source, *args, **kwargs)
+            if isinstance(tree, BaseAction):
+                self.store(filename, source, fingerprint, tree, compact)
+        return tree
+
+    def entries(self, directory=None):
+        # the entries in a directory, or in the directories used so far
+        folders = [pathlib.Path(directory)] if directory is not None else sorted(self.directories)
+        for folder in folders:
+            if folder.is_dir():
+                yield from (path for path in folder.iterdir() if path.name.endswith(SUFFIX))
+
+    def entriesOf(self, filename, tag=None):
+        # the entries of filename, of any grammar or of the grammar and the mode of tag
+        stem = self.stem(filename)
+        for path in self.entries(self.folder(filename)):
+            parts = path.name[:-len(SUFFIX)].rsplit('.', 2)
+            if len(parts) == 3 and parts[0] == stem and (tag is None or parts[1] == tag):
+                yield path
+
+    def invalidate(self, filename=None):
+        """Remove the entries of filename, or all the entries of the directories used so far
+
+        Returns:
+            int -- number of removed entries
+        """
+        if filename is None:
+            paths = list(self.entries())
+        else:
+            paths = list(self.entriesOf(filename))
+        return sum(self._remove(path) for path in paths)
+
+    def cleanup(self, directory=None, maxsize=None):
+        """Remove the least recently used entries until the total size is at most maxsize
+
+        Keyword Arguments:
+            directory {str} -- directory to clean up, None for the directories used so far (default: {None})
+            maxsize {int} -- bound in bytes, None for `self.maxsize` (default: {None})
+
+        Returns:
+            int -- number of removed entries
+        """
+        maxsize = self.maxsize if maxsize is None else maxsize
+        if maxsize is None:
+            return 0
+        folders = [directory] if directory is not None else sorted(self.directories)
+        removed = 0
+        for folder in folders:
+            stats = []
+            for path in self.entries(folder):
+                try:
+                    stats.append((path.stat(), path))
+                except OSError:
+                    pass
+            total = sum(st.st_size for st, _ in stats)
+            for st, path in sorted(stats, key=lambda x: x[0].st_mtime):
+                if total <= maxsize:
+                    break
+                total -= st.st_size
+                removed += self._remove(path)
+        return removed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+
+class MemoryCache:
+    '''LRU cache in memory of the results of parsing strings (trees, and whether they match)
+
+    The keys are the source, the fingerprint of the grammar and the options changing
+    the result (lazy, compact, intern). The trees are shared by the hits:
+    they should not be changed, as the trees with interned nodes.
+    Parsing errors are not cached, nor the results None of the parsers reporting their errors.
+
+    Example:
+        language.cache = MemoryCache(maxsize=1024)
+        language.eval('x^2 + 1')   # parsed
+        language.eval('x^2 + 1')   # found
+        language.cache.hits, language.cache.misses
+    '''
+
+    def __init__(self, maxsize=1024):
+        """
+        Keyword Arguments:
+            maxsize {int} -- maximum number of results, None for unbounded (default: {1024})
+        """
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        # the value of key, compute() on a miss; None (a failure) is not stored
+        with self.lock:
+            try:
+                value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+        value = compute()
+        if value is None:
+            return value
+        with self.lock:
+            self.entries[key] = value
+            if self.maxsize is not None:
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        return value
+
+    @staticmethod
+    def grammarKey(parser):
+        # the fingerprint of the grammar, or the grammar itself if it has none
+        return parser.fingerprint or parser.grammar
+
+    def parse(self, parser, s, *args, **kwargs):
+        """Parse s with parser (see BaseParser.parse for the arguments), through the cache
+
+        The results are not cached when `intern` is an Interner shared with former parsings.
+        """
+        options = inspect.signature(parser.parse).bind(s, *args, **kwargs).arguments
+        intern = options.get('intern', False)
+        if not isinstance(intern, bool):
+            return parser.parse(s, *args, **kwargs)
+        key = self.grammarKey(parser), 'parse', s, bool(options.get('lazy', False)), bool(options.get('compact', False)), intern
+        return self.get(key, lambda: parser.parse(s, *args, **kwargs))
+
+    def matches(self, parser, s, *args, **kwargs):
+        # parser.matches(s) through the cache
+        options = inspect.signature(parser.matches).bind(s, *args, **kwargs).arguments
+        key = self.grammarKey(parser), 'matches', s, bool(options.get('doActions', True))
+        return self.get(key, lambda: parser.matches(s, *args, **kwargs))
+
+    def info(self):
+        # hits, misses, maxsize, currsize, as functools.lru_cache
+        return _CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getstate__(self):
+        # the entries and the lock are not pickled
+        return {'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state['maxsize'])
+
+
+_CacheInfo = collections.namedtuple('CacheInfo', ('hits', 'misses', 'maxsize', 'currsize'))
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Compile trees of expression actions to Python closures
+
+compileAction(action, calculator) returns a function of a context (the values of the variables);
+calling it gives the value of `action.eval` with a calculator having that context,
+without walking the tree. The names of the dictionary of the calculator are constants
+(StandardCalculator does not assign them), so the operators, functions and constants
+found there are resolved once, at compile time; the other names are looked up in the context.
+
+The nodes of classes without a compiler, or overriding the evaluation of a class having one,
+are evaluated by their own `eval` with a copy of the calculator.
+'''
+
+import copy
+import functools
+import sys
+
+from pyparsing_ext.actions import *
+from pyparsing_ext.frames import Frame
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _lookup(calculator, context, t, arity):
+    # what StandardCalculator.__call__ applies to the arguments: a function, or the value if arity == 0
+    dictionary = calculator.dictionary
+    if t in context:
+        v = context[t]
+        if arity and isinstance(v, dict):
+            if arity in v:
+                return v[arity]
+            raise Exception('Notice the arity!')
+        return v
+    elif t in dictionary:
+        v = dictionary[t]
+        if isinstance(v, dict):
+            if arity == 0:
+                return v[2]
+            if arity in v:
+                return v[arity]
+            raise Exception('notice the arity!')
+        return v
+    elif getattr(calculator, 'useBuiltins', False):
+        return eval(t)() if arity == 0 else eval(t)
+    raise NameError('Did not find %s' % t)
+
+
+def _resolved(calculator, t, arity):
+    # (True, function) if t is resolved at compile time
+    if t in calculator.dictionary and t not in calculator.context:
+        try:
+            return True, _lookup(calculator, {}, t, arity)
+        except Exception:
+            pass
+    return False, None
+
+def _function(calculator, t, arity):
+    # function of the context giving the function (or the value) of t for arity
+    ok, value = _resolved(calculator, t, arity)
+    if ok:
+        return lambda context: value
+    return lambda context: _lookup(calculator, context, t, arity)
+
+
+def _fallback(action, calculator):
+    # evaluate action by its own method, with the context in a copy of the calculator
+    def f(context):
+        c = copy.copy(calculator)
+        c.context = context
+        return action.eval(c)
+    return f
+
+
+def _atom(action, calculator, sub):
+    value = action.content
+    return lambda context: value
+
+def _literal(action, calculator, sub):
+    # the literal converted for the numeric mode of the calculator
+    value = action.eval(calculator)
+    return lambda context: value
+
+def _variable(action, calculator, sub):
+    name = action.content
+    dictionary = calculator.dictionary
+    def f(context):
+        if name in context:
+            # calculator[name]: the dictionary first
+            return dictionary[name] if name in dictionary else context[name]
+        raise Exception('%s could not be evaluated!' % name)
+    return f
+
+def _apply(f, args):
+    # function of the context applying the function of the context f to the arguments
+    n = len(args)
+    if n == 1:
+        a, = args
+        return lambda context: f(context)(a(context))
+    elif n == 2:
+        a, b = args
+        return lambda context: f(context)(a(context), b(context))
+    return lambda context: f(context)(*[arg(context) for arg in args])
+
+def _call(fn, args):
+    # the same for a function resolved at compile time
+    n = len(args)
+    if n == 0:
+        return lambda context: fn()
+    elif n == 1:
+        a, = args
+        return lambda context: fn(a(context))
+    elif n == 2:
+        a, b = args
+        return lambda context: fn(a(context), b(context))
+    elif n == 3:
+        a, b, c = args
+        return lambda context: fn(a(context), b(context), c(context))
+    return lambda context: fn(*[arg(context) for arg in args])
+
+def _functionCall(action, calculator, sub):
+    if any(isinstance(arg, (UnpackAction, KWUnpackAction, KWAction)) for arg in action.args):
+        return None
+    args = [sub(arg) for arg in action.args]
+    t = action.function
+    if not args:
+        # calculator(t): the value of t
+        return _function(calculator, t, 0)
+    ok, fn = _resolved(calculator, t, len(args))
+    if ok:
+        return _call(fn, args)
+    return _apply(_function(calculator, t, len(args)), args)
+
+def _unary(action, calculator, sub):
+    a = sub(action.operand)
+    ok, fn = _resolved(calculator, action.function, 1)
+    if ok:
+        return lambda context: fn(a(context))
+    f = _function(calculator, action.function, 1)
+    return lambda context: f(context)(a(context))
+
+def _binary(action, calculator, sub):
+    args = [sub(arg) for arg in action.args]
+    if action.ishybrid:
+        fs = [_function(calculator, t, 0) for t in action.function]
+        f0 = fs[0]
+        def f(context):
+            values = [arg(context) for arg in args]
+            ret = f0(context)(values[0], values[1])
+            for k, g in enumerate(fs[1:], 2):
+                ret = g(context)(ret, values[k])
+            return ret
+        return f
+    ok, fn = _resolved(calculator, action.function, 0)
+    if ok and len(args) == 2:
+        a, b = args
+        return lambda context: fn(a(context), b(context))
+    elif ok:
+        return lambda context: functools.reduce(fn, [arg(context) for arg in args])
+    g = _function(calculator, action.function, 0)
+    return lambda context: functools.reduce(g(context), [arg(context) for arg in args])
+
+def _rightBinary(action, calculator, sub):
+    args = [sub(arg) for arg in action.args]
+    if action.ishybrid:
+        fs = [_function(calculator, t, 0) for t in action.function]
+        def f(context):
+            values = [arg(context) for arg in args]
+            ret = fs[-1](context)(values[-2], values[-1])
+            for g, value in zip(fs[-2::-1], values[-3::-1]):
+                ret = g(context)(value, ret)
+            return ret
+        return f
+    ok, fn = _resolved(calculator, action.function, 0)
+    if ok and len(args) == 2:
+        a, b = args
+        return lambda context: fn(a(context), b(context))
+    g = _function(calculator, action.function, 0)
+    def f(context):
+        values = [arg(context) for arg in args]
+        h = fn if ok else g(context)
+        ret = h(values[-2], values[-1])
+        for value in values[-3::-1]:
+            ret = h(value, ret)
+        return ret
+    return f
+
+def _compare(action, calculator, sub):
+    args = [sub(arg) for arg in action.args]
+    functions = action.function if action.ishybrid else [action.function] * (len(args) - 1)
+    fs = [_function(calculator, t, 0) for t in functions]
+    if len(args) == 2:
+        a, b = args
+        ok, fn = _resolved(calculator, functions[0], 0)
+        if ok:
+            return lambda context: bool(fn(a(context), b(context)))
+    rest = list(zip(fs, args[1:]))
+    def f(context):
+        # the operands are evaluated on demand, as CompareAction.eval does
+        left = args[0](context)
+        for g, arg in rest:
+            right = arg(context)
+            if not g(context)(left, right):
+                return False
+            left = right
+        return True
+    return f
+
+def _logical(action, calculator, sub):
+    args = [sub(arg) for arg in action.args]
+    functions = action.function if action.ishybrid else [action.function] * (len(args) - 1)
+    stops = action.stops
+    rest = [(_function(calculator, t, 0), stops.get(t), arg) for t, arg in zip(functions, args[1:])]
+    def f(context):
+        # an operand deciding the next operator is its value, see LogicalOperatorAction
+        ret = args[0](context)
+        for g, stop, arg in rest:
+            if stop is not None and bool(ret) == stop:
+                continue
+            ret = g(context)(ret, arg(context))
+        return ret
+    return f
+
+def _ternary(action, calculator, sub):
+    positions = action.conditional()
+    if positions is None:
+        return None
+    c, a, b = (sub(action.args[k]) for k in positions)
+    return lambda context: a(context) if c(context) else b(context)
+
+def _container(kind):
+    def compiler(action, calculator, sub):
+        args = [sub(arg) for arg in action.args]
+        return lambda context: kind([arg(context) for arg in args])
+    return compiler
+
+def _index(action, calculator, sub):
+    variable = sub(action.variable)
+    indexes = [sub(ind) for ind in action.index]
+    def f(context):
+        ret = variable(context)
+        for ind in indexes:
+            ret = ret[int(ind(context))]
+        return ret
+    return f
+
+
+# action class => compiler(action, calculator, sub), sub giving the functions of the subtrees
+compilers = {
+    AtomAction: _atom,
+    NumberAction: _literal,
+    IntegerAction: _literal,
+    VariableAction: _variable,
+    FunctionAction: _functionCall,
+    UnaryOperatorAction: _unary,
+    BinaryOperatorAction: _binary,
+    RightBinaryOperatorAction: _rightBinary,
+    CompareAction: _compare,
+    LogicalOperatorAction: _logical,
+    TernaryOperatorAction: _ternary,
+    TupleAction: _container(tuple),
+    ListAction: _container(list),
+    SetAction: _container(set),
+    IndexAction: _index
+}
+
+def _compiler(cls):
+    # the compiler of cls, None if it evaluates in its own way
+    for c in cls.__mro__:
+        if c in compilers:
+            return compilers[c]
+        if 'eval' in c.__dict__ or 'evalSteps' in c.__dict__:
+            return None
+
+
+def compileAction(action, calculator, dynamic=()):
+    '''Compile the tree of action to a function of a context
+
+    Example:
+        f = compileAction(language.parse('x^2 + 2*x + 1'), language.calculator)
+        f({'x': 3})  # == the value of the expression with x = 3
+
+    Arguments:
+        action {BaseAction} -- tree of expression actions
+        calculator {StandardCalculator} -- gives the dictionary; its context is the default one
+
+    Keyword Arguments:
+        dynamic {iterable} -- names looked up at run time, even if they are in the dictionary,
+                              such as the names a program assigns (default: {()})
+
+    Returns:
+        function -- context {dict} => value
+    '''
+    if type(action) is LazyAction:
+        action = action.force()
+    default = calculator
+    if dynamic:
+        # the names in the context are not resolved at compile time
+        calculator = copy.copy(calculator)
+        calculator.context = dict.fromkeys(dynamic, None)
+        context = default.context
+        calculator.context.update(context.flatten() if isinstance(context, Frame) else context)
+    done = {}
+    depth = {}
+    def sub(x):
+        if type(x) is LazyAction:
+            x = x.force()
+        if not isinstance(x, BaseAction):
+            raise _Unsupported(x)
+        return done[id(x)]
+    for node in walk(action, 'post', unique=True):
+        depth[id(node)] = 1 + max((depth[id(c)] for c in node.children()), default=0)
+        compiler = _compiler(type(node))
+        try:
+            f = compiler and compiler(node, calculator, sub)
+        except _Unsupported:
+            f = None
+        done[id(node)] = f or _fallback(node, calculator)
+    if depth[id(action)] > sys.getrecursionlimit() // 4:
+        # the closures would nest too deeply, eval runs without recursion
+        f = _fallback(action, calculator)
+    else:
+        f = done[id(action)]
+    def run(context=None):
+        return f(default.context if context is None else context)
+    run.action = action
+    return run
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Frames of local variables for the calls of functions, lambdas and let-expressions
+
+A Frame holds the local variables and looks up the other names in its parent
+(the context where the function was defined), so entering a call costs
+the number of its parameters, not the size of the global context.
+The frames are taken from a pool and given back when the call returns,
+unless a function or a lambda made in the call keeps them (see capture).
+'''
+
+import threading
+
+
+class Frame(dict):
+    '''Local variables with a parent mapping
+
+    Lookups go up the chain of parents, writes and deletions stay local;
+    len, iteration and items only see the local variables.
+    '''
+
+    __slots__ = ('parent', 'captured')
+
+    def __init__(self, local=(), parent=None):
+        super().__init__(local)
+        self.parent = {} if parent is None else parent
+        self.captured = False
+
+    def __missing__(self, key):
+        return self.parent[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.parent
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def copy(self):
+        # the new frame shares the parents, they are not recycled any more
+        capture(self.parent)
+        return Frame(self, self.parent)
+
+    def flatten(self):
+        # dict of all the visible names
+        parent = self.parent
+        ret = parent.flatten() if isinstance(parent, Frame) else dict(parent)
+        ret.update(self)
+        return ret
+
+    def __repr__(self):
+        return 'Frame(%s, parent=%s)' % (dict.__repr__(self), type(self.parent).__name__)
+
+
+def capture(context):
+    # mark the frames of the chain of context as kept by a closure
+    while isinstance(context, Frame) and not context.captured:
+        context.captured = True
+        context = context.parent
+
+
+class FramePool:
+    '''Free frames to reuse, a list of them for each thread
+
+    A frame released by a thread is only reused by that thread,
+    so the threads (and the languages in threaded mode) share a pool but not its frames.
+    '''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.local = threading.local()
+
+    @property
+    def free(self):
+        # the free frames of the current thread
+        try:
+            return self.local.free
+        except AttributeError:
+            self.local.free = free = []
+            return free
+
+    def acquire(self, parent):
+        try:
+            frame = self.free.pop()
+        except IndexError:
+            return Frame(parent=parent)
+        frame.parent = parent
+        return frame
+
+    def release(self, frame):
+        # frames kept by closures are left to the garbage collector
+        if frame.captured or len(self.free) >= self.maxsize:
+            return
+        frame.clear()
+        frame.parent = None
+        self.free.append(frame)
+
+    def __len__(self):
+        return len(self.free)
+
+
+framePool = FramePool()
@@ -15,8 +15,8 @@ setOplist = [('&', 2, pp.opAssoc.LEFT, BinaryOperatorAction),
 
 # logic:
 boolOplist = [(pp.Keyword('not'), 1, pp.opAssoc.RIGHT, UnaryOperatorAction),
-    (pp.Keyword('and'), 2, pp.opAssoc.LEFT, BinaryOperatorAction),
-    (pp.Keyword('or'), 2, pp.opAssoc.LEFT, BinaryOperatorAction)]
+    (pp.Keyword('and'), 2, pp.opAssoc.LEFT, LogicalOperatorAction),
+    (pp.Keyword('or'), 2, pp.opAssoc.LEFT, LogicalOperatorAction)]
 
 logicOplist = boolOplist
 
@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Optimization of grammars
+
+compileRegex: replace regular sub-grammars with single regular expressions
+'''
+
+import re
+import itertools
+
+import pyparsing as pp
+
+from pyparsing_ext.parsers import _Enhance
+from pyparsing_ext.utils import analyze, _children
+
+
+# compile regular sub-grammars to regular expressions
+_optionalNotMatched = pp.Optional._Optional__optionalNotMatched
+
+_FLAGS = ((re.I, 'i'), (re.M, 'm'), (re.S, 's'), (re.X, 'x'), (re.A, 'a'))
+
+class _Unsupported(Exception):
+    pass
+
+
+def _charset(chars):
+    return ''.join(re.escape(c) for c in sorted(chars))
+
+
+class _Node:
+    # the part of a compiled pattern that a ParserElement matches
+    # group: name of the group spanning the match (after whitespace)
+
+    def __init__(self, pe, group, children=()):
+        self.pe = pe
+        self.group = group
+        self.children = children
+        self.patterns = None   # (first, next) of repetitions
+
+    def build(self, m, instring, doActions=True):
+        # rebuild the tokens as pe._parse would do
+        pe = self.pe
+        start, end = m.span(self.group)
+        tokens = self.parseImpl(m, instring, start, end, doActions)
+        tokens = pe.postParse(instring, end, tokens)
+        retTokens = pp.ParseResults(tokens, pe.resultsName, asList=pe.saveAsList, modal=pe.modalResults)
+        if pe.parseAction and (doActions or pe.callDuringTry):
+            for fn in pe.parseAction:
+                try:
+                    tokens = fn(instring, start, retTokens)
+                except IndexError as parse_action_exc:
+                    exc = pp.ParseException("exception raised in parse action")
+                    exc.__cause__ = parse_action_exc
+                    raise exc
+                if tokens is not None and tokens is not retTokens:
+                    retTokens = pp.ParseResults(tokens, pe.resultsName,
+                        asList=pe.saveAsList and isinstance(tokens, (pp.ParseResults, list)),
+                        modal=pe.modalResults)
+        return retTokens
+
+    def parseImpl(self, m, instring, start, end, doActions):
+        pe = self.pe
+        if isinstance(pe, (pp.Literal, pp.Keyword)):
+            return pe.match
+        elif isinstance(pe, pp.Regex):
+            if pe.re.groupindex:
+                result = pe.re_match(instring, start)
+                ret = pp.ParseResults(result.group())
+                for k, v in result.groupdict().items():
+                    ret[k] = v
+                return ret
+            return pp.ParseResults(instring[start:end])
+        elif isinstance(pe, pp.Token):
+            return instring[start:end]
+        elif isinstance(pe, pp.And):
+            first, *others = self.children
+            tokens = first.build(m, instring, doActions)
+            for child in others:
+                tmptokens = child.build(m, instring, doActions)
+                if tmptokens or tmptokens.haskeys():
+                    tokens += tmptokens
+            return tokens
+        elif isinstance(pe, pp.MatchFirst):
+            for child in self.children:
+                if m.start(child.group) != -1:
+                    return child.build(m, instring, doActions)
+        elif isinstance(pe, pp.Optional):
+            child, = self.children
+            if m.start(child.group) != -1:
+                return child.build(m, instring, doActions)
+            if pe.defaultValue is not _optionalNotMatched:
+                if pe.expr.resultsName:
+                    tokens = pp.ParseResults([pe.defaultValue])
+                    tokens[pe.expr.resultsName] = pe.defaultValue
+                else:
+                    tokens = [pe.defaultValue]
+                return tokens
+            return []
+        elif isinstance(pe, (pp.OneOrMore, pp.ZeroOrMore)):
+            if start == end:
+                return []
+            (first, firstNode), (next_, nextNode) = self.patterns
+            r = first.match(instring, start)
+            tokens = firstNode.build(r, instring, doActions)
+            loc = r.end()
+            while loc < end:
+                r = next_.match(instring, loc)
+                tmptokens = nextNode.build(r, instring, doActions)
+                if tmptokens or tmptokens.haskeys():
+                    tokens += tmptokens
+                loc = r.end()
+            return tokens
+        else:
+            # Group, Suppress, Combine and Forward
+            return self.children[0].build(m, instring, doActions)
+
+
+class _Emitter:
+    # translate a ParserElement to a regular expression
+    # every match is made atomic by (?=(?P<g>X))(?P=g), the PEG behaviour of pyparsing
+
+    def __init__(self):
+        self.names = itertools.count()
+
+    def group(self):
+        return '_ppx%d' % next(self.names)
+
+    def atomic(self, pattern, group=None):
+        group = group or self.group()
+        return '(?=(?P<%s>%s))(?P=%s)' % (group, pattern, group), group
+
+    def whitespace(self, pe, callPreParse):
+        if pe.ignoreExprs:
+            raise _Unsupported('ignorable expressions')
+        if callPreParse and pe.callPreparse and pe.skipWhitespace and pe.whiteChars:
+            return self.atomic('[%s]*' % _charset(pe.whiteChars))[0]
+        return ''
+
+    def emit(self, pe, callPreParse=True):
+        # -> pattern, _Node
+        if pe.debug or pe.failAction:
+            raise _Unsupported('debugging or fail action')
+        ws = self.whitespace(pe, callPreParse)
+        if isinstance(pe, pp.Token):
+            pattern, group = self.atomic(self.token(pe))
+            return ws + pattern, _Node(pe, group)
+        elif isinstance(pe, pp.And):
+            if any(isinstance(e, pp.And._ErrorStop) for e in pe.exprs):
+                raise _Unsupported('error stop (-)')
+            parts = [self.emit(e, k > 0) for k, e in enumerate(pe.exprs)]
+            group = self.group()
+            pattern = '(?P<%s>%s)' % (group, ''.join(p for p, _ in parts))
+        elif isinstance(pe, pp.MatchFirst):
+            parts = [self.emit(e) for e in pe.exprs]
+            pattern, group = self.atomic('|'.join(p for p, _ in parts))
+        elif isinstance(pe, pp.Optional):
+            parts = [self.emit(pe.expr, False)]
+            pattern, group = self.atomic('(?:%s)?' % parts[0][0])
+        elif isinstance(pe, (pp.OneOrMore, pp.ZeroOrMore)):
+            if pe.not_ender is not None:
+                raise _Unsupported('repetition with stopOn')
+            if analyze(pe.expr).nullable:
+                raise _Unsupported('repetition of a nullable expression')
+            first, firstNode = self.emit(pe.expr, False)
+            next_, nextNode = self.emit(pe.expr)
+            body = '%s(?:%s)*' % (first, next_)
+            if isinstance(pe, pp.ZeroOrMore):
+                body = '(?:%s)?' % body
+            pattern, group = self.atomic(body)
+            node = _Node(pe, group)
+            try:
+                node.patterns = (re.compile(first), firstNode), (re.compile(next_), nextNode)
+            except re.error as ex:
+                raise _Unsupported('regular expression: %s' % ex)
+            return ws + pattern, node
+        elif isinstance(pe, (pp.Group, pp.Suppress, pp.Combine, pp.Forward)):
+            if pe.expr is None:
+                raise _Unsupported('undefined Forward')
+            parts = [self.emit(pe.expr, False)]
+            group = self.group()
+            pattern = '(?P<%s>%s)' % (group, parts[0][0])
+        else:
+            raise _Unsupported('%s is not supported' % type(pe).__name__)
+        return ws + pattern, _Node(pe, group, [node for _, node in parts])
+
+    def token(self, pe):
+        if type(pe) in (pp.Literal, pp._SingleCharLiteral):
+            return re.escape(pe.match)
+        elif type(pe) is pp.Keyword:
+            if pe.caseless:
+                raise _Unsupported('caseless Keyword')
+            ident = _charset(pe.identChars)
+            return '(?<![%s])%s(?![%s])' % (ident, re.escape(pe.match), ident)
+        elif isinstance(pe, pp._WordRegex):
+            return pe.reString
+        elif type(pe) is pp.Word:
+            body = _charset(pe.bodyChars)
+            if pe.maxLen == pp._MAX_INT:
+                pattern = '[%s][%s]{%d,}' % (_charset(pe.initChars), body, pe.minLen - 1)
+            else:
+                pattern = '[%s][%s]{%d,%d}' % (_charset(pe.initChars), body, pe.minLen - 1, pe.maxLen - 1)
+            if pe.maxSpecified or pe.asKeyword:
+                pattern += '(?![%s])' % body
+            if pe.asKeyword:
+                pattern = '(?<![%s])' % body + pattern
+            return pattern
+        elif type(pe) is pp.Regex:
+            if pe.asGroupList or pe.asMatch:
+                raise _Unsupported('Regex returning groups or match objects')
+            if re.search(r'\\[1-9]|\(\?P=|\(\?\(', pe.pattern):
+                raise _Unsupported('Regex with backreferences')
+            flags = pe.re.flags & ~re.U
+            letters = ''
+            for flag, letter in _FLAGS:
+                if flags & flag:
+                    letters += letter
+                    flags &= ~flag
+            if flags:
+                raise _Unsupported('Regex flags %d' % flags)
+            # names are dropped, since groupdict is rebuilt by the Regex itself
+            pattern = re.sub(r'(?<!\\)\(\?P<\w+>', '(', pe.pattern)
+            return '(?%s:%s)' % (letters, pattern) if letters else '(?:%s)' % pattern
+        raise _Unsupported('%s is not supported' % type(pe).__name__)
+
+
+class RegexExpression(pp.Token):
+    '''ParserElement matching a regular sub-grammar with one regular expression
+
+    It reproduces the tokens, the named results and the parse actions of the original expression,
+    assuming that the parse actions do not reject matches.'''
+
+    def __init__(self, expr):
+        super(RegexExpression, self).__init__()
+        self.expr = expr
+        if analyze(expr).recursive:
+            raise _Unsupported('recursive expression')
+        self.reString, self.node = _Emitter().emit(expr, False)
+        try:
+            self.re = re.compile(self.reString)
+        except re.error as ex:
+            raise _Unsupported('regular expression: %s' % ex)
+        self.re_match = self.re.match
+        self.name = pp._ustr(expr)
+        self.errmsg = "Expected " + self.name
+        self.mayReturnEmpty = expr.mayReturnEmpty
+        self.mayIndexError = False
+        self.skipWhitespace = expr.skipWhitespace
+        self.whiteChars = set(expr.whiteChars)
+        self.copyDefaultWhiteChars = False
+        self.callPreparse = expr.callPreparse
+
+    def parseImpl(self, instring, loc, doActions=True):
+        m = self.re_match(instring, loc)
+        if m is None:
+            raise pp.ParseException(instring, loc, self.errmsg, self)
+        return m.end(), self.node.build(m, instring, doActions)
+
+    def __str__(self):
+        return self.name
+
+
+class CompileReport:
+    '''Report of compileRegex
+
+    converted: list of (expression, pattern)
+    skipped: list of (expression, reason)'''
+
+    def __init__(self):
+        self.converted = []
+        self.skipped = []
+
+    def __str__(self):
+        lines = ['converted %d, skipped %d' % (len(self.converted), len(self.skipped))]
+        lines.extend('+ %s' % pe for pe, _ in self.converted)
+        lines.extend('- %s: %s' % (pe, reason) for pe, reason in self.skipped)
+        return '\n'.join(lines)
+
+
+def _size(pe):
+    # number of elements in the sub-grammar
+    seen = set()
+    stack = [pe]
+    while stack:
+        x = stack.pop()
+        if id(x) not in seen:
+            seen.add(id(x))
+            stack.extend(_children(x))
+    return len(seen)
+
+
+def compileRegex(pe, minsize=3):
+    '''Replace the maximal regular sub-grammars of pe with RegexExpression
+
+    The sub-grammars are replaced in place (in their parents);
+    sub-grammars with less than minsize elements are left alone.
+
+    Arguments:
+        pe {ParserElement} -- grammar
+
+    Returns:
+        tuple -- the compiled grammar and a CompileReport
+
+    Example:
+        >>> pe, report = compileRegex(DECIMAL)
+        >>> print(report)
+    '''
+
+    report = CompileReport()
+    compiled = {}
+
+    def compile_(x):
+        if id(x) not in compiled:
+            compiled[id(x)] = None
+            if isinstance(x, pp.Token) or _size(x) < minsize:
+                return None
+            try:
+                compiled[id(x)] = RegexExpression(x)
+                report.converted.append((x, compiled[id(x)].reString))
+            except _Unsupported as ex:
+                report.skipped.append((x, str(ex)))
+        return compiled[id(x)]
+
+    root = compile_(pe)
+    if root is not None:
+        return root, report
+    visited = set()
+    stack = [pe]
+    while stack:
+        x = stack.pop()
+        if id(x) in visited:
+            continue
+        visited.add(id(x))
+        if isinstance(x, pp.ParseExpression):
+            for k, e in enumerate(x.exprs):
+                r = compile_(e)
+                if r is None:
+                    stack.append(e)
+                else:
+                    x.exprs[k] = r
+        elif isinstance(x, _Enhance) and x.expr is not None:
+            r = compile_(x.expr)
+            if r is None:
+                stack.append(x.expr)
+            else:
+                x.expr = r
+    return pe, report
+
+
+# profile-guided reordering of alternatives
+def _elements(pe):
+    # elements of a grammar in depth-first order,
+    # the alternatives of MatchFirst in their order before AlternativeProfile.apply
+    pe.streamline()
+    found, visited = [], set()
+    stack = [pe]
+    while stack:
+        x = stack.pop()
+        if id(x) in visited:
+            continue
+        visited.add(id(x))
+        found.append(x)
+        if isinstance(x, pp.MatchFirst):
+            stack.extend(reversed(_originalExprs(x)))
+        else:
+            stack.extend(reversed(_children(x)))
+    return found
+
+def _matchFirsts(pe):
+    # MatchFirst expressions of a grammar in depth-first order
+    return [x for x in _elements(pe) if isinstance(x, pp.MatchFirst)]
+
+def _originalOrder(mf):
+    # the original positions of the alternatives of a MatchFirst, in their current order
+    order = getattr(mf, '_ppx_order', None)
+    if order is None or len(order) != len(mf.exprs):
+        return list(range(len(mf.exprs)))
+    return order
+
+def _originalExprs(mf):
+    # the alternatives of a MatchFirst in their order before AlternativeProfile.apply
+    exprs = [None] * len(mf.exprs)
+    for e, j in zip(mf.exprs, _originalOrder(mf)):
+        exprs[j] = e
+    return exprs
+
+
+def _skips(pe):
+    # (chars surely skipped, chars maybe skipped, ignorables) before pe in a sequence;
+    # None if it can not be decided
+    if not pe.callPreparse:
+        if isinstance(pe, (pp.MatchFirst, pp.Or)) and pe.exprs:
+            skips = [_skips(e) for e in pe.exprs]
+            if None in skips or len({i for _, _, i in skips}) > 1:
+                return None
+            return (frozenset.intersection(*(a for a, _, _ in skips)),
+                frozenset.union(*(b for _, b, _ in skips)), skips[0][2])
+        elif isinstance(pe, _Enhance) and pe.expr is not None:
+            return _skips(pe.expr)
+        return None
+    white = frozenset(pe.whiteChars) if pe.skipWhitespace else frozenset()
+    ignores = frozenset(map(id, pe.ignoreExprs))
+    visited = set()
+    stack = [pe]
+    while stack:
+        x = stack.pop()
+        if id(x) in visited:
+            continue
+        visited.add(id(x))
+        if x.skipWhitespace and not set(x.whiteChars) <= white or not set(map(id, x.ignoreExprs)) <= ignores:
+            return None
+        stack.extend(_children(x))
+    return white, white, ignores
+
+
+def _head(pe):
+    # -> first token, [elements after it]
+    rest = []
+    while True:
+        if isinstance(pe, pp.Token):
+            return pe, rest
+        elif isinstance(pe, pp.And) and pe.exprs:
+            rest[:0] = pe.exprs[1:]
+            pe = pe.exprs[0]
+        elif isinstance(pe, pp.MatchFirst) and len(pe.exprs) == 1:
+            pe = pe.exprs[0]
+        elif isinstance(pe, (pp.Group, pp.Suppress, pp.Forward)) and pe.expr is not None:
+            pe = pe.expr
+        else:
+            return None, rest
+
+
+def _sameEnd(a, b):
+    # whether tokens a and b end at the same place whenever both match at the same place
+    if a is b:
+        return True
+    if isinstance(a, pp.Word):
+        a, b = b, a
+    if type(a) in (pp.Literal, pp._SingleCharLiteral, pp.Keyword) and type(b) is type(a):
+        return a.match == b.match and not getattr(a, 'caseless', False)
+    if type(a) is pp.Keyword and isinstance(b, pp.Word) and not a.caseless:
+        return (b.maxLen == pp._MAX_INT and a.match[0] in b.initChars and set(a.match[1:]) <= b.bodyChars
+            and b.bodyChars <= set(a.identChars))
+    return False
+
+
+def _sequenceFirst(exprs):
+    # (skips, first) of a sequence; None if it is nullable or unknown
+    skips, first = None, frozenset()
+    for e in exprs:
+        facts = analyze(e)
+        key = _skips(e)
+        if facts.first is None or key is None or skips is not None and not key[0] == key[1] == skips[1]:
+            return None
+        skips, first = skips or key, first | facts.first
+        if not facts.nullable:
+            return skips, first
+    return None
+
+
+def _apart(a, b):
+    # whether sequences with (skips, first) a and b can not both match at the same place
+    (mina, maxa, ia), fa = a
+    (minb, maxb, ib), fb = b
+    return ia == ib and not ((fa | maxa) & (fb | maxb)) - (mina & minb)
+
+
+def _disjoint(a, b):
+    # whether ParserElements a and b could never both match at the same place
+    sa, sb = _sequenceFirst([a]), _sequenceFirst([b])
+    if sa is None or sb is None:
+        return False
+    if _apart(sa, sb):
+        return True
+    if not sa[0] == sb[0] or sa[0][0] != sa[0][1]:
+        return False
+    fa, fb = analyze(a), analyze(b)
+    if fa.keywords is not None and fb.keywords is not None and all(
+        not (x.startswith(y) or y.startswith(x)) for x in fa.keywords for y in fb.keywords):
+        return True
+    (ha, ra), (hb, rb) = _head(a), _head(b)
+    if ha is not None and hb is not None and _sameEnd(ha, hb):
+        ra, rb = _sequenceFirst(ra), _sequenceFirst(rb)
+        return ra is not None and rb is not None and _apart(ra, rb)
+    return False
+
+
+def _safeOrder(exprs, counts):
+    # most frequent first, keeping the relative order of overlapping alternatives
+    n = len(exprs)
+    before = [{i for i in range(j) if not _disjoint(exprs[i], exprs[j])} for j in range(n)]
+    order = []
+    while len(order) < n:
+        ready = [j for j in range(n) if j not in order and before[j] <= set(order)]
+        order.append(min(ready, key=lambda j: (-counts[j], j)))
+    return order
+
+
+class AlternativeProfile:
+    '''Counts of the winning alternatives of the MatchFirst expressions in a grammar
+
+    counts: {ordinal of MatchFirst: [count of each alternative]}
+    The ordinals follow the depth-first order of the streamlined grammar,
+    so a profile applies to any grammar built by the same code.
+    The ordinals and the positions of the alternatives are those before `apply`
+    (it records the order it gives), so a reordered grammar could be profiled and reordered again.
+
+    Example:
+        >>> profile = profileAlternatives(grammar, corpus)
+        >>> profile.save('grammar.profile')
+        >>> AlternativeProfile.load('grammar.profile').apply(newGrammar)
+    '''
+
+    def __init__(self, counts=None):
+        self.counts = counts or {}
+
+    def record(self, pe, corpus, parseAll=False):
+        # parse the strings in corpus and count the winners
+        mfs = _matchFirsts(pe)
+        for k, mf in enumerate(mfs):
+            self.counts.setdefault(k, [0] * len(mf.exprs))
+            mf.parseImpl = self._counter(mf, self.counts[k], _originalOrder(mf))
+        try:
+            for s in corpus:
+                try:
+                    pe.parseString(s, parseAll=parseAll)
+                except pp.ParseBaseException:
+                    pass
+        finally:
+            for mf in mfs:
+                del mf.parseImpl
+        return self
+
+    @staticmethod
+    def _counter(mf, counts, positions):
+        # positions: the original positions of the alternatives
+        parseImpl = mf.parseImpl
+        def _parseImpl(instring, loc, doActions=True):
+            for k, e in zip(positions, mf.exprs):
+                try:
+                    ret = e._parse(instring, loc, doActions)
+                except (pp.ParseException, IndexError):
+                    continue
+                counts[k] += 1
+                return ret
+            return parseImpl(instring, loc, doActions)
+        return _parseImpl
+
+    def orders(self, pe):
+        # {ordinal: safe order of the original positions of the alternatives}, for the MatchFirst changed
+        orders = {}
+        for k, mf in enumerate(_matchFirsts(pe)):
+            counts = self.counts.get(k)
+            if counts and len(counts) == len(mf.exprs) and any(counts):
+                order = _safeOrder(_originalExprs(mf), counts)
+                if order != _originalOrder(mf):
+                    orders[k] = order
+        return orders
+
+    def apply(self, pe):
+        '''Reorder the alternatives of pe in place
+
+        Returns:
+            int -- number of reordered MatchFirst expressions
+        '''
+        mfs = _matchFirsts(pe)
+        orders = self.orders(pe)
+        for k, order in orders.items():
+            mf = mfs[k]
+            exprs = _originalExprs(mf)
+            mf.exprs[:] = [exprs[j] for j in order]
+            mf._ppx_order = order
+        if orders:
+            # the text of the expressions containing the reordered ones
+            for x in _elements(pe):
+                if _children(x):
+                    x.strRepr = None
+        return len(orders)
+
+    def save(self, filename):
+        import json
+        with open(filename, 'w') as fo:
+            json.dump({str(k): v for k, v in self.counts.items()}, fo)
+
+    @classmethod
+    def load(cls, filename):
+        import json
+        with open(filename) as fo:
+            return cls({int(k): v for k, v in json.load(fo).items()})
+
+
+def profileAlternatives(pe, corpus, parseAll=False):
+    '''Count the winning alternatives of the MatchFirst expressions of pe over corpus
+
+    Arguments:
+        pe {ParserElement} -- grammar
+        corpus {iterable} -- sample strings
+
+    Returns:
+        AlternativeProfile
+    '''
+    return AlternativeProfile().record(pe, corpus, parseAll)
@@ -3,6 +3,9 @@
 
 import sys
 import re
+import time
+import threading
+import collections
 
 import pyparsing as pp
 
@@ -23,6 +26,31 @@ _Exception = pp.ParseException
 _Token = pp.Token
 
 
+def recognize(pe, s, parseAll=True):
+    """Whether ParserElement pe matches string s, as pe.matches does,
+    but without calling the parse actions (except those set with callDuringTry)
+
+    It is only a wrapper of pe._parse(doActions=False): pyparsing has no switch for the token
+    lists, so the ParseResults are still built and thrown away. It saves the action objects,
+    not the parse; to check a growing source, see ProgrammingParser.continuation.
+    """
+    pp.ParserElement.resetCache()
+    if not pe.streamlined:
+        pe.streamline()
+    for e in pe.ignoreExprs:
+        e.streamline()
+    if not pe.keepTabs:
+        s = s.expandtabs()
+    try:
+        loc, _ = pe._parse(s, 0, doActions=False)
+        if parseAll:
+            loc = pe.preParse(s, loc)
+            (pp.Empty() + pp.StringEnd())._parse(s, loc, doActions=False)
+    except pp.ParseBaseException:
+        return False
+    return True
+
+
 # def scanFile(pe, file, *args, **kwargs):
 #     """Execute the parse expression on the given file or filename.
 #        If a filename is specified (instead of a file object),
@@ -506,3 +534,127 @@ class LinenStart(pp._PositionToken):
             return loc, []
         raise ParseException(instring, loc, self.errmsg, self)
 
+
+
+# parsing with deadline and budget
+class ParseBudgetExceeded(Exception):
+    """Raised when parsing runs out of time or of attempts
+
+    loc: the furthest location reached
+    attempts: number of element attempts
+    elapsed: seconds spent
+    hotspots: [(ParserElement, attempts)] of the elements tried most often
+    """
+    def __init__(self, reason, loc, attempts, elapsed, hotspots):
+        self.reason = reason
+        self.loc = loc
+        self.attempts = attempts
+        self.elapsed = elapsed
+        self.hotspots = hotspots
+        names = ', '.join('%.40s (%d)' % (pe, n) for pe, n in hotspots[:3])
+        super(ParseBudgetExceeded, self).__init__('%s: reached location %d after %d attempts in %.3fs; tried most: %s'
+            % (reason, loc, attempts, elapsed, names))
+
+
+_budgets = threading.local()
+_budgetLock = threading.Lock()
+_budgetUsers = [0, None]   # number of active budgets, original ParserElement._parse
+
+def _parseWithBudget(self, instring, loc, doActions=True, callPreParse=True):
+    budget = getattr(_budgets, 'current', None)
+    if budget is not None:
+        budget.attempt(self, loc)
+    return _budgetUsers[1](self, instring, loc, doActions, callPreParse)
+
+def _parseCacheWithBudget(self, instring, loc, doActions=True, callPreParse=True):
+    # ParserElement._parseCache counting the misses, without adding a frame to the deep recursion
+    lookup = (self, instring, loc, callPreParse, doActions)
+    with pp.ParserElement.packrat_cache_lock:
+        cache = pp.ParserElement.packrat_cache
+        value = cache.get(lookup)
+        if value is cache.not_in_cache:
+            pp.ParserElement.packrat_cache_stats[1] += 1
+            budget = getattr(_budgets, 'current', None)
+            if budget is not None:
+                budget.attempt(self, loc)
+            try:
+                value = self._parseNoCache(instring, loc, doActions, callPreParse)
+            except pp.ParseBaseException as pe:
+                cache.set(lookup, pe.__class__(*pe.args))
+                raise
+            else:
+                cache.set(lookup, (value[0], value[1].copy()))
+                return value
+        else:
+            pp.ParserElement.packrat_cache_stats[0] += 1
+            if isinstance(value, Exception):
+                raise value
+            return value[0], value[1].copy()
+
+
+class ParseBudget:
+    """Bound the parsing in the current thread by a deadline and/or a number of element attempts
+
+    Example:
+        with ParseBudget(timeout=0.5, maxAttempts=100000):
+            pe.parseString(s)
+
+    With packrat enabled only the attempts missing the cache are counted.
+    ParseBudgetExceeded is raised when a limit is exceeded;
+    it is not a ParseBaseException, so no alternative can swallow it.
+    """
+
+    def __init__(self, timeout=None, maxAttempts=None, checkEvery=256):
+        """
+        Keyword Arguments:
+            timeout {number} -- wall-clock seconds (default: {None})
+            maxAttempts {int} -- maximum number of element attempts (default: {None})
+            checkEvery {int} -- attempts between two readings of the clock (default: {256})
+        """
+        self.timeout = timeout
+        self.maxAttempts = maxAttempts
+        self.checkEvery = checkEvery
+
+    @property
+    def active(self):
+        return self.timeout is not None or self.maxAttempts is not None
+
+    def __enter__(self):
+        if self.active:
+            self.attempts = 0
+            self.loc = 0
+            self.counter = collections.Counter()
+            self.start = time.perf_counter()
+            self.deadline = None if self.timeout is None else self.start + self.timeout
+            self.outer = getattr(_budgets, 'current', None)
+            with _budgetLock:
+                if _budgetUsers[0] == 0:
+                    _budgetUsers[1] = pp.ParserElement._parse
+                    if _budgetUsers[1] is pp.ParserElement._parseCache:
+                        pp.ParserElement._parse = _parseCacheWithBudget
+                    else:
+                        pp.ParserElement._parse = _parseWithBudget
+                _budgetUsers[0] += 1
+            _budgets.current = self
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        if self.active:
+            _budgets.current = self.outer
+            with _budgetLock:
+                _budgetUsers[0] -= 1
+                if _budgetUsers[0] == 0 and pp.ParserElement._parse in (_parseWithBudget, _parseCacheWithBudget):
+                    pp.ParserElement._parse = _budgetUsers[1]
+
+    def attempt(self, pe, loc):
+        self.attempts += 1
+        self.counter[pe] += 1
+        if loc > self.loc:
+            self.loc = loc
+        if self.maxAttempts is not None and self.attempts > self.maxAttempts:
+            self.exceed('too many attempts')
+        if self.deadline is not None and self.attempts % self.checkEvery == 0 and time.perf_counter() > self.deadline:
+            self.exceed('deadline exceeded')
+
+    def exceed(self, reason):
+        raise ParseBudgetExceeded(reason, self.loc, self.attempts, time.perf_counter() - self.start, self.counter.most_common(10))
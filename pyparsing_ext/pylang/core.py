@@ -10,6 +10,12 @@ Author: William
 
 import operator
 import copy
+import concurrent.futures
+import multiprocessing
+import os
+import pickle
+import threading
+import contextlib
 
 import pyparsing as pp
 
@@ -18,6 +24,24 @@ from pyparsing_ext import *
 class Memory(dict):
     pass
 
+
+# functions without side effects, see BaseCalculator.isPure
+_PURE = {abs, min, max, len, round, pow, sum, divmod, bool, int, float, complex, str, tuple, frozenset}
+_IMPURE = {operator.setitem, operator.delitem} | {getattr(operator, name) for name in dir(operator)
+    if name.startswith('i') and hasattr(operator, name[1:])}
+
+def _isPure(f):
+    if not callable(f):
+        return True
+    try:
+        if f in _PURE:
+            return True
+        if f in _IMPURE:
+            return False
+    except TypeError:
+        return False
+    return getattr(f, '__module__', None) in {'math', 'cmath', 'operator', '_operator'} or type(f).__name__ == 'ufunc'
+
 # Languages
 
 
@@ -26,6 +50,9 @@ class BaseCalculator:
 
     A semantic calculator could evaluate constants and variables in the language
     """
+    memo = None   # EvalMemo in evalShared
+    numeric = numericModes['decimal']   # numbers of the literals, see setNumeric
+    pure = None   # names of pure functions, None to decide by their values
     def __init__(self, dictionary={}, context={}):
         """
         Keyword Arguments:
@@ -61,8 +88,50 @@ class BaseCalculator:
     def update(self, x_v):
         self.context.update(x_v)
 
+    def isPure(self, t):
+        """Is the function named t free of side effects
+
+        Functions of the modules math and operator (except the in-place ones)
+        and numpy ufuncs are pure; set `pure` to give the names explicitly.
+        """
+        if self.pure is not None:
+            return t in self.pure
+        try:
+            v = self.context[t] if t in self.context else self.dictionary[t]
+        except (KeyError, TypeError):
+            return False
+        return all(map(_isPure, v.values())) if isinstance(v, dict) else _isPure(v)
+
     def copy(self):
-        return self.__class__(self.dictionary, self.context.copy())
+        ret = self.__class__(self.dictionary, self.context.copy())
+        ret.numeric = self.numeric
+        return ret
+
+    def setNumeric(self, mode):
+        """Select the numbers of the literals: 'decimal' (default), 'float', 'int-or-float' or 'fraction'
+
+        The literals are converted once for the mode; the number constants of the dictionary
+        are converted to the mode, in a copy of the dictionary.
+        """
+        self.numeric = numericMode(mode)
+        self.dictionary = self.numeric.match(self.dictionary)
+        return self
+
+    frames = framePool
+
+    def enter(self):
+        """Calculator for a call, whose context is a frame of local variables over the context
+
+        It costs the same whatever the size of the context;
+        give it back by `leave` when the call returns.
+        """
+        loc = object.__new__(self.__class__)
+        loc.__dict__.update(self.__dict__)
+        loc.context = self.frames.acquire(self.context)
+        return loc
+
+    def leave(self, loc):
+        self.frames.release(loc.context)
 
     def __enter__(self):
         return self.copy()
@@ -71,6 +140,24 @@ class BaseCalculator:
         return True
 
 
+class SymbolTable(dict):
+    """Functions of the names of a dictionary selected by arity: (name, arity) => function
+
+    stamp: identity and size of the dictionary when the functions were resolved
+    """
+    stamp = None
+
+
+_builtins = {}   # name => eval(name), see StandardCalculator.useBuiltins
+
+def _builtin(t):
+    try:
+        return _builtins[t]
+    except KeyError:
+        _builtins[t] = f = eval(t)
+        return f
+
+
 class StandardCalculator(BaseCalculator):
     """Semantic calculator with control information
 
@@ -88,14 +175,26 @@ class StandardCalculator(BaseCalculator):
         self.control = control
         self.maxloop = 5000
         self.useBuiltins = False
+        self.symbols = SymbolTable()
+        self.memoized = {}   # names of the functions defined with a cache => maxsize, see memoize
 
     def copy(self):
-        return self.__class__(self.dictionary, self.context.copy(), self.control)
+        ret = self.__class__(self.dictionary, self.context.copy(), self.control)
+        # the functions resolved in the dictionary do not depend on the context
+        ret.symbols = self.symbols
+        ret.numeric = self.numeric
+        ret.memoized = self.memoized
+        return ret
 
     def reset(self):
         super().reset()
         self.control = None
 
+    def enter(self):
+        loc = super().enter()
+        loc.control = loc.retval = None
+        return loc
+
     def __call__(self, t, *args, **kwargs):
         """Get the value of t
         
@@ -110,38 +209,109 @@ class StandardCalculator(BaseCalculator):
             Exception -- [description]
             NameError -- [description]
         """
-        arity = len(args) + len(kwargs)
-        if t in self.context:
-            v = self.context[t]
-            if arity == 0:
+        context = self.context
+        if t in context:
+            v = context[t]
+            if not args and not kwargs:
                 return v
             else:
                 if isinstance(v, dict):
+                    arity = len(args) + len(kwargs)
                     if arity in v:
                         return v[arity](*args, **kwargs)
                     else:
                         raise Exception('Notice the arity!')
                 else:
                     return v(*args, **kwargs)
-        elif t in self.dictionary:
-            v = self.dictionary[t]
+        return self.resolve(t, len(args) + len(kwargs))(*args, **kwargs)
+
+    def resolve(self, t, arity):
+        """The function f of a name t out of the context, such that self(t, *args) == f(*args)
+
+        The functions of the names in the dictionary are selected by arity once and kept in
+        `symbols`, shared by the copies; the table is cleared when the dictionary changes shape.
+        Call `invalidate` after replacing a value of the dictionary.
+
+        Raises:
+            NameError -- t is neither in the dictionary nor a builtin (with useBuiltins)
+        """
+        dictionary = self.dictionary
+        symbols = self.symbols
+        if symbols.stamp != (id(dictionary), len(dictionary)):
+            symbols.clear()
+            symbols.stamp = id(dictionary), len(dictionary)
+        try:
+            return symbols[t, arity]
+        except KeyError:
+            pass
+        if t in dictionary:
+            v = dictionary[t]
             if arity == 0:
-                if isinstance(v, dict):
-                    return v[2]
-                else:
-                    return v
+                value = v[2] if isinstance(v, dict) else v
+                f = lambda: value
+            elif isinstance(v, dict):
+                if arity not in v:
+                    raise Exception('notice the arity!')
+                f = v[arity]
             else:
-                if isinstance(v, dict):
-                    if arity in v:
-                        return v[arity](*args, **kwargs)
-                    else:
-                        raise Exception('notice the arity!')
-                else:
-                    return v(*args, **kwargs)
+                f = v
+            symbols[t, arity] = f
+            return f
+        if self.useBuiltins:
+            return _builtin(t)
+        raise NameError('Did not find %s' % t)
+
+    def invalidate(self):
+        # forget the functions resolved in the dictionary
+        self.symbols.clear()
+        self.symbols.stamp = None
+
+    def memoize(self, name, maxsize=1024):
+        """The functions defined by `def name` afterwards cache their values (as with the pragma @memo)
+
+        Only pure functions should be memoized: the value is computed once for each arguments,
+        the changes of the variables and the output of the function are not repeated.
+        The calls with unhashable arguments are not cached.
+
+        Arguments:
+            name {str} -- name of the function
+
+        Keyword Arguments:
+            maxsize {int} -- size of the LRU cache, None for unbounded (default: {1024})
+        """
+        self.memoized[name] = maxsize
+
+    def threadCopy(self):
+        """Calculator for another thread
+
+        It shares the dictionary, the resolved functions and the settings, and has its own context
+        (a copy) and its own control state; the functions defined (def) with this calculator are
+        defined again with the new one, so they run in its context, with new caches if they are memoized.
+        """
+        ret = object.__new__(self.__class__)
+        ret.__dict__.update(self.__dict__)
+        ret.context = self.context.copy()
+        ret.control = None
+        ret.__dict__.pop('memo', None)
+        for name, f in list(ret.context.items()):
+            definition = getattr(f, 'definition', None)
+            if definition is not None and definition[1] is self:
+                action, _, body = definition
+                ret.context[name] = action.makeFunction(ret, body)
+        return ret
+
+    def cacheInfo(self, name):
+        # hits, misses, maxsize, currsize of the cache of the memoized function `name`
+        return self.context[name].cache_info()
+
+    def clearMemo(self, name=None):
+        # clear the cache of the memoized function `name`, or of all the memoized functions of the context
+        if name is not None:
+            self.context[name].cache_clear()
         else:
-            if self.useBuiltins:
-                return eval(t)(*args, **kwargs)
-            raise NameError('Did not find %s' % t)
+            for f in set(self.context.values()):
+                if hasattr(f, 'cache_clear'):
+                    f.cache_clear()
 
     def eval(self, parseResult):
         pass
@@ -151,9 +321,15 @@ class StandardCalculator(BaseCalculator):
 
     def __setstate__(self, state):
         self.dictionary, self.context, self.control = state['dictionary'], state['context'], state['control']
+        self.numeric = numericMode(state.get('numeric', 'decimal'))
+        self.symbols = SymbolTable()
+        self.memoized = state.get('memoized', {})
+        self.maxloop = state.get('maxloop', 5000)
+        self.useBuiltins = state.get('useBuiltins', False)
 
     def __getstate__(self):
-        return {'dictionary': self.dictionary, 'context': self.context, 'control': self. control}
+        return {'dictionary': self.dictionary, 'context': self.context, 'control': self. control, 'numeric': self.numeric.name,
+            'memoized': self.memoized, 'maxloop': self.maxloop, 'useBuiltins': self.useBuiltins}
 
 
 def _token(s):
@@ -165,27 +341,92 @@ class BaseParser:
     Users must define `make` in subclass
     """
     expression = None
+    cache = None   # ParseCache used by parseFile
 
     def make(self, *args, **kwargs):
         raise NotImplementedError('define method `make` to create a parser based on pyparsing')
     
-    def parse(self, s):
+    def parse(self, s, timeout=None, maxAttempts=None, lazy=False, compact=False, intern=False):
+        """Parse string s
+
+        Keyword Arguments:
+            timeout {number} -- deadline of parsing in seconds (default: {None})
+            maxAttempts {int} -- maximum number of element attempts (default: {None})
+            lazy {bool} -- create the action objects on first access (default: {False})
+            compact {bool} -- make compact action objects, without ParseResults and source (default: {False})
+            intern {bool|Interner} -- share structurally identical action objects (default: {False})
+
+        Raises:
+            ParseBudgetExceeded -- when a limit is exceeded
+        """
         if self.expression is None:
             self.make()
-        return self.expression.parseString(s)[0]
+        with ParseBudget(timeout, maxAttempts), lazyActions(lazy), compactActions(compact), internActions(intern):
+            return self.expression.parseString(s)[0]
 
-    def matches(self, s):
+    def matches(self, s, timeout=None, maxAttempts=None, doActions=True):
+        # doActions=False: only recognize s, without the parse actions
         if self.expression is None:
             self.make()
-        return self.expression.matches(s)
-
-    def parseFile(self, filename):
+        with ParseBudget(timeout, maxAttempts):
+            if doActions:
+                return self.expression.matches(s)
+            return recognize(self.expression, s)
+
+    def parseFile(self, filename, *args, **kwargs):
+        # load the tree from the cache if the source is unchanged
+        if self.cache is not None:
+            return self.cache.parseFile(self, filename, *args, **kwargs)
         with open(filename, 'r') as fo:
-            return self.parse(fo.read())
+            return self.parse(fo.read(), *args, **kwargs)
 
     def kill(self):
         self.expression = None
 
+    @property
+    def fingerprint(self):
+        # grammarFingerprint of the grammar, computed once for each grammar made
+        grammar = self.grammar
+        cached = getattr(self, '_fingerprint', None)
+        if cached is None or cached[0] is not grammar:
+            cached = self._fingerprint = grammar, grammarFingerprint(grammar)
+        return cached[1]
+
+    @property
+    def grammar(self):
+        # the ParserElement used by `parse`
+        if self.expression is None:
+            self.make()
+        return self.expression
+
+    def profile(self, corpus, filename=None):
+        """Count the winning alternatives of the grammar over corpus
+
+        Arguments:
+            corpus {iterable} -- sample strings
+            filename {str} -- file to save the profile (default: {None})
+
+        Returns:
+            AlternativeProfile
+        """
+        profile = profileAlternatives(self.grammar, corpus)
+        if filename:
+            profile.save(filename)
+        return profile
+
+    def reorder(self, profile):
+        """Reorder the alternatives of the grammar where it is safe
+
+        Arguments:
+            profile {AlternativeProfile|str} -- a profile or the file storing it
+
+        Returns:
+            int -- number of reordered MatchFirst expressions
+        """
+        if isinstance(profile, str):
+            profile = AlternativeProfile.load(profile)
+        return profile.apply(self.grammar)
+
 
 class StandardParser(BaseParser):
     '''Standard class for Syntax Parser
@@ -284,35 +525,289 @@ class StandardParser(BaseParser):
          state['keywords'], state['constants'], state['variables'], state['functions'], state['operators']
 
 
+# the language of a worker process of Language.evalMany
+_worker = None
+
+def _startWorker(language, factory, calculator):
+    # make the grammar once in a worker process
+    global _worker
+    if factory is not None:
+        language = factory()
+    if calculator is not None:
+        language.calculator = calculator
+    language.make_parser()
+    if language.cache is None:
+        language.cache = MemoryCache()
+    _worker = language
+
+def _evalChunk(items):
+    # values of the items (source, context) in the worker, the exceptions in place of the values of the failed items
+    language = _worker
+    base = language.calculator.context
+    ret = []
+    try:
+        for s, context in items:
+            language.calculator.context = {**base, **context} if context else base.copy()
+            try:
+                ret.append(language.eval(s))
+            except Exception as ex:
+                try:
+                    pickle.dumps(ex)
+                except Exception:
+                    ex = RuntimeError('%s: %s' % (type(ex).__name__, ex))
+                ret.append(ex)
+    finally:
+        language.calculator.context = base
+    return ret
+
+
+# makes the grammars of the languages switched to the threaded mode
+_makeLock = threading.Lock()
+
+
 class Language:
     '''Language
     a language contains two parts syntax parser and semantic calculator
+
+    In the threaded mode (see setThreaded) the threads share the grammar, the dictionary
+    and the cache of the language, and each thread has its own calculator.
     '''
-    def __init__(self, name='Toy', parser=None, calculator=None):
+    threaded = False   # each thread has its own calculator
+    def __init__(self, name='Toy', parser=None, calculator=None, cache=None):
+        """
+        Keyword Arguments:
+            cache {MemoryCache} -- cache of the results of parsing strings, shared by matches, parse and eval (default: {None})
+        """
         self.name = name
         self.parser = parser
         self.calculator = calculator
+        self.cache = cache
 
     def __str__(self):
         return 'Language <%s>' % self.name
 
+    @property
+    def calculator(self):
+        # the calculator of the current thread in the threaded mode, see threadCopy
+        if not self.threaded:
+            return self.sharedCalculator
+        local = self.locals
+        try:
+            return local.calculator
+        except AttributeError:
+            local.calculator = self.sharedCalculator.threadCopy()
+            return local.calculator
+
+    @calculator.setter
+    def calculator(self, calculator):
+        self.sharedCalculator = calculator
+        if self.threaded:
+            self.locals = threading.local()
+
+    def setThreaded(self, flag=True):
+        """Switch to the threaded mode, where each thread evaluates with its own calculator
+
+        The grammar is made once now: the threads share it, with the dictionary and the cache;
+        the calculators of the threads are copies of the calculator of the language (threadCopy)
+        made on their first use, so set up the calculator (setNumeric, memoize, context) first.
+        The threads parse one string at a time (see parsing), the evaluations run concurrently.
+
+        Example:
+            language.setThreaded()
+            executor.map(language.eval, sources)
+        """
+        if flag:
+            with _makeLock:
+                if self.parser.expression is None:
+                    self.parser.make()
+            self.locals = threading.local()
+            self.parseLock = threading.RLock()
+        self.threaded = flag
+        return self
+
+    def parsing(self):
+        # context of the parsing: in the threaded mode, the lock of the language, as pyparsing clears
+        # its packrat cache at the start of each parse, out of the lock of the cache
+        return self.parseLock if self.threaded else contextlib.nullcontext()
+
+    @contextlib.contextmanager
+    def request(self, context=None):
+        """Context in which the current thread has a new calculator, for a request of a server in the threaded mode
+
+        Example:
+            with language.request({'x': 1}) as calculator:
+                language.eval('x + 1')
+
+        Keyword Arguments:
+            context {dict} -- variables added to the context of the new calculator (default: {None})
+
+        Raises:
+            ValueError -- the language is not in the threaded mode
+        """
+        if not self.threaded:
+            raise ValueError('request is for the threaded mode, see setThreaded')
+        local = self.locals
+        outer = getattr(local, 'calculator', None)
+        local.calculator = calculator = self.sharedCalculator.threadCopy()
+        if context:
+            calculator.context.update(context)
+        try:
+            yield calculator
+        finally:
+            if outer is None:
+                del local.calculator
+            else:
+                local.calculator = outer
+
     def make_parser(self):
         self.parser.make()
 
-    def matches(self, s):
-        return self.parser.matches(s)
+    def matches(self, s, *args, **kwargs):
+        with self.parsing():
+            if self.cache is not None:
+                return self.cache.matches(self.parser, s, *args, **kwargs)
+            return self.parser.matches(s, *args, **kwargs)
 
-    def parse(self, s):
-        return self.parser.parse(s)
+    def parse(self, s, *args, **kwargs):
+        # see BaseParser.parse for the deadline and the budget
+        with self.parsing():
+            if self.cache is not None:
+                return self.cache.parse(self.parser, s, *args, **kwargs)
+            return self.parser.parse(s, *args, **kwargs)
 
-    def parseFile(self, filename):
-        return self.parser.parseFile(filename)
+    def parseMany(self, strings, *args, **kwargs):
+        """Parse the strings, each distinct string once
 
-    def eval(self, s):
+        Returns:
+            list -- the trees of the strings, in order; equal strings have the same tree
+        """
+        strings = list(strings)
+        trees = {s: self.parse(s, *args, **kwargs) for s in dict.fromkeys(strings)}
+        return [trees[s] for s in strings]
+
+    def parseFile(self, filename, *args, **kwargs):
+        with self.parsing():
+            return self.parser.parseFile(filename, *args, **kwargs)
+
+    def eval(self, s, shared=False):
+        # shared: build identical subexpressions once and compute the pure ones once
+        if shared:
+            return evalShared(self.parse(s, intern=True), self.calculator)
         return self.parse(s).eval(calculator=self.calculator)
 
+    def compile(self, s):
+        """Compile the expression s to a function of a context, see compileAction
+
+        Example:
+            f = language.compile('x^2 + 1')
+            [f({'x': x}) for x in range(10)]
+        """
+        return compileAction(self.parse(s), self.calculator)
+
+    def evalBatch(self, s, columns):
+        """Evaluate the expression s (or its tree) for each row of columns of NumPy arrays, see pyparsing_ext.batch
+
+        Example:
+            language.setNumeric('float')
+            language.evalBatch('x^2 + 1', {'x': numpy.arange(10**6)})
+        """
+        from pyparsing_ext.batch import evalBatch
+        return evalBatch(self.parse(s) if isinstance(s, str) else s, self.calculator, columns)
+
+    def setNumeric(self, mode):
+        # numbers of the language, see StandardCalculator.setNumeric
+        # (in the threaded mode, the calculators of the threads are made again)
+        self.sharedCalculator.setNumeric(mode)
+        self.calculator = self.sharedCalculator
+        return self
+
+    def simplify(self, s, identities=True):
+        # the tree of s with the constant subtrees folded, see pyparsing_ext.simplify
+        return simplify(self.parse(s), self.calculator, identities)
+
     def __call__(self, s):
         return self.eval(s)
 
+    def evalMany(self, sources, contexts=None, workers=None, chunksize=None, factory=None):
+        """Evaluate the sources in a pool of processes
+
+        The workers make the grammar once and are kept for the next calls with the same
+        arguments, calculator and context (see `shutdown`); each worker gets the calculator once and
+        evaluates the items with the variables of their contexts added to its context.
+        The items are sent in chunks.
+
+        The grammars of pyparsing can not be pickled: without factory, the workers are forked
+        and inherit the language; factory is a picklable function (of a module) making
+        the language in the workers, required where fork is not available.
+
+        Example:
+            language.evalMany(['x^2 + 1', 'x + y'], [{'x': 1}, {'x': 2, 'y': 3}], workers=4)
+
+        Arguments:
+            sources {iterable} -- strings of expressions
+
+        Keyword Arguments:
+            contexts {iterable} -- dictionaries of the variables of the sources, None for no variables (default: {None})
+            workers {int} -- number of processes (default: {None}, the number of CPUs)
+            chunksize {int} -- number of items sent at once (default: {None}, 4 chunks per worker)
+            factory {callable} -- function without arguments returning the language (default: {None})
+
+        Returns:
+            list -- the values of the sources in order, the exception raised in place of the value of a failed source
+
+        Raises:
+            ValueError -- the lengths of sources and contexts differ, or no factory where fork is not available
+        """
+        sources = list(sources)
+        contexts = [None] * len(sources) if contexts is None else list(contexts)
+        if len(contexts) != len(sources):
+            raise ValueError('there should be a context for each source, not %d for %d' % (len(contexts), len(sources)))
+        if not sources:
+            return []
+        executor = self.workers(workers, factory)
+        if chunksize is None:
+            chunksize = max(1, -(-len(sources) // ((workers or os.cpu_count() or 1) * 4)))
+        items = list(zip(sources, contexts))
+        chunks = [items[k:k+chunksize] for k in range(0, len(items), chunksize)]
+        return [value for values in executor.map(_evalChunk, chunks) for value in values]
+
+    def workers(self, workers=None, factory=None):
+        # the pool of processes of evalMany, made again if the arguments, the calculator or its context changed
+        calculator = self.calculator
+        stamp = (workers, factory, id(calculator), id(calculator.dictionary), len(calculator.dictionary), calculator.numeric,
+            getattr(calculator, 'maxloop', None), getattr(calculator, 'useBuiltins', None), dict(calculator.context))
+        pool = getattr(self, 'pool', None)
+        if pool is not None:
+            try:
+                same = pool[0] == stamp
+            except Exception:
+                # values without a truth of ==, as arrays
+                same = False
+            if same:
+                return pool[1]
+        self.shutdown()
+        if factory is None:
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                raise ValueError('fork is not available, give a factory to make the language in the workers')
+            context, initargs = multiprocessing.get_context('fork'), (self, None, None)
+        else:
+            context, initargs = None, (None, factory, calculator)
+        executor = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context,
+            initializer=_startWorker, initargs=initargs)
+        self.pool = stamp, executor
+        return executor
+
+    def shutdown(self):
+        # stop the processes of evalMany
+        pool = getattr(self, 'pool', None)
+        if pool is not None:
+            self.pool = None
+            pool[1].shutdown()
+
+    def __getstate__(self):
+        # the pool is not pickled
+        return {'name': self.name, 'parser': self.parser, 'calculator': self.sharedCalculator, 'cache': self.cache}
+
     def __setstate__(self, state):
         self.name, self.parser, self.calculator = state['name'], state['parser'], state['calculator']
+        self.cache = state.get('cache')
@@ -2,13 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import operator
+import os
+import pathlib
+import threading
+import weakref
+import collections
+import concurrent.futures
 
 from pyparsing_ext import *
 from pyparsing_ext.pylang import *
 
 
 arithOpTable = [{'token':'^','assoc':'right'}, {'token':pp.oneOf('+ -'),'arity':1}, pp.oneOf('* /'), pp.oneOf('+ -'), {'token':pp.oneOf('== != < > <= >='), 'action': CompareAction}]
-logicOpTable = [{'token':'~', 'arity':1, 'action':UnaryOperatorAction}, {'token':'&', 'action':BinaryOperatorAction}, {'token':'|', 'action':BinaryOperatorAction}]
+logicOpTable = [{'token':'~', 'arity':1, 'action':UnaryOperatorAction}, {'token':'&', 'action':LogicalOperatorAction}, {'token':'|', 'action':LogicalOperatorAction}]
 
 arithDict = {'True':True, 'False':False, '+': {1:operator.pos, 2:operator.add}, '*': operator.mul, '-':{1:operator.neg, 2:operator.sub}, '/':operator.truediv, '^':operator.pow, '==':operator.eq, '!=':operator.ne, '<':operator.lt, '>':operator.gt, '<=':operator.le, '>=':operator.ge}
 
@@ -67,7 +73,9 @@ class ProgrammingParser(StandardParser):
 
         PARAM = variable('name') + pp.Optional(pp.Suppress('=') + expression('default'))
         PARAM.setParseAction(ParameterAction)
-        defStatement = self.keywords['def']('keyword') + (variable('function') + LPAREN + pp.delimitedList(PARAM)('parameters') + RPAREN
+        # pragma: @memo or @memo(maxsize), see DefAction
+        memoPragma = pp.Suppress('@') + pp.Keyword('memo')('memo') + pp.Optional(LPAREN + INTEGER('maxsize') + RPAREN)
+        defStatement = pp.Optional(memoPragma) + self.keywords['def']('keyword') + (variable('function') + LPAREN + pp.delimitedList(PARAM)('parameters') + RPAREN
           | PUNC('left') + pp.delimitedList(PARAM)('parameters') + PUNC('right')
           | PARAM('parameter1') + PUNC('operator') + PARAM('parameter2')) + LBRACE + program('program') + RBRACE
         defStatement.setParseAction(DefAction)
@@ -76,9 +84,14 @@ class ProgrammingParser(StandardParser):
         breakStatement, continueStatement, expressionStatement, LBRACE + program + RBRACE]
 
         statement = pp.MatchFirst(self.statements)
-        program <<= pp.OneOrMore(statement).setParseAction(ProgramSequenceAction)
+        sequence = pp.OneOrMore(statement).setParseAction(ProgramSequenceAction)
+        program <<= sequence
+        self.statement, self.sequence = statement, sequence
         loadStatement = pp.Keyword('load')('keyword').suppress() + pp.restOfLine('path')
-        self.program = pp.ZeroOrMore(loadStatement)('loading') + program
+        self.loading = pp.ZeroOrMore(loadStatement)('loading')
+        self.program = (self.loading + program).setParseAction(_module)
+        # the locations are those of the source (tabs not expanded), as the offsets of reparse
+        self.program.parseWithTabs()
         self.comment = pp.pythonStyleComment
         self.program.ignore(self.comment)
 
@@ -100,18 +113,274 @@ class ProgrammingParser(StandardParser):
             self.comment = matlabStyleComment
         self.program.ignore(self.comment)
 
-    def parse(self, s):
+    @property
+    def grammar(self):
+        if not hasattr(self, 'program'):
+            self.make()
+        return self.program
+
+    def profile(self, corpus, filename=None):
+        profile = profileAlternatives(self.grammar, corpus, parseAll=True)
+        if filename:
+            profile.save(filename)
+        return profile
+
+    def parse(self, s, timeout=None, maxAttempts=None, lazy=False, compact=False, intern=False):
         if not hasattr(self, 'program'):
             self.make()
         try:
-            return self.program.parseString(s, parseAll=True)[0]
+            with ParseBudget(timeout, maxAttempts), lazyActions(lazy), compactActions(compact), internActions(intern):
+                return self.program.parseString(s, parseAll=True)[0]
         except pp.ParseException as pe:
             print(pp.ParseException.explain(pe))
 
 
+    def continuation(self, s, state=None):
+        """Whether the source s is a whole program, where s extends a source checked before
+
+        Only the text added since the previous check is scanned for braces. While a brace is open
+        s is not complete; otherwise the statements are recognized (without the parse actions)
+        from the last but one top-level statement recognized before.
+        So each line typed at the command line costs its length plus the last two statements.
+
+        Arguments:
+            s {str} -- the source
+            state {tuple} -- state returned for a prefix of s (default: {None}, nothing checked)
+
+        Returns:
+            tuple -- whether s is a whole program, state of s
+        """
+        if not hasattr(self, 'program'):
+            self.make()
+        checked, depth, marks = state or (0, 0, [])
+        added = (pp.quotedString | self.comment).suppress().transformString(s[checked:])
+        depth += added.count('{') - added.count('}')
+        if depth > 0:
+            return False, (len(s), depth, marks)
+
+        pp.ParserElement.resetCache()
+        complete = False
+        try:
+            if len(marks) < 2:
+                loc, marks = self.loading._parse(s, 0, doActions=False)[0], []
+            else:
+                # the statement before the last one may have looked ahead into the added text
+                loc, marks = marks[-2], marks[:-2]
+            while True:
+                preloc = self.sequence._skipIgnorables(s, loc)
+                next_ = self.statements[0].preParse(s, preloc)
+                if next_ >= len(s):
+                    complete = bool(marks)
+                    break
+                loc, _ = self.statement._parse(s, preloc, doActions=False)
+                marks.append(next_)
+        except (pp.ParseBaseException, IndexError):
+            pass
+        return complete, (len(s), depth, marks)
+
+    # actions of top-level statements, whose locations are statement boundaries
+    boundaryActions = (IfAction, WhileAction, DefAction, ReturnAction, PassAction, PrintAction, AssignmentAction, BreakAction, ContinueAction)
+
+    def reparse(self, previous, start, end, text):
+        """Parse the source of a previous parse with source[start:end] replaced by text
+
+        The top-level statements before the edit (but the last two) and after it are reused,
+        only the statements in between are parsed again. The result is the same as a full parse.
+        The reused statements are copied to the new source, previous is left unchanged.
+
+        Arguments:
+            previous {ProgramSequenceAction} -- result of parse or reparse
+            start, end {int} -- edited range of the previous source
+            text {str} -- new text of the range
+
+        Returns:
+            ProgramSequenceAction
+        """
+        old = previous.instring
+        s = old[:start] + text + old[end:]
+        if not (isinstance(previous, ProgramSequenceAction) and isinstance(previous.tokens, pp.ParseResults)
+            and hasattr(self, 'sequence')):
+            return self.parse(s)
+        delta = len(text) - (end - start)
+        items = previous.program
+        marks = [k for k, item in enumerate(items) if isinstance(item, self.boundaryActions)]
+        before = [k for k in marks if items[k].loc < start]
+        if len(before) < 2:
+            return self.parse(s)
+        # the statement before the edited one may have looked ahead into it
+        restart = before[-2]
+        after = {items[k].loc + delta: k for k in marks if items[k].loc > end}
+
+        pp.ParserElement.resetCache()
+        pieces = []
+        resync = None
+        try:
+            loc, tokens = self.statement._parse(s, items[restart].loc)
+            pieces.append(tokens)
+            while True:
+                preloc = self.sequence._skipIgnorables(s, loc)
+                next_ = self.statements[0].preParse(s, preloc)
+                if next_ in after:
+                    resync = after[next_]
+                    break
+                try:
+                    loc, tokens = self.statement._parse(s, preloc)
+                except (pp.ParseException, IndexError):
+                    break
+                pieces.append(tokens)
+            if resync is None:
+                (pp.Empty() + pp.StringEnd())._parse(s, self.program.preParse(s, loc))
+        except pp.ParseBaseException:
+            return self.parse(s)
+
+        memo = {}
+        tokens = _relocated(_sliceResults(previous.tokens, 0, restart), s, 0, memo)
+        if resync is not None:
+            suffix = _relocated(_sliceResults(previous.tokens, resync, len(items)), s, delta, memo)
+            pieces.append(suffix)
+        for piece in pieces:
+            if piece or piece.haskeys():
+                tokens += piece
+        return ProgramSequenceAction(s, previous.loc, tokens)
+
+
+def _module(instring, loc, tokens):
+    # the program, or a ModuleAction if it loads modules
+    if tokens.get('loading'):
+        return ModuleAction(instring, loc, tokens)
+    return tokens[-1]
+
+def _sliceResults(tokens, i, j):
+    # ParseResults of tokens[i:j] with their names
+    ret = pp.ParseResults(tokens[i:j])
+    for name, occurrences in tokens._ParseResults__tokdict.items():
+        for value, offset in occurrences:
+            if i <= offset < j:
+                ret[name] = pp._ParseResultsWithOffset(value, offset - i)
+    return ret
+
+def _relocated(tokens, instring, delta, memo):
+    # copy of tokens with the action objects moved to instring, their locations shifted by delta
+    # memo maps the ids of the copied objects to (object, copy), a shared subtree is copied once
+    def copied(x):
+        return memo[id(x)][1] if id(x) in memo else x
+
+    stack = [(tokens, False)]
+    while stack:
+        x, done = stack.pop()
+        if id(x) in memo:
+            continue
+        action = x.force() if type(x) is LazyAction else x
+        if isinstance(action, BaseAction):
+            fields = list(iterfields(action))
+            if not done:
+                stack.append((x, True))
+                stack.extend((value, False) for _, value in fields)
+                continue
+            ret = object.__new__(type(action))
+            for name, value in fields:
+                setattr(ret, name, copied(value))
+            ret.instring = instring
+            ret.loc = action.loc + delta
+        elif isinstance(x, pp.ParseResults):
+            if not done:
+                stack.append((x, True))
+                stack.extend((value, False) for value in x)
+                stack.extend((value, False) for occurrences in x._ParseResults__tokdict.values() for value, _ in occurrences)
+                continue
+            ret = x.copy()
+            ret._ParseResults__toklist[:] = [copied(value) for value in x]
+            ret._ParseResults__tokdict = {name: [pp._ParseResultsWithOffset(copied(value), offset) for value, offset in occurrences]
+                for name, occurrences in x._ParseResults__tokdict.items()}
+        elif isinstance(x, CompactTokens):
+            if not done:
+                stack.append((x, True))
+                stack.extend((value, False) for value in x.items)
+                stack.extend((value, False) for value in (x.names or {}).values())
+                continue
+            ret = CompactTokens(map(copied, x.items), x.names and {name: copied(value) for name, value in x.names.items()})
+        elif isinstance(x, (list, tuple, dict)):
+            if not done:
+                stack.append((x, True))
+                stack.extend((value, False) for value in (x.values() if isinstance(x, dict) else x))
+                continue
+            ret = {name: copied(value) for name, value in x.items()} if isinstance(x, dict) else type(x)(map(copied, x))
+        else:
+            continue
+        memo[id(x)] = x, ret
+    return copied(tokens)
+
+
+class CyclicLoadError(ImportError):
+    """Raised when a module loads itself, directly or through other modules
+
+    chain: the paths of the modules, from the first one to the repeated one
+    """
+    def __init__(self, chain):
+        self.chain = chain
+        super(CyclicLoadError, self).__init__('cyclic load: %s' % ' -> '.join(map(str, chain)))
+
+
+Module = collections.namedtuple('Module', ('path', 'stamp', 'tree'))
+
+
+class ModuleRegistry:
+    """Parsed modules by resolved path, like sys.modules
+
+    A module is parsed again when the mtime or the size of its file changes.
+    It also records the modules run with each calculator, so that `load` runs a module
+    once per calculator (again if the file changed).
+    """
+
+    def __init__(self):
+        self.modules = {}   # path => Module
+        self.executed = weakref.WeakKeyDictionary()   # calculator => {path: stamp}
+        self.lock = threading.Lock()
+
+    def __contains__(self, path):
+        return path in self.modules
+
+    def __len__(self):
+        return len(self.modules)
+
+    @staticmethod
+    def stamp(path):
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def get(self, path, parse):
+        """The module of path, parsed by parse(path) if it is not registered or the file changed
+
+        Returns:
+            Module
+        """
+        stamp = self.stamp(path)
+        with self.lock:
+            module = self.modules.get(path)
+        if module is None or module.stamp != stamp:
+            module = Module(path, stamp, parse(path))
+            if module.tree is not None:
+                with self.lock:
+                    self.modules[path] = module
+        return module
+
+    def isExecuted(self, calculator, module):
+        return self.executed.get(calculator, {}).get(module.path) == module.stamp
+
+    def setExecuted(self, calculator, module):
+        self.executed.setdefault(calculator, {})[module.path] = module.stamp
+
+    def clear(self):
+        with self.lock:
+            self.modules.clear()
+            self.executed.clear()
+
+
 class ProgrammingLanguage(Language):
     '''programming Language
     '''
+    vm = False   # run the programs compiled to instructions, see compileProgram
+
     def __init__(self, name='Toy', *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -120,6 +389,7 @@ class ProgrammingLanguage(Language):
             'paths': [],
             'suffix': '.toy'
         }
+        self.modules = ModuleRegistry()
 
     # def make(self):
     #     grammar = ProgrammingParser()
@@ -130,29 +400,102 @@ class ProgrammingLanguage(Language):
         ret = self.parse(s)
         if ret and 'loading' in ret:
             for path in ret.loading:
-                self.executeFile(path.strip())
-        ret.execute(self.calculator)
+                self.load(path)
+        self.run(ret)
 
-    def parseFile(self, filename):
-        import pathlib
-        filename = pathlib.Path(filename).with_suffix(self.info['suffix'])
-        if filename.exists():
-            return super(ProgrammingLanguage, self).parseFile(filename)
+    def run(self, tree):
+        # execute the statements of tree
+        if self.vm:
+            runProgram(tree, self.calculator)
         else:
-            for path in self.info['paths']:
-                filename = pathlib.Path(path) / filename
-                if filename.exists():
-                    return super(ProgrammingLanguage, self).parseFile(filename)
-            else:
-                raise Exception('Could not find file %s' % filename)
+            tree.execute(self.calculator)
 
-    def executeFile(self, filename):
-        ret = self.parseFile(filename)
-        if ret:
-            if 'loading' in ret:
-                for path in ret.loading:
-                    self.executeFile(path.strip())
-            ret.execute(self.calculator)
+    def findFile(self, filename, base=None):
+        """Resolved path of a source file
+
+        The suffix is replaced by info['suffix']; the file is searched in the current directory,
+        then in base (the directory of the loading module) and in info['paths'].
+        """
+        filename = pathlib.Path(filename).with_suffix(self.info['suffix'])
+        folders = [pathlib.Path()] if base is None else [pathlib.Path(), pathlib.Path(base)]
+        for folder in folders + [pathlib.Path(path) for path in self.info['paths']]:
+            if (folder / filename).exists():
+                return (folder / filename).resolve()
+        raise Exception('Could not find file %s' % filename)
+
+    def parseFile(self, filename, *args, **kwargs):
+        return super(ProgrammingLanguage, self).parseFile(self.findFile(filename), *args, **kwargs)
+
+    def load(self, filename, base=None, force=False, chain=()):
+        """Run a module unless it has been run with the calculator
+
+        The modules it loads are run first. It is parsed once, see ModuleRegistry.
+
+        Arguments:
+            filename {str} -- path of the module
+
+        Keyword Arguments:
+            base {str} -- directory of the loading module (default: {None})
+            force {bool} -- run it even if it has been run (default: {False})
+            chain {tuple} -- paths of the modules being loaded (default: {()})
+
+        Raises:
+            CyclicLoadError -- the module is being loaded
+        """
+        path = self.findFile(filename, base)
+        if path in chain:
+            raise CyclicLoadError(chain[chain.index(path):] + (path,))
+        module = self.modules.get(path, super(ProgrammingLanguage, self).parseFile)
+        ret = module.tree
+        if not ret or not force and self.modules.isExecuted(self.calculator, module):
+            return
+        if 'loading' in ret:
+            for p in ret.loading:
+                self.load(p, path.parent, chain=chain + (path,))
+        self.run(ret)
+        self.modules.setExecuted(self.calculator, module)
+
+    def prefetch(self, filename, workers=None):
+        """Parse a module and the modules it loads, recursively, in a pool of threads
+
+        The parsed modules are registered; the files that can not be found or parsed are left
+        to `load`, to raise the errors in order.
+
+        Returns:
+            int -- number of parsed modules
+        """
+        parse = super(ProgrammingLanguage, self).parseFile
+        seen = set()
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            def submit(name, base):
+                try:
+                    path = self.findFile(name, base)
+                except Exception:
+                    return None
+                if path not in seen:
+                    seen.add(path)
+                    return executor.submit(self.modules.get, path, parse)
+            pending = {submit(filename, None)} - {None}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is not None:
+                        continue
+                    module = future.result()
+                    if module.tree and 'loading' in module.tree:
+                        pending |= {submit(p, module.path.parent) for p in module.tree.loading} - {None}
+        return len(seen)
+
+    def executeFile(self, filename, prefetch=False, workers=None):
+        """Run a source file, after the modules it loads
+
+        Keyword Arguments:
+            prefetch {bool} -- parse the loaded modules concurrently first, see `prefetch` (default: {False})
+            workers {int} -- number of threads for prefetch (default: {None})
+        """
+        if prefetch:
+            self.prefetch(filename, workers)
+        self.load(filename, force=True)
 
     def __call__(self, s):
         self.execute(s)
@@ -168,23 +511,25 @@ class ProgrammingLanguage(Language):
             if s == 'quit':
                 self.calculator.reset()
                 break
-            if self.matches(s):
+            if self.matches(s, doActions=False):
                 try:
                     ret = self.eval(s)
                     print(ret)
                 except Exception as ex:
                     print(ex)
             else:
-                while not self.program.matches(s):
+                # check each new line, not the whole source again
+                complete, state = self.parser.continuation(s)
+                while not complete:
                     ss = input(newlinePrompt)
                     if ss == '':
                         raise Exception('command could not be executed!')
                     s += ss
-                else:
-                    try:
-                        self.execute(s)
-                    except Exception as ex:
-                        print(ex)
+                    complete, state = self.parser.continuation(s, state)
+                try:
+                    self.execute(s)
+                except Exception as ex:
+                    print(ex)
 
     def view(self):
         for k, v in self.calculator.context.items():
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Binary format of trees of action objects
+
+A stream is the magic bytes, the version of the format, then records:
+    TYPE    name of an action class, numbered in order
+    STRING  an interned string, numbered in order
+    NODE    type id, location (varint delta of the former one), tokens
+    ROOT    index of the node that is the root of a tree
+Nodes are numbered in order and written after their subtrees,
+the tokens refer to the subtrees by their indexes.
+
+ASTWriter: write trees to a file object, or the nodes as they are made (streamActions)
+ASTReader: read the trees, lazily or not, or iterate the records without building them
+dumpAST, loadAST (dumpsAST, loadsAST for bytes): one tree
+registerAction: accept an action class of another module in the streams
+
+A stream names the classes of its nodes; the reader only makes action classes
+(subclasses of BaseAction) of pyparsing_ext, registered or given to it,
+so a tampered stream could not call other functions.
+'''
+
+import collections
+import importlib
+import io
+import struct
+
+import pyparsing as pp
+
+from pyparsing_ext.actions import _mode, lazyActions, BaseAction, LazyAction, CompactTokens
+
+
+MAGIC = b'PPXA'
+FORMAT_VERSION = 1
+
+# records
+_TYPE, _STRING, _NODE, _ROOT = range(1, 5)
+# tokens
+_NONE, _TRUE, _FALSE, _INT, _FLOAT, _STR, _ACTION, _RESULTS, _COMPACT, _LIST, _TUPLE, _SAME = range(12)
+
+_double = struct.Struct('<d')
+
+
+def _varint(out, n):
+    while n > 0x7f:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+
+def _zigzag(n):
+    return n << 1 if n >= 0 else (-n << 1) - 1
+
+def _unzigzag(n):
+    return -((n + 1) >> 1) if n & 1 else n >> 1
+
+
+# modules (and their submodules) of the action classes accepted by the readers
+trustedModules = {'pyparsing_ext'}
+# 'module:qualname' => action class accepted by the readers, see registerAction
+_registered = {}
+
+def _name(cls):
+    return '%s:%s' % (cls.__module__, cls.__qualname__)
+
+def registerAction(cls):
+    '''Accept the action class cls in the streams read by ASTReader, as a decorator
+
+    Example:
+        @registerAction
+        class MyAction(BaseAction):
+            ...
+    '''
+    if not (isinstance(cls, type) and issubclass(cls, BaseAction)):
+        raise TypeError('%r is not an action class' % (cls,))
+    _registered[_name(cls)] = cls
+    return cls
+
+
+class NodeRecord(collections.namedtuple('NodeRecord', 'index, cls, loc, tokens')):
+    '''A node read by ASTReader, the subtrees in tokens are NodeRef'''
+    __slots__ = ()
+
+
+class NodeRef(collections.namedtuple('NodeRef', 'index')):
+    __slots__ = ()
+
+
+class RootRecord(collections.namedtuple('RootRecord', 'index')):
+    __slots__ = ()
+
+
+class ASTWriter:
+    '''Write trees of action objects to a binary file object
+
+    Example:
+        with open('ast.bin', 'wb') as fo:
+            writer = ASTWriter(fo)
+            writer.write(tree)
+            writer.flush()
+    '''
+
+    def __init__(self, fileobj, bufsize=65536):
+        """
+        Arguments:
+            fileobj {file} -- binary file object
+
+        Keyword Arguments:
+            bufsize {int} -- size of the buffer flushed to fileobj (default: {65536})
+        """
+        self.fileobj = fileobj
+        self.bufsize = bufsize
+        self.buffer = bytearray(MAGIC)
+        _varint(self.buffer, FORMAT_VERSION)
+        self.types = {}     # class => id
+        self.strings = {}   # str => id
+        self.nodes = {}     # id(action) => (index, action)
+        self.loc = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.flush()
+
+    def flush(self):
+        self.fileobj.write(bytes(self.buffer))
+        self.buffer.clear()
+
+    def write(self, action):
+        # write the tree of action, then its ROOT record
+        index = self.add(action)
+        self.buffer.append(_ROOT)
+        _varint(self.buffer, index)
+        return index
+
+    def add(self, action):
+        # write the nodes of the tree not written yet, children first; return the index of action
+        stack = [(action, False)]
+        while stack:
+            node, visited = stack.pop()
+            if type(node) is LazyAction:
+                node = node.force()
+            if id(node) in self.nodes:
+                continue
+            if visited:
+                self.node(node)
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(node.children()) if id(child) not in self.nodes)
+        if type(action) is LazyAction:
+            action = action.force()
+        return self.nodes[id(action)][0]
+
+    def node(self, action):
+        # write one node, whose subtrees are written
+        cls = type(action)
+        if cls not in self.types:
+            self.types[cls] = len(self.types)
+            self._record(_TYPE, _name(cls))
+        body = bytearray()
+        self._tokens(body, action.tokens, {})
+        self.buffer.append(_NODE)
+        _varint(self.buffer, self.types[cls])
+        _varint(self.buffer, _zigzag(action.loc - self.loc))
+        self.buffer += body
+        self.loc = action.loc
+        self.nodes[id(action)] = len(self.nodes), action
+        if len(self.buffer) >= self.bufsize:
+            self.flush()
+
+    def _record(self, tag, s):
+        data = s.encode('utf-8')
+        self.buffer.append(tag)
+        _varint(self.buffer, len(data))
+        self.buffer += data
+
+    def _string(self, s):
+        if s not in self.strings:
+            self.strings[s] = len(self.strings)
+            self._record(_STRING, s)
+        return self.strings[s]
+
+    def _tokens(self, out, x, memo):
+        # memo: id => local number of the ParseResults in the tokens of the node
+        if isinstance(x, BaseAction):
+            if type(x) is LazyAction:
+                x = x.force()
+            out.append(_ACTION)
+            _varint(out, self.nodes[id(x)][0])
+        elif x is None:
+            out.append(_NONE)
+        elif x is True:
+            out.append(_TRUE)
+        elif x is False:
+            out.append(_FALSE)
+        elif type(x) is int:
+            out.append(_INT)
+            _varint(out, _zigzag(x))
+        elif type(x) is float:
+            out.append(_FLOAT)
+            out += _double.pack(x)
+        elif isinstance(x, str):
+            out.append(_STR)
+            _varint(out, self._string(str(x)))
+        elif id(x) in memo:
+            out.append(_SAME)
+            _varint(out, memo[id(x)])
+        elif isinstance(x, pp.ParseResults):
+            memo[id(x)] = len(memo)
+            out.append(_RESULTS)
+            _varint(out, len(x))
+            for t in x:
+                self._tokens(out, t, memo)
+            names = [(name, value, offset) for name, occurrences in x._ParseResults__tokdict.items()
+                for value, offset in occurrences]
+            _varint(out, len(names))
+            for name, value, offset in names:
+                _varint(out, self._string(name))
+                self._tokens(out, value, memo)
+                _varint(out, _zigzag(offset))
+        elif isinstance(x, CompactTokens):
+            memo[id(x)] = len(memo)
+            out.append(_COMPACT)
+            _varint(out, len(x))
+            for t in x:
+                self._tokens(out, t, memo)
+            _varint(out, len(x.keys()))
+            for name in x.keys():
+                _varint(out, self._string(name))
+                self._tokens(out, x[name], memo)
+        elif isinstance(x, (list, tuple)):
+            memo[id(x)] = len(memo)
+            out.append(_LIST if isinstance(x, list) else _TUPLE)
+            _varint(out, len(x))
+            for t in x:
+                self._tokens(out, t, memo)
+        else:
+            raise TypeError('Could not write tokens of type %s' % type(x).__name__)
+
+
+class streamActions(lazyActions):
+    '''Context in which the action objects are written by an ASTWriter as they are made
+
+    Objects made by the alternatives that fail are written as well,
+    write the result (`writer.write(ret)`) to record the root.
+
+    Example:
+        with streamActions(writer):
+            ret = pe.parseString(s)[0]
+        writer.write(ret)
+    '''
+
+    def __enter__(self):
+        self.outer = getattr(_mode, 'writer', None)
+        _mode.writer = self.flag
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        _mode.writer = self.outer
+
+
+class _Input:
+    # buffered reading of a file object
+
+    def __init__(self, fileobj, bufsize=65536):
+        self.fileobj = fileobj
+        self.bufsize = bufsize
+        self.buf = b''
+        self.pos = 0
+
+    def fill(self, n):
+        # make n bytes available, False at the end of the file
+        while len(self.buf) - self.pos < n:
+            data = self.fileobj.read(max(n, self.bufsize))
+            if not data:
+                return False
+            self.buf = self.buf[self.pos:] + data
+            self.pos = 0
+        return True
+
+    def byte(self):
+        if self.pos >= len(self.buf) and not self.fill(1):
+            return None
+        self.pos += 1
+        return self.buf[self.pos - 1]
+
+    def varint(self):
+        ret = shift = 0
+        while True:
+            b = self.byte()
+            if b is None:
+                raise ValueError('truncated AST stream')
+            ret |= (b & 0x7f) << shift
+            if b < 0x80:
+                return ret
+            shift += 7
+
+    def read(self, n):
+        if not self.fill(n):
+            raise ValueError('truncated AST stream')
+        self.pos += n
+        return self.buf[self.pos - n:self.pos]
+
+
+class ASTReader:
+    '''Read trees of action objects written by ASTWriter
+
+    Iterating the reader gives NodeRecord and RootRecord, without building the trees;
+    `trees()` gives the roots of the trees.
+
+    Example:
+        with open('ast.bin', 'rb') as fo:
+            for tree in ASTReader(fo).trees(lazy=True):
+                print(tree)
+    '''
+
+    def __init__(self, fileobj, classes={}, instring=''):
+        """
+        Arguments:
+            fileobj {file} -- binary file object
+
+        Keyword Arguments:
+            classes {dict} -- name ('module:qualname') => action class, for the classes not importable (default: {{}})
+            instring {str} -- the source string of the action objects (default: {''})
+
+        Raises:
+            ValueError -- not an AST stream, or a newer version of the format
+        """
+        self.input = _Input(fileobj)
+        self.classes = classes
+        self.instring = instring
+        if self.input.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not an AST stream of pyparsing_ext')
+        self.version = self.input.varint()
+        if self.version > FORMAT_VERSION:
+            raise ValueError('AST format %d is newer than the supported one (%d)' % (self.version, FORMAT_VERSION))
+        self.types = []
+        self.strings = []
+        self.count = 0   # number of the nodes read
+        self.loc = 0
+
+    def _class(self, name):
+        # the action class of name, only from the trusted modules, registered or given
+        if name in self.classes:
+            ret = self.classes[name]
+        elif name in _registered:
+            ret = _registered[name]
+        else:
+            module, _, qualname = name.partition(':')
+            if not any(module == m or module.startswith(m + '.') for m in trustedModules):
+                raise ValueError('class %s of AST stream is not of a trusted module, see registerAction' % name)
+            try:
+                ret = importlib.import_module(module)
+                for attr in qualname.split('.'):
+                    ret = getattr(ret, attr)
+            except (ImportError, AttributeError):
+                raise ValueError('class %s of AST stream is not found' % name)
+        if not (isinstance(ret, type) and issubclass(ret, BaseAction)):
+            raise ValueError('%s of AST stream is not an action class' % name)
+        return ret
+
+    def __iter__(self):
+        return self.records(NodeRef)
+
+    def records(self, resolve):
+        # the records, the subtrees in tokens are resolve(index)
+        read = self.input
+        while True:
+            tag = read.byte()
+            if tag is None:
+                return
+            elif tag == _TYPE:
+                self.types.append(self._class(read.read(read.varint()).decode('utf-8')))
+            elif tag == _STRING:
+                self.strings.append(read.read(read.varint()).decode('utf-8'))
+            elif tag == _NODE:
+                cls = self.types[read.varint()]
+                self.loc += _unzigzag(read.varint())
+                tokens = self._tokens(resolve, [])
+                self.count += 1
+                yield NodeRecord(self.count - 1, cls, self.loc, tokens)
+            elif tag == _ROOT:
+                yield RootRecord(read.varint())
+            else:
+                raise ValueError('unknown record %d in AST stream' % tag)
+
+    def _tokens(self, resolve, memo):
+        read = self.input
+        tag = read.byte()
+        if tag == _ACTION:
+            return resolve(read.varint())
+        elif tag == _NONE:
+            return None
+        elif tag == _TRUE:
+            return True
+        elif tag == _FALSE:
+            return False
+        elif tag == _INT:
+            return _unzigzag(read.varint())
+        elif tag == _FLOAT:
+            return _double.unpack(read.read(8))[0]
+        elif tag == _STR:
+            return self.strings[read.varint()]
+        elif tag == _SAME:
+            return memo[read.varint()]
+        elif tag == _RESULTS:
+            ret = pp.ParseResults([])
+            memo.append(ret)
+            ret.extend([self._tokens(resolve, memo) for _ in range(read.varint())])
+            for _ in range(read.varint()):
+                name = self.strings[read.varint()]
+                value = self._tokens(resolve, memo)
+                ret[name] = pp._ParseResultsWithOffset(value, _unzigzag(read.varint()))
+            return ret
+        elif tag == _COMPACT:
+            ret = CompactTokens()
+            memo.append(ret)
+            ret.items = tuple(self._tokens(resolve, memo) for _ in range(read.varint()))
+            names = {}
+            for _ in range(read.varint()):
+                name = self.strings[read.varint()]
+                names[name] = self._tokens(resolve, memo)
+            ret.names = names or None
+            return ret
+        elif tag in (_LIST, _TUPLE):
+            ret = []
+            memo.append(ret)
+            ret.extend(self._tokens(resolve, memo) for _ in range(read.varint()))
+            return ret if tag == _LIST else tuple(ret)
+        else:
+            raise ValueError('unknown tokens %s in AST stream' % tag)
+
+    def trees(self, lazy=False):
+        """The roots of the trees in the stream
+
+        Keyword Arguments:
+            lazy {bool} -- make LazyAction objects, created on first access (default: {False})
+        """
+        nodes = []
+        for record in self.records(nodes.__getitem__):
+            if isinstance(record, RootRecord):
+                yield nodes[record.index]
+            else:
+                args = self.instring, record.loc, record.cls.wrapTokens(record.tokens)
+                nodes.append(LazyAction(record.cls, args) if lazy else record.cls(*args))
+
+
+def dumpAST(action, fileobj):
+    # write the tree of action to a binary file object
+    writer = ASTWriter(fileobj)
+    writer.write(action)
+    writer.flush()
+
+def dumpsAST(action):
+    fo = io.BytesIO()
+    dumpAST(action, fo)
+    return fo.getvalue()
+
+def loadAST(fileobj, lazy=False, classes={}, instring=''):
+    # read the first tree in a binary file object
+    for tree in ASTReader(fileobj, classes, instring).trees(lazy):
+        return tree
+    raise ValueError('no tree in the AST stream')
+
+def loadsAST(data, *args, **kwargs):
+    return loadAST(io.BytesIO(data), *args, **kwargs)
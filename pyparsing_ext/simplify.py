@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Constant folding and algebraic simplification of trees of actions
+
+simplify(action, calculator) returns a tree with the same value, where
+- the numbers are ValueAction nodes holding their values (Decimal, int),
+- the subtrees of pure actions whose operands are all values and whose functions
+  are pure functions of the dictionary are replaced by their values,
+- the constant prefix of a left-associative chain (2*3*x) and the constant suffix of
+  a right-associative one (x^2^3) are folded,
+- the identities x*1 = 1*x = x, x-0 = x, x^1 = x and -(-x) = x are applied to the functions
+  of the operator module,
+- a constant operand deciding a logical operator (False and x) or the condition of a ternary
+  gives the value or the branch.
+
+The dictionary is taken as constant, as in compileAction. Subtrees raising an error
+(1/0) are kept, so the error is raised by the evaluation as before.
+x+0 is kept (it is 0.0 for x = -0.0), and so is x/1 (it is a float for an int x).
+The result is consumed by eval, evalShared, compileAction and compileProgram;
+it could not be serialized if it has values of other types than the tokens.
+'''
+
+import copy
+import numbers
+import operator
+
+import pyparsing as pp
+
+from pyparsing_ext.actions import *
+from pyparsing_ext.compiler import _resolved
+
+
+# operator => (identity element, positions of the operand it is dropped at)
+_identities = {
+    operator.mul: (1, 'any'),
+    operator.sub: (0, 'right'),
+    operator.pow: (1, 'right')
+}
+
+
+def _isValue(x):
+    return type(x) is ValueAction
+
+
+class Simplifier(Transformer):
+    '''Transformer folding the constant subtrees, see simplify
+
+    Attributes:
+        calculator -- gives the dictionary
+        identities {bool} -- apply the algebraic identities
+    '''
+
+    def __init__(self, calculator, identities=True):
+        self.calculator = calculator
+        self.identities = identities
+        # evaluate the constant subtrees without the context, only the dictionary is constant
+        self.scratch = copy.copy(calculator)
+        self.scratch.context = {}
+        self.pure = {}
+
+    def isPure(self, t):
+        # t is a pure function (or constant) of the dictionary
+        if t not in self.pure:
+            try:
+                self.pure[t] = t in self.calculator.dictionary and self.calculator.isPure(t)
+            except TypeError:
+                self.pure[t] = False
+        return self.pure[t]
+
+    def function(self, t, arity):
+        # the function of the dictionary the name t applies for arity, None if it is not resolved
+        try:
+            ok, f = _resolved(self.scratch, t, arity)
+        except TypeError:
+            return None
+        return f if ok else None
+
+    def value(self, node):
+        # ValueAction of the value of node, None if it could not be computed
+        try:
+            value = node.eval(self.scratch)
+        except Exception:
+            return None
+        return ValueAction(node.instring, node.loc, [value])
+
+    def make(self, node, tokens):
+        # node of the class of node with the tokens
+        return type(node)(node.instring, node.loc, type(node).wrapTokens(pp.ParseResults(tokens)))
+
+    def visit_NumberAction(self, node):
+        return self.value(node) or node
+
+    visit_IntegerAction = visit_NumberAction
+
+    def visit_VariableAction(self, node):
+        return node
+
+    def generic_visit(self, node):
+        node = yield from super().generic_visit(node)
+        if not isinstance(node, BaseAction) or not node.pure or _isValue(node):
+            return node
+        children = node.children()
+        # atoms are kept, functions without arguments are the constants of the dictionary
+        if (children or isinstance(node, FunctionAction)) and all(map(_isValue, children)) and all(map(self.isPure, node.callees())):
+            return self.value(node) or node
+        return node
+
+    def visit_BinaryOperatorAction(self, node):
+        node = yield from self.generic_visit(node)
+        if not isinstance(node, BinaryOperatorAction) or node.ishybrid or type(node) is CompareAction:
+            return node
+        return self.chain(node)
+
+    def chain(self, node):
+        # fold the constant end of the chain of a binary operator and drop the identity elements
+        args = list(node.args)
+        if not self.isPure(node.function) or self.function(node.function, 0) is None:
+            return node
+        right = isinstance(node, RightBinaryOperatorAction)
+        # operands evaluated first: the prefix for the left-associative operators, the suffix for the others
+        ordered = args[::-1] if right else args
+        n = 0
+        while n < len(ordered) and _isValue(ordered[n]):
+            n += 1
+        if 2 <= n < len(ordered):
+            head = ordered[:n][::-1] if right else ordered[:n]
+            folded = self.value(self.make(node, self.tokens(node, head)))
+            if folded is not None:
+                ordered = [folded] + ordered[n:]
+                args = ordered[::-1] if right else ordered
+        if self.identities:
+            args = self.dropIdentities(self.function(node.function, 0), args, right)
+        if len(args) == 1:
+            return args[0]
+        if len(args) == len(node.args) and all(a is b for a, b in zip(args, node.args)):
+            return node
+        return self.make(node, self.tokens(node, args))
+
+    @staticmethod
+    def tokens(node, args):
+        # tokens of a chain of the operator of node
+        ret = [args[0]]
+        for arg in args[1:]:
+            ret += [node.function, arg]
+        return ret
+
+    @staticmethod
+    def dropIdentities(f, args, right=False):
+        try:
+            unit, where = _identities[f]
+        except (KeyError, TypeError):
+            return args
+        def isUnit(x):
+            return _isValue(x) and isinstance(x.content, numbers.Number) and not isinstance(x.content, bool) and x.content == unit
+        if f is operator.pow:
+            # x^1^y is x, x^y^1 is x^y
+            for k, arg in enumerate(args[1:], 1):
+                if isUnit(arg):
+                    return args[:k]
+            return args
+        if where == 'any':
+            kept = [arg for arg in args if not isUnit(arg)]
+            return kept or args[:1]
+        return args[:1] + [arg for arg in args[1:] if not isUnit(arg)]
+
+    def visit_LogicalOperatorAction(self, node):
+        node = yield from self.generic_visit(node)
+        # a constant first operand deciding the operator is the value: False and x
+        if isinstance(node, LogicalOperatorAction) and not node.ishybrid and _isValue(node.args[0]):
+            stop = node.stops.get(node.function)
+            if stop is not None and bool(node.args[0].content) == stop:
+                return node.args[0]
+        return node
+
+    def visit_TernaryOperatorAction(self, node):
+        node = yield from self.generic_visit(node)
+        # the branch taken by a constant condition
+        if isinstance(node, TernaryOperatorAction):
+            positions = node.conditional()
+            if positions is not None and _isValue(node.args[positions[0]]):
+                c, a, b = positions
+                return node.args[a] if node.args[c].content else node.args[b]
+        return node
+
+    def visit_UnaryOperatorAction(self, node):
+        node = yield from self.generic_visit(node)
+        if not self.identities or not isinstance(node, UnaryOperatorAction) or type(node) is ICDAction:
+            return node
+        # -(-x) is x
+        inner = node.operand
+        if isinstance(inner, UnaryOperatorAction) and type(inner) is not ICDAction and \
+            self.function(node.function, 1) is operator.neg and self.function(inner.function, 1) is operator.neg:
+            return inner.operand
+        return node
+
+
+def simplify(action, calculator, identities=True):
+    '''Fold the constant subtrees of action and apply the algebraic identities
+
+    Example:
+        tree = simplify(language.parse('2*3*x + 4^2'), language.calculator)
+        tree.eval(calculator)  # == the value of the former tree
+
+    Arguments:
+        action {BaseAction} -- tree of expression actions
+        calculator {StandardCalculator} -- gives the dictionary and `isPure`
+
+    Keyword Arguments:
+        identities {bool} -- apply the identities x*1 = x, x-0 = x, ... that hold for numbers (default: {True})
+
+    Returns:
+        BaseAction -- the simplified tree; the unchanged subtrees are shared with action
+    '''
+    return Simplifier(calculator, identities).visit(action)
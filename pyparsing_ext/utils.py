@@ -2,9 +2,338 @@
 # -*- coding: utf-8 -*-
 
 
+import collections
+import functools
+import re
+import sys
+try:
+    from re import _parser as _sre
+except ImportError:
+    import sre_parse as _sre
+
 import pyparsing as pp
 
 from pyparsing_ext import *
+from pyparsing_ext.parsers import _Enhance
+
+
+# static analysis of grammars
+GrammarFacts = collections.namedtuple('GrammarFacts', ('nullable', 'first', 'lookahead', 'keywords', 'recursive', 'atomic', 'monomial'))
+GrammarFacts.__doc__ = '''Facts of a ParserElement computed by `analyze`
+
+    nullable: it may succeed without consuming any character
+    first: characters that a non-empty match may start with (after whitespace)
+    lookahead: characters at which it may succeed, '' standing for the end of the string
+    keywords: literal strings that every non-empty match starts with
+    recursive: it may reach itself (through a Forward)
+    atomic, monomial: see isatomic and ismonomial
+
+    `None` stands for an unbounded (unknown) set.'''
+
+_EMPTY = frozenset()
+_BOTTOM = (_EMPTY, _EMPTY, _EMPTY)   # (first, empty-on, keywords) of NoMatch
+
+def _union(a, b):
+    if a is None or b is None:
+        return None
+    return a | b
+
+def _intersect(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a & b
+
+def _chars(a):
+    # drop the end-of-string marker
+    return a if a is None or '' not in a else a - {''}
+
+
+def _children(pe):
+    if isinstance(pe, pp.ParseExpression):
+        return pe.exprs
+    elif isinstance(pe, _Enhance) and pe.expr is not None:
+        return [pe.expr]
+    return []
+
+
+def _tokenFacts(pe):
+    # (first, empty-on, keywords) of a token
+    # empty-on is the set of next characters at which the token matches the empty string
+    if isinstance(pe, pp.Empty):
+        return _EMPTY, None, _EMPTY
+    elif isinstance(pe, pp.NoMatch):
+        return _BOTTOM
+    elif isinstance(pe, pp.CaselessLiteral):
+        c = pe.match[0]
+        return frozenset((c.lower(), c.upper())), _EMPTY, None
+    elif isinstance(pe, (pp.Literal, pp.Keyword)):
+        c = pe.match[0]
+        if getattr(pe, 'caseless', False):
+            return frozenset((c.lower(), c.upper())), _EMPTY, None
+        return frozenset(c), _EMPTY, frozenset((pe.match,))
+    elif isinstance(pe, pp.Word):
+        return frozenset(pe.initChars), _EMPTY, None
+    elif isinstance(pe, pp.QuotedString):
+        return frozenset(pe.quoteChar[0]), _EMPTY, None
+    elif isinstance(pe, pp.White):
+        return frozenset(pe.matchWhite), _EMPTY, None
+    elif isinstance(pe, pp.LineEnd):
+        return frozenset('\n'), frozenset(('',)), frozenset('\n')
+    elif isinstance(pe, pp.StringEnd):
+        return _EMPTY, frozenset(('',)), _EMPTY
+    elif isinstance(pe, pp.GoToColumn):
+        return None, None, None
+    elif isinstance(pe, pp._PositionToken):
+        return _EMPTY, None, _EMPTY
+    elif isinstance(pe, (Escape, EscapeRight)):
+        return frozenset(pe.escChar), _EMPTY, None
+    elif isinstance(pe, pp.Regex) and not pe.mayReturnEmpty:
+        return _regexFirst(pe.re), _EMPTY, None
+    else:
+        # Regex, CharsNotIn, Wordx, ...
+        return None, (None if pe.mayReturnEmpty else _EMPTY), None
+
+
+@functools.lru_cache(maxsize=None)
+def _decimals():
+    # characters matched by \\d
+    return frozenset(c for c in map(chr, range(sys.maxunicode + 1)) if c.isdecimal())
+
+def _regexFirst(regex):
+    # characters that a match of a compiled regex may start with, None if unknown
+    try:
+        items = _sre.parse(regex.pattern, regex.flags)
+    except Exception:
+        return None
+    ignorecase = regex.flags & re.I
+
+    def chars(av):
+        cs = set()
+        for op, a in av:
+            if op is _sre.LITERAL:
+                cs.add(chr(a))
+            elif op is _sre.RANGE and a[1] - a[0] < 256:
+                cs.update(map(chr, range(a[0], a[1] + 1)))
+            elif op is _sre.CATEGORY and a is _sre.CATEGORY_DIGIT:
+                cs |= frozenset('0123456789') if regex.flags & re.A else _decimals()
+            else:
+                return None
+        return cs
+
+    def sequence(items):
+        # -> first, nullable
+        first = set()
+        for op, av in items:
+            if op is _sre.LITERAL:
+                f, nullable = {chr(av)}, False
+            elif op is _sre.IN:
+                f, nullable = chars(av), False
+            elif op is _sre.SUBPATTERN:
+                f, nullable = sequence(av[-1])
+            elif op is _sre.BRANCH:
+                f, nullable = set(), False
+                for branch in av[1]:
+                    g, n = sequence(branch)
+                    f = None if f is None or g is None else f | g
+                    nullable = nullable or n
+            elif op in (_sre.MAX_REPEAT, _sre.MIN_REPEAT, getattr(_sre, 'POSSESSIVE_REPEAT', None)):
+                f, nullable = sequence(av[2])
+                nullable = nullable or av[0] == 0
+            elif op in (_sre.AT, _sre.ASSERT, _sre.ASSERT_NOT):
+                continue
+            else:
+                return None, True
+            if f is None:
+                return None, True
+            first |= f
+            if not nullable:
+                return first, False
+        return first, True
+
+    first, _ = sequence(items)
+    if first is None:
+        return None
+    if ignorecase:
+        first |= {c.swapcase() for c in first}
+    return frozenset(first)
+
+
+def _sequenceFacts(facts):
+    # facts of a sequence of elements
+    first, empty, keywords = _EMPTY, None, _EMPTY
+    for f, e, k in facts:
+        if empty is None or empty:
+            c = _chars(_intersect(f, empty))
+            first = _union(first, c)
+            if c is None or c:
+                keywords = _union(keywords, k)
+        empty = _intersect(empty, e)
+    return first, empty, keywords
+
+
+def _localFacts(pe, sub):
+    # (first, empty-on, keywords) of pe, where sub maps sub-elements to their facts
+    if isinstance(pe, pp.Token):
+        return _tokenFacts(pe)
+    elif isinstance(pe, Meanwhile):
+        return sub(pe.exprs[0])
+    elif isinstance(pe, pp.And):
+        return _sequenceFacts(map(sub, pe.exprs))
+    elif isinstance(pe, pp.Each):
+        first, empty, keywords = _EMPTY, None, _EMPTY
+        for f, e, k in map(sub, pe.exprs):
+            first, empty, keywords = _union(first, f), _intersect(empty, e), _union(keywords, k)
+        return first, empty, keywords
+    elif isinstance(pe, pp.ParseExpression):
+        # Or, MatchFirst
+        first, empty, keywords = _BOTTOM
+        for f, e, k in map(sub, pe.exprs):
+            first, empty, keywords = _union(first, f), _union(empty, e), _union(keywords, k)
+        return first, empty, keywords
+    elif isinstance(pe, _Enhance):
+        if pe.expr is None:
+            return _BOTTOM
+        elif isinstance(pe, pp.SkipTo):
+            return None, None, None
+        elif isinstance(pe, (pp.NotAny, pp.PrecededBy)):
+            return _EMPTY, None, _EMPTY
+        f, e, k = sub(pe.expr)
+        if isinstance(pe, pp.FollowedBy):
+            return _EMPTY, _union(f, e), _EMPTY
+        elif isinstance(pe, (pp.Optional, pp.ZeroOrMore)):
+            return f, None, k
+        else:
+            return f, e, k
+    else:
+        return None, None, None
+
+
+def _components(pe, children):
+    # strongly connected components of the grammar graph, children first (Tarjan)
+    index, low, onstack, stack, sccs = {}, {}, set(), [], []
+    index[id(pe)] = low[id(pe)] = 0
+    stack.append(pe); onstack.add(id(pe))
+    work = [(pe, iter(children(pe)))]
+    while work:
+        node, it = work[-1]
+        for child in it:
+            if id(child) not in index:
+                index[id(child)] = low[id(child)] = len(index)
+                stack.append(child); onstack.add(id(child))
+                work.append((child, iter(children(child))))
+                break
+            elif id(child) in onstack:
+                low[id(node)] = min(low[id(node)], index[id(child)])
+        else:
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[id(parent)] = min(low[id(parent)], low[id(node)])
+            if low[id(node)] == index[id(node)]:
+                scc = []
+                while True:
+                    x = stack.pop(); onstack.discard(id(x))
+                    scc.append(x)
+                    if x is node:
+                        break
+                sccs.append(scc)
+    return sccs
+
+
+def _cache(pe):
+    # valid cache (stamp, facts, local facts) of pe or None
+    cache = getattr(pe, '_ppx_facts', None)
+    if cache is not None and all(f.expr is e for f, e in cache[0]):
+        return cache
+
+
+def analyze(pe, refresh=False):
+    '''Static analysis of ParserElement pe
+
+    The facts of pe and of all its sub-elements are computed in one pass over
+    the grammar graph and cached on the elements. The cache of an element is
+    invalidated when a Forward it reaches is reassigned; call it with
+    refresh=True after editing the grammar in other ways (e.g. appending to a MatchFirst).
+
+    Returns:
+        GrammarFacts
+    '''
+    known = {}
+    def children(x):
+        if not refresh:
+            cache = _cache(x)
+            if cache is not None:
+                known[id(x)] = cache
+                return []
+        return _children(x)
+
+    sccs = _components(pe, children)
+    if id(pe) in known:
+        return known[id(pe)][1]
+
+    local, done, forwards = {}, {}, {}
+    for id_, (stamp, facts, raw) in known.items():
+        local[id_], done[id_], forwards[id_] = raw, facts, frozenset(f for f, _ in stamp)
+    def sub(e):
+        return local[id(e)]
+
+    for scc in sccs:
+        if id(scc[0]) in known:
+            continue
+        members = {id(x) for x in scc}
+        cyclic = len(scc) > 1 or any(c is scc[0] for c in _children(scc[0]))
+        # reachable Forwards, to stamp the cache
+        fwds = {x for x in scc if isinstance(x, pp.Forward)}
+        for x in scc:
+            for c in _children(x):
+                if id(c) not in members:
+                    fwds |= forwards[id(c)]
+        fwds = frozenset(fwds)
+        stamp = tuple((f, f.expr) for f in fwds)
+
+        # least fixed point of (first, empty-on, keywords) in the component
+        for x in scc:
+            local[id(x)] = _BOTTOM
+        changed = True
+        while changed:
+            changed = False
+            for x in scc:
+                v = _localFacts(x, sub)
+                if v != local[id(x)]:
+                    local[id(x)] = v
+                    changed = cyclic
+
+        for x in scc:
+            forwards[id(x)] = fwds
+            recursive = cyclic or any(done[id(c)].recursive for c in _children(x))
+            if recursive:
+                atomic = monomial = False
+            elif isinstance(x, pp.Token):
+                atomic = monomial = True
+            elif isinstance(x, _Enhance):
+                atomic = monomial = False
+                if x.expr is not None:
+                    atomic, monomial = done[id(x.expr)].atomic, done[id(x.expr)].monomial
+            else:
+                atomic = len(x.exprs) == 1 and done[id(x.exprs[0])].atomic
+                monomial = atomic or isinstance(x, (pp.And, pp.Each)) and all(done[id(c)].monomial for c in x.exprs)
+            f, e, k = local[id(x)]
+            facts = GrammarFacts(nullable=e is None or bool(e), first=f, lookahead=_union(f, e),
+                keywords=k, recursive=recursive, atomic=atomic, monomial=monomial)
+            done[id(x)] = facts
+            x._ppx_facts = (stamp, facts, local[id(x)])
+    return done[id(pe)]
+
+
+def isnullable(pe):
+    # whether ParserElement pe may match the empty string
+    return analyze(pe).nullable
+
+def isrecursive(pe):
+    # whether ParserElement pe may reach itself
+    return analyze(pe).recursive
 
 # advanced functitons
 def isatomic(pe):
@@ -12,51 +341,109 @@ def isatomic(pe):
     a token is atomic
     enhancement of an atom is atomic
     expression consisting of only one atom is atomic'''
-    if pe.checkRecursion([]):
-        return False
-    if isinstance(pe, pp.Token):
-        return True
-    elif isinstance(pe, _Enhance):
-        return isatomic(pe.expr)
-    elif isinstance(pe, pp.ParseExpression):
-        if len(pe.exprs) ==1:
-            return isatomic(pe.exprs[0])
-        else:
-            return False
-    else:
-        return False
+    return analyze(pe).atomic
 
 def ismonomial(pe, product=(pp.And, pp.Each)):
     # exmpale: a + b + c where a, b, c are atomic as in polynomials
-    if pe.checkRecursion([]):
+    if product == (pp.And, pp.Each):
+        return analyze(pe).monomial
+    if analyze(pe).recursive:
         return False
     if isatomic(pe):
         return True
     elif isinstance(pe, _Enhance):
-        return ismonomial(pe.expr)
+        return ismonomial(pe.expr, product)
     elif isinstance(pe, product):
-        return all(ismonomial(expr) for expr in pe.exprs)
+        return all(ismonomial(expr, product) for expr in pe.exprs)
     else:
         return False
 
 
-def expand(pe, aslist = False):
-    pe.streamline()
-    if isinstance(pe, (pp.And, pp.Each)):
-        if pe.exprs:
-            x = expand(pe.exprs[0], True)
-            for expr in pe.exprs[1:]:
-                x = [xi + a for xi in x for a in expand(expr, True)]
+# expansion of alternatives
+def _key(pe):
+    # structural key of a leaf in an expansion
+    if isinstance(pe, (pp.Literal, pp.Keyword)) and not (pe.parseAction or pe.resultsName):
+        return type(pe), pe.match
+    return id(pe)
+
+def _join(parts):
+    if not parts:
+        return pp.Empty()
+    elif len(parts) == 1:
+        return parts[0]
+    else:
+        return pp.And(list(parts))
+
+def _expansions(pe, maxdepth, trail):
+    # generate the alternatives of pe as tuples of (element, key) to be concatenated
+    if isinstance(pe, pp.Forward):
+        if pe.expr is None:
+            yield ((pe, id(pe)),)
+            return
+        depth = sum(f is pe for f in trail)
+        if depth:
+            if maxdepth is None:
+                raise pp.RecursiveGrammarException(list(trail) + [pe])
+            if depth >= maxdepth:
+                yield ((pe, id(pe)),)
+                return
+        yield from _expansions(pe.expr, maxdepth, trail + (pe,))
+    elif isinstance(pe, pp.And):
+        yield from _product(pe.exprs, maxdepth, trail)
     elif isinstance(pe, (pp.Or, pp.MatchFirst)):
-        x = []
         for expr in pe.exprs:
-            x.extend(expand(expr, True))
-    elif isinstance(pe, _Enhance):
-        x = expand(pe.expr, True)
+            yield from _expansions(expr, maxdepth, trail)
+    elif isinstance(pe, pp.Optional):
+        yield from _expansions(pe.expr, maxdepth, trail)
+        yield ()
+    elif isinstance(pe, pp.TokenConverter):
+        for parts in _expansions(pe.expr, maxdepth, trail):
+            c = pe.copy()
+            c.expr = _join([e for e, _ in parts])
+            yield ((c, (id(pe), tuple(k for _, k in parts))),)
     else: # x is monomal
-        x = [pe]
+        yield ((pe, _key(pe)),)
+
+def _product(exprs, maxdepth, trail, start=0):
+    if start == len(exprs):
+        yield ()
+        return
+    for head in _expansions(exprs[start], maxdepth, trail):
+        for tail in _product(exprs, maxdepth, trail, start+1):
+            yield head + tail
+
+
+def iterexpand(pe, maxcount=None, maxdepth=None):
+    '''Generate the alternatives of ParserElement pe lazily
+
+    Alternatives of Or/MatchFirst (and Optional) are distributed over And,
+    so that pe matches what one of the generated elements matches.
+    Structural duplicates are removed. Repetitions and lookaheads are kept as they are.
+
+    Keyword Arguments:
+        maxcount {int} -- the maximal number of alternatives (default: {None})
+        maxdepth {int} -- how many times a recursive Forward may be unfolded,
+                          it is kept unexpanded beyond (default: {None})
+
+    Raises:
+        pp.RecursiveGrammarException -- a recursive Forward makes the expansion infinite
+                                        and maxdepth is not given
+    '''
+    if maxcount is not None and maxcount <= 0:
+        return
+    seen = set()
+    for parts in _expansions(pe, maxdepth, ()):
+        key = tuple(k for _, k in parts)
+        if key not in seen:
+            seen.add(key)
+            yield _join([e for e, _ in parts])
+            if len(seen) == maxcount:
+                break
+
 
-    x = [xi.streamline() for xi in x]
+def expand(pe, aslist=False, maxcount=None, maxdepth=None):
+    # expand pe to a MatchFirst of monomials, see iterexpand
+    x = list(iterexpand(pe, maxcount, maxdepth))
     if aslist:
         return x
     else:
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''Compile trees of statements to instructions run by a dispatch loop
+
+compileProgram(tree, calculator) gives a Code: a flat list of instructions,
+where if, while, for, break, continue and return are jumps, instead of
+the recursive `execute` of the statements and the checks of `calculator.control`
+after each of them. `Code.run(calculator)` runs it with the same effects as
+`tree.execute(calculator)`, including `maxloop` and the control state left in the calculator.
+
+The expressions are compiled by compileAction, unless the program runs code
+the compiler can not see (embedded code, statements of unknown classes).
+The statements of unknown classes are executed by their own `execute`,
+then the control state they set is handled as the sequences and the loops do.
+'''
+
+from pyparsing_ext.actions import *
+from pyparsing_ext.compiler import compileAction
+
+
+# opcodes, instructions are (opcode, a, b)
+EXEC, CHECK, ASSIGN, JUMP, JUMP_IF_NOT, LOOP, TICK, FOR, NEXT, DEF, EXIT = range(11)
+
+_CONTROLS = ('break', 'continue', 'return')
+_noop = {BaseAction.execute, CommandAction.execute}
+
+
+class Code:
+    '''Instructions of a program
+
+    instructions: list of (opcode, a, b)
+    registers: number of loop counters
+    '''
+
+    def __init__(self, instructions, registers):
+        self.instructions = instructions
+        self.registers = registers
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def run(self, calculator):
+        # the dispatch loop
+        code = self.instructions
+        regs = [None] * self.registers
+        pc = 0
+        n = len(code)
+        while pc < n:
+            op, a, b = code[pc]
+            pc += 1
+            if op == ASSIGN:
+                # a: name, b: value of the calculator
+                calculator.update({a: b(calculator)})
+            elif op == JUMP_IF_NOT:
+                if not a(calculator):
+                    pc = b
+            elif op == TICK:
+                if regs[a] == 0:
+                    raise Exception('reach the maximal looping')
+                regs[a] -= 1
+            elif op == JUMP:
+                pc = a
+            elif op == EXEC:
+                a.execute(calculator)
+            elif op == NEXT:
+                # a: register, b: (variable, end of the loop)
+                it = regs[a]
+                try:
+                    value = next(it[0])
+                except StopIteration:
+                    pc = b[1]
+                    continue
+                calculator.update({b[0]: value})
+                if it[1] == 0:
+                    raise Exception('reach the maximal looping')
+                it[1] -= 1
+            elif op == LOOP:
+                regs[a] = calculator.maxloop
+            elif op == FOR:
+                # a: register, b: value of the calculator to iterate
+                regs[a] = [iter(b(calculator)), calculator.maxloop]
+            elif op == CHECK:
+                # a: (end of the loop, start of the next iteration) or None, b: exit
+                control = calculator.control
+                if control in _CONTROLS:
+                    if a is None or control == 'return':
+                        pc = b
+                    else:
+                        calculator.control = None
+                        pc = a[0] if control == 'break' else a[1]
+            elif op == DEF:
+                # a: DefAction, b: Code of the body
+                calculator.update({a.function: a.makeFunction(calculator, b.run)})
+            elif op == EXIT:
+                # break or continue out of any loop: a is the control state
+                calculator.control = a
+                pc = n
+
+
+def _bound(tree):
+    # (names the program binds, whether its expressions can be compiled)
+    names = set()
+    compilable = True
+    stack = [tree]
+    while stack:
+        x = stack.pop()
+        if type(x) is LazyAction:
+            x = x.force()
+        if isinstance(x, AssignmentAction):
+            names.add(x.variable.content)
+        elif isinstance(x, DefAction):
+            names.add(x.function)
+            names.update(getattr(p.name, 'content', p.name) for p in x.parameters)
+        elif isinstance(x, ForAction) and hasattr(x, 'loopingVar'):
+            names.add(x.loopingVar)
+        elif isinstance(x, EmbedAction):
+            compilable = False
+        stack.extend(x.children())
+    return names, compilable
+
+
+class _Compiler:
+    # statements => instructions
+
+    def __init__(self, calculator, dynamic, compilable):
+        self.calculator = calculator
+        self.dynamic = dynamic
+        self.compilable = compilable
+
+    def expression(self, expr):
+        # function of the calculator giving the value of expr
+        if self.compilable and isinstance(expr, BaseAction):
+            f = compileAction(expr, self.calculator, self.dynamic)
+            return lambda calculator: f(calculator.context)
+        return expr.eval
+
+    def code(self, program):
+        self.instructions = []
+        self.registers = 0
+        self.exits = []   # JUMP and CHECK instructions to patch with the end
+        self.statement(program, None)
+        end = len(self.instructions)
+        for k in self.exits:
+            op, a, b = self.instructions[k]
+            self.instructions[k] = (op, a, end) if op == CHECK else (JUMP, end, None)
+        return Code(self.instructions, self.registers)
+
+    def emit(self, op, a=None, b=None):
+        self.instructions.append((op, a, b))
+        return len(self.instructions) - 1
+
+    def patch(self, k, a=None, b=None):
+        op, a0, b0 = self.instructions[k]
+        self.instructions[k] = op, a0 if a is None else a, b0 if b is None else b
+
+    def statement(self, x, loop):
+        # loop: [breaks, start of the next iteration] of the innermost loop, None out of loops
+        if type(x) is LazyAction:
+            x = x.force()
+        cls = type(x)
+        if cls in (ProgramSequenceAction, ModuleAction):
+            for item in x.program:
+                self.statement(item, loop)
+        elif cls is AssignmentAction and 'type' not in x:
+            if 'args' in x:
+                args = [self.expression(arg) for arg in x.args]
+                value = lambda calculator: tuple(arg(calculator) for arg in args)
+            else:
+                value = self.expression(x.arg)
+            self.emit(ASSIGN, x.variable.content, value)
+        elif cls is IfAction:
+            k = self.emit(JUMP_IF_NOT, self.expression(x.condition))
+            self.statement(x.program, loop)
+            self.patch(k, b=len(self.instructions))
+        elif cls is IfelseAction and hasattr(x, 'elseprogram'):
+            jumps = []
+            for c, p in zip(x.conditions, x.programs):
+                k = self.emit(JUMP_IF_NOT, self.expression(c))
+                self.statement(p, loop)
+                jumps.append(self.emit(JUMP))
+                self.patch(k, b=len(self.instructions))
+            self.statement(x.elseprogram, loop)
+            for k in jumps:
+                self.patch(k, a=len(self.instructions))
+        elif cls is WhileAction:
+            r = self.register()
+            self.emit(LOOP, r)
+            start = self.emit(JUMP_IF_NOT, self.expression(x.condition))
+            self.emit(TICK, r)
+            inner = [[], start]
+            self.statement(x.program, inner)
+            self.emit(JUMP, start)
+            self.patch(start, b=len(self.instructions))
+            self.close(inner)
+        elif cls is ForAction and hasattr(x, 'range_'):
+            r = self.register()
+            self.emit(FOR, r, self.expression(x.range_))
+            start = self.emit(NEXT, r)
+            inner = [[], start]
+            self.statement(x.program, inner)
+            self.emit(JUMP, start)
+            self.patch(start, b=(x.loopingVar, len(self.instructions)))
+            self.close(inner)
+        elif cls is DefAction:
+            self.emit(DEF, x, _Compiler(self.calculator, self.dynamic, self.compilable).code(x.program))
+        elif cls in (BreakAction, ContinueAction):
+            control = 'break' if cls is BreakAction else 'continue'
+            if loop is None:
+                self.emit(EXIT, control)
+            elif cls is BreakAction:
+                loop[0].append(self.emit(JUMP))
+            else:
+                self.emit(JUMP, loop[1])
+        elif cls is ReturnAction:
+            # sets the return value and the control state
+            self.emit(EXEC, x)
+            self.exits.append(self.emit(JUMP))
+        elif cls is PrintAction or cls.execute in _noop:
+            if cls.execute not in _noop:
+                self.emit(EXEC, x)
+        else:
+            self.emit(EXEC, x)
+            k = self.emit(CHECK, None if loop is None else loop)
+            self.exits.append(k)
+
+    def register(self):
+        self.registers += 1
+        return self.registers - 1
+
+    def close(self, loop):
+        # patch the breaks and the CHECK instructions of the loop
+        end = len(self.instructions)
+        for k in loop[0]:
+            self.patch(k, a=end)
+        for k in range(loop[1], end):
+            op, a, b = self.instructions[k]
+            if op == CHECK and a is loop:
+                self.instructions[k] = (op, (end, loop[1]), b)
+
+
+def compileProgram(tree, calculator):
+    '''Compile the statements of tree to Code
+
+    Arguments:
+        tree {ProgramSequenceAction|ModuleAction} -- result of ProgrammingParser.parse
+        calculator {StandardCalculator} -- gives the dictionary to compile the expressions
+
+    Returns:
+        Code
+    '''
+    dynamic, compilable = _bound(tree)
+    return _Compiler(calculator, dynamic, compilable).code(tree)
+
+def runProgram(tree, calculator):
+    # compile tree and run it, as tree.execute(calculator)
+    compileProgram(tree, calculator).run(calculator)
@@ -3,6 +3,7 @@
 
 import pyparsing as pp
 import pyparsing_ext as ppx
+import pyparsing_ext.pylang
 
 
 w = ppx.Wordx(lambda x: x in {'a', 'b', 'c', 'd'})
@@ -15,4 +16,227 @@ print(p.asList())
 
 s = '''[1]hehe
 [2]hehe'''
-print(ppx.enumeratedItems().parseString(s))
\ No newline at end of file
+print(ppx.enumeratedItems().parseString(s))
+facts = ppx.analyze(M)
+assert ppx.analyze(M) is facts and not facts.nullable and not facts.recursive and facts.monomial
+assert ppx.isatomic(w) and not ppx.isatomic(w + w) and ppx.ismonomial(w + w) and ppx.isnullable(pp.Optional(w))
+nested = pp.Forward()
+nested <<= '(' + pp.Optional(nested) + ')'
+assert ppx.isrecursive(nested)
+ab = pp.oneOf('a b', asKeyword=True) + pp.Optional(w)
+monomials = [str(x) for x in ppx.expand(ab, aslist=True)]
+assert monomials == ['{"a" W:(all:<lambda>)}', '"a"', '{"b" W:(all:<lambda>)}', '"b"']
+# bounded, and the duplicates of ab | ab are dropped
+assert [str(x) for x in ppx.expand(ab, aslist=True, maxcount=3)] == monomials[:3]
+assert [str(x) for x in ppx.expand(ab | ab, aslist=True)] == monomials
+lazy = ppx.iterexpand(ab)
+assert iter(lazy) is lazy and str(next(lazy)) == monomials[0]
+regular = pp.Group(pp.Word(pp.alphas) + pp.Optional(pp.oneOf('+ -'))) + pp.OneOrMore(pp.Word(pp.nums))
+pe, report = ppx.compileRegex(regular)
+assert len(report.converted) == 1 and not report.skipped
+for text in ('abc - 1 2 3', 'x 4', 'ab+ 5 6'):
+    assert pe.parseString(text).asList() == regular.parseString(text).asList()
+assert pe.parseString('abc - 1 2 3').asList() == [['abc', '-'], '1', '2', '3']
+v = pp.Word(pp.alphas)
+alt = pp.Keyword('if') + v | pp.Word(pp.nums) | v + '=' + v
+profile = ppx.profileAlternatives(alt, ['x = y', 'x=z', '12'])
+keyword, number, assignment = alt.exprs
+assert profile.counts == {0: [0, 1, 2]} and profile.apply(alt) == 1
+# the most frequent first, as the alternatives are disjoint
+assert all(a is b for a, b in zip(alt.exprs, [assignment, number, keyword]))
+assert alt.parseString('x = y').asList() == ['x', '=', 'y'] and alt.parseString('if x').asList() == ['if', 'x']
+reordered = str(alt)
+# the counts are kept in the original positions: a reordered grammar gives the same profile
+assert ppx.profileAlternatives(alt, ['x = y', 'x=z', '12']).counts == profile.counts
+assert profile.apply(alt) == 0 and str(alt) == reordered
+try:
+    with ppx.ParseBudget(maxAttempts=3):
+        (v + v + v + v).parseString('a b c d')
+except ppx.ParseBudgetExceeded as ex:
+    assert ex.reason == 'too many attempts' and ex.attempts == 4 and ex.hotspots[0] == (v, 3)
+else:
+    raise AssertionError('the budget is not exceeded')
+with ppx.ParseBudget(maxAttempts=100, timeout=10):
+    assert (v + v + v + v).parseString('a b c d').asList() == ['a', 'b', 'c', 'd']
+assert ppx.recognize(v + v, 'a b') and not ppx.recognize(v + v, 'a b c')
+with ppx.lazyActions():
+    lazy = v.copy().setParseAction(ppx.VariableAction).parseString('x')[0]
+assert type(lazy) is ppx.LazyAction and isinstance(lazy, ppx.VariableAction) and str(lazy) == 'x'
+with ppx.internActions() as ctx:
+    atom = v.copy().setParseAction(ppx.VariableAction)
+    ret = pp.OneOrMore(pp.Group(atom + atom).setParseAction(ppx.FunctionAction)).parseString('f x f x g x')
+assert ret[0] is ret[1] and ret[0] != ret[2] and (len(ctx.interner), ctx.interner.hits) == (5, 4)
+tree = pp.infixNotation(pp.Word(pp.nums).setParseAction(ppx.IntegerAction), [(pp.oneOf('* /'), 2, pp.opAssoc.LEFT, ppx.BinaryOperatorAction), (pp.oneOf('+ -'), 2, pp.opAssoc.LEFT, ppx.BinaryOperatorAction)]).parseString('1+2*3-4')[0]
+assert str(tree) == '1 + 2 * 3 - 4' and tree.sexpr() == '((+, -) 1 (* 2 3) 4)'
+assert [str(a) for a in ppx.walk(tree, 'post')] == ['1', '2', '3', '2 * 3', '4', '1 + 2 * 3 - 4']
+loaded = ppx.loadsAST(ppx.dumpsAST(tree))
+assert loaded.sexpr() == tree.sexpr() and [type(a) for a in ppx.walk(loaded)] == [type(a) for a in ppx.walk(tree)]
+for name in (b'os:system', b'pyparsing_ext.serialize:dumpAST'):
+    try:
+        ppx.loadsAST(b'PPXA\x01\x01' + bytes([len(name)]) + name)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('%s is read from an AST stream' % name)
+import tempfile, os
+with tempfile.TemporaryDirectory() as tmp:
+    parser = ppx.pylang.StandardParser(constants=[{'token': ppx.NUMBER, 'action': ppx.NumberAction}], variables=[{'token': ppx.IDEN, 'action': ppx.VariableAction}], operators=ppx.pylang.arithOpTable)
+    parser.cache = ppx.ParseCache(directory=tmp)
+    with open(os.path.join(tmp, 'a.txt'), 'w') as fo:
+        fo.write('1+2*3')
+    assert parser.parseFile(os.path.join(tmp, 'a.txt')).sexpr() == '(+ 1.0 (* 2.0 3.0))' and parser.cache.hits == 0
+    assert parser.parseFile(os.path.join(tmp, 'a.txt')).sexpr() == '(+ 1.0 (* 2.0 3.0))' and parser.cache.hits == 1
+    parser.parseFile(os.path.join(tmp, 'a.txt'), compact=True)
+    tree = parser.parseFile(os.path.join(tmp, 'a.txt'), compact=True)
+    assert parser.cache.hits == 2 and tree.sexpr() == '(+ 1.0 (* 2.0 3.0))' and type(tree._tokens) is ppx.TokenLayout
+number = lambda: pp.Word(pp.nums)
+assert ppx.grammarFingerprint(number().setParseAction(lambda t: int(t[0]))) != ppx.grammarFingerprint(number().setParseAction(lambda t: float(t[0])))
+assert ppx.grammarFingerprint(number().setParseAction(lambda t: int(t[0]))) == ppx.grammarFingerprint(number().setParseAction(lambda t: int(t[0])))
+assert ppx.grammarFingerprint(number().setParseAction(pp.replaceWith('1'))) != ppx.grammarFingerprint(number().setParseAction(pp.replaceWith('2')))
+assert ppx.grammarFingerprint(number().setParseAction(int.__call__)) is None
+prog = ppx.pylang.ProgrammingLanguage(parser=ppx.pylang.ProgrammingParser(keywords=ppx.pylang.commonKeywords,
+    constants=[{'token': ppx.NUMBER, 'action': ppx.NumberAction}], variables=[{'token': ppx.IDEN, 'action': ppx.VariableAction}],
+    operators=ppx.pylang.arithOpTable), calculator=ppx.pylang.StandardCalculator(dictionary=ppx.pylang.arithDict))
+with tempfile.TemporaryDirectory() as tmp:
+    for name, code in [('base', 'n = n + 1;\n'), ('a', 'load base\nx = n;\n'), ('main', 'load base\nload a\ny = n;\n'), ('c', 'load c\npass;\n')]:
+        with open(os.path.join(tmp, name + '.toy'), 'w') as fo:
+            fo.write(code)
+    prog.calculator.context = {'n': 0}
+    prog.executeFile(os.path.join(tmp, 'main'), prefetch=True)
+    try:
+        prog.executeFile(os.path.join(tmp, 'c'))
+    except ppx.pylang.CyclicLoadError as ex:
+        assert prog.calculator.context == {'n': 1, 'x': 1, 'y': 1} and len(prog.modules) == 4 and ex.chain[-1].name == 'c.toy'
+    else:
+        raise AssertionError('cyclic load is executed')
+arith = ppx.pylang.Language(parser=parser, calculator=ppx.pylang.StandardCalculator(dictionary=ppx.pylang.arithDict))
+f = arith.compile('x^2 + 2*x - 1')
+assert f({'x': 3}) == 14 and f({'x': 1}) == 2 and f({'x': 3}) == arith.parse('x^2 + 2*x - 1').eval(ppx.pylang.StandardCalculator(ppx.pylang.arithDict, {'x': 3}))
+prog.vm = True
+prog.calculator.context = {}
+prog.execute('def f(n) {\nk = 0;\nwhile 1 { k = k + 1; if k > n { return k; } }\n}\ni = 0;\nwhile i < 100 { i = i + 1; if i == 50 { break; } }\nm = f(i);\n')
+assert prog.calculator.context['i'] == 50 and prog.calculator.context['m'] == 51
+assert len(ppx.compileProgram(prog.parse('i = 0;\nwhile i < 3 { i = i + 1; }\n'), prog.calculator)) == 6
+c = ppx.pylang.StandardCalculator(ppx.pylang.arithDict, {'x': 2})
+assert c('+', 1, 2) == 3 and c.copy().symbols is c.symbols and len(c.symbols) == 1
+prog.execute('def fact(n) {\nif n < 2 { return 1; }\nreturn n * fact(n - 1);\n}\nx = fact(6);\n')
+assert prog.calculator.context['x'] == 720 and len(ppx.framePool) > 0
+import concurrent.futures
+frames = ppx.FramePool()
+frame = frames.acquire({})
+frames.release(frame)
+with concurrent.futures.ThreadPoolExecutor(1) as executor:
+    assert executor.submit(lambda: (len(frames), frames.acquire({}) is frame)).result() == (0, False)
+assert len(frames) == 1 and frames.acquire({}) is frame
+tree = arith.simplify('2*3*x + 4^2 - y*1')
+assert str(tree) == '6 * x + 16 - y' and tree.eval(ppx.pylang.StandardCalculator(ppx.pylang.arithDict, {'x': 2, 'y': 1})) == 27
+arith.setNumeric('fraction')
+import fractions
+assert arith.eval('1/3 + 0.5') == fractions.Fraction(5, 6) and arith.compile('x/3')({'x': 1}) == fractions.Fraction(1, 3)
+arith.setNumeric('decimal')
+logic = ppx.pylang.StandardParser(constants=[{'token': ppx.NUMBER, 'action': ppx.NumberAction}], variables=[{'token': ppx.IDEN, 'action': ppx.VariableAction}],
+    operators=ppx.pylang.arithOpTable + [{'token': pp.Keyword('and'), 'action': ppx.LogicalOperatorAction}, {'token': (pp.Keyword('if'), pp.Keyword('else')), 'arity': 3, 'assoc': 'right'}])
+c = ppx.pylang.StandardCalculator(ppx.pylang.arithDict, {'x': 0})
+assert logic.parse('x != 0 and 1 / x > 2').eval(c) is False and logic.parse('1 / x if x != 0 else 0').eval(c) == 0
+try:
+    import numpy as np
+except ImportError:
+    np = None
+if np is not None:
+    arith.setNumeric('float')
+    assert list(arith.evalBatch('x^2 + 2*x - 1', {'x': np.arange(4)})) == [-1, 2, 7, 14]
+    arith.setNumeric('decimal')
+for vm in (True, False):
+    prog.vm = vm
+    prog.calculator.context = {}
+    prog.execute('@memo def fib(n) {\nif n < 2 { return n; }\nreturn fib(n - 1) + fib(n - 2);\n}\nx = fib(60);\n')
+    assert prog.calculator.context['x'] == 1548008755920 and prog.calculator.cacheInfo('fib').hits == 58
+arith.cache = ppx.MemoryCache(maxsize=2)
+trees = arith.parseMany(['x + 1', '2 * x', 'x + 1'])
+assert trees[0] is trees[2] and arith.eval('1 + 2') == arith.eval('1 + 2') == 3 and not arith.matches('1 +')
+assert arith.cache.info() == (1, 4, 2, 2)
+arith.cache = None
+import multiprocessing
+if 'fork' in multiprocessing.get_all_start_methods():
+    results = arith.evalMany(['x^2 + 1', 'x / 0', '2 * y'], [{'x': 3}, {'x': 1}, {'y': 4}], workers=2)
+    assert results[0] == 10 and isinstance(results[1], ZeroDivisionError) and results[2] == 8
+    arith.calculator.context['a'] = 5
+    assert arith.evalMany(['a + 1'], workers=2) == [6]
+    arith.calculator.context['a'] = 7
+    assert arith.evalMany(['a + 1'], workers=2) == [8]
+    arith.calculator.context = {'a': 1}
+    assert arith.evalMany(['a + 1', 'a * 2'], workers=2) == [2, 2]
+    arith.shutdown()
+    arith.calculator.context = {}
+arith.setThreaded()
+def square(k):
+    with arith.request({'x': k}):
+        return arith.eval('x^2')
+with concurrent.futures.ThreadPoolExecutor(4) as executor:
+    assert list(executor.map(square, range(5))) == [0, 1, 4, 9, 16] and 'x' not in arith.sharedCalculator.context
+arith.setThreaded(False)
+import pickle
+c = pickle.loads(pickle.dumps(ppx.pylang.StandardCalculator(ppx.pylang.arithDict, {})))
+try:
+    c('undefined')
+except NameError:
+    pass
+else:
+    raise AssertionError('undefined name found')
+prog.parse('i = 0;\nwhile i < 3 { i = i + 1; }\n').execute(c)
+assert c.context['i'] == 3 and c.maxloop == 5000
+c.useBuiltins, c.maxloop = True, 10
+c = pickle.loads(pickle.dumps(c))
+assert c('len', [1, 2]) == 2 and c.maxloop == 10
+import threading
+def fibs(n):
+    barrier.wait()
+    with prog.request() as c:
+        prog.execute('x = fib(%d);\n' % n)
+        return c.context['x'], c.cacheInfo('fib').misses, c.cacheInfo('fib').hits
+for vm in (True, False):
+    prog.vm = vm
+    prog.calculator.context = {}
+    prog.execute('@memo def fib(n) {\nif n < 2 { return n; }\nreturn fib(n - 1) + fib(n - 2);\n}\n')
+    prog.setThreaded()
+    barrier = threading.Barrier(2)
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        assert list(executor.map(fibs, (20, 10))) == [(6765, 21, 18), (55, 11, 8)]
+    prog.setThreaded(False)
+    assert prog.calculator.cacheInfo('fib').misses == 0 and 'x' not in prog.calculator.context
+arith.setThreaded()
+sources = ['x^%d + %d*(y - %d)' % (k % 3 + 1, k, k % 7) for k in range(40)]
+with concurrent.futures.ThreadPoolExecutor(8) as executor:
+    trees = list(executor.map(arith.parse, sources))
+arith.setThreaded(False)
+assert [tree.sexpr() for tree in trees] == [arith.parse(s).sexpr() for s in sources]
+import io, contextlib
+prog.cache = ppx.MemoryCache()
+for _ in range(2):
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        assert prog.parse('x = = ;') is None
+    assert out.getvalue() and len(prog.cache) == 0
+assert prog.parse('x = 1;\n') is prog.parse('x = 1;\n') and prog.cache.info().currsize == 1
+prog.cache = None
+s, state = '', None
+for line in ['a = 1;', ' # {{\n', 'def f(n) {', 'while n > 0 {', 'n = n - 1;', '}', 'return n;', '}', 'if a {', 'b = 2;', '}', 'c', ' = 3;', 'x = ']:
+    s += line
+    complete, state = prog.parser.continuation(s, state)
+    assert complete == ppx.recognize(prog.parser.grammar, s)
+assert state[1] == 0 and state[2] == [s.index(k) for k in ('a =', 'def', 'if', 'c')]
+source = 'a = 1;\nb = 2;\nif a < 2 {\n\tc = 3;\n}\nd = 4;\ne = 5;\n'
+for old, new in (('d = 4', 'd = 40 + 2'), ('e = 5', 'e =\t5')):
+    start = source.index(old)
+    edited = source[:start] + new + source[start + len(old):]
+    tree, full = prog.parser.reparse(prog.parse(source), start, start + len(old), new), prog.parse(edited)
+    assert tree.sexpr() == full.sexpr() and [s.loc for s in tree.program] == [s.loc for s in full.program]
+prog.cache = ppx.MemoryCache()
+tree = prog.parse(source)
+locs, start = [s.loc for s in tree.program], source.index('d = 4')
+prog.parser.reparse(tree, start, start + len('d = 4'), 'd = 40 + 2')
+assert prog.parse(source) is tree and [s.loc for s in tree.program] == locs and all(s.instring == source for s in tree.program)
+prog.cache = None
+tree = parser.parse('x^2 + 2*x - 1', compact=True)
+assert not hasattr(tree, '__dict__') and isinstance(tree.tokens, ppx.CompactTokens) and tree.loc == 0
+assert all(type(node._tokens) is ppx.TokenLayout and node.instring is None for node in ppx.walk(tree))
+assert tree.sexpr() == parser.parse('x^2 + 2*x - 1').sexpr() and tree.eval(ppx.pylang.StandardCalculator(ppx.pylang.arithDict, {'x': 3})) == 14